@@ -0,0 +1,138 @@
+import threading
+import time
+
+from config import logger
+from db import settings_cache
+
+
+# --- Сводки уведомлений администратору ---
+# Обычные события (пополнения, успешные отправки звезд) копятся в буфере и
+# уходят одним сообщением раз в interval секунд или по достижении max_events.
+# Ошибки отправляются сразу. Параметры читаются из settings при каждом
+# проходе, поэтому меняются без перезапуска (см. /digest).
+DIGEST_INTERVAL_KEY = 'admin_digest_interval'
+DIGEST_MAX_EVENTS_KEY = 'admin_digest_max_events'
+DEFAULT_DIGEST_INTERVAL = 60  # секунд; 0 — отправлять каждое событие сразу
+DEFAULT_DIGEST_MAX_EVENTS = 20
+MESSAGE_LIMIT = 4000  # запас до лимита Telegram в 4096 символов
+
+
+def get_digest_settings():
+    """Возвращает (interval, max_events) из настроек."""
+    interval = max(0.0, settings_cache.get_float(DIGEST_INTERVAL_KEY, DEFAULT_DIGEST_INTERVAL))
+    max_events = max(1, settings_cache.get_int(DIGEST_MAX_EVENTS_KEY, DEFAULT_DIGEST_MAX_EVENTS))
+    return interval, max_events
+
+
+def set_digest_settings(interval, max_events):
+    settings_cache.set(DIGEST_INTERVAL_KEY, float(interval))
+    settings_cache.set(DIGEST_MAX_EVENTS_KEY, int(max_events))
+
+
+class AdminNotifier:
+    """Буфер уведомлений администратору с отправкой сводками."""
+
+    def __init__(self, sender=None):
+        # sender(text, parse_mode) отправляет сообщение администратору
+        self.sender = sender
+        self._cond = threading.Condition()
+        self._events = []
+        self._first_at = None
+        self._thread = None
+        self.sent_digests = 0
+        self.sent_immediate = 0
+        self.buffered_total = 0
+
+    def set_sender(self, sender):
+        self.sender = sender
+
+    def notify(self, summary, text=None, parse_mode=None):
+        """Добавляет событие в сводку.
+
+        summary — одна строка для сводки; text/parse_mode — полное сообщение,
+        которое уходит, если событие в сводке оказалось одно.
+        """
+        interval, max_events = get_digest_settings()
+        if not interval:
+            self._send(text or summary, parse_mode if text else None)
+            self.sent_immediate += 1
+            return
+
+        with self._cond:
+            if not self._events:
+                self._first_at = time.monotonic()
+            self._events.append((summary, text, parse_mode))
+            self.buffered_total += 1
+            self._ensure_thread()
+            self._cond.notify_all()
+
+    def error(self, text, parse_mode=None):
+        """Ошибки уходят сразу, минуя сводку."""
+        self._send(text, parse_mode)
+        self.sent_immediate += 1
+
+    def flush(self):
+        """Отправляет накопленные события одной сводкой."""
+        with self._cond:
+            events = self._events
+            self._events = []
+            self._first_at = None
+        if not events:
+            return
+
+        if len(events) == 1:
+            summary, text, parse_mode = events[0]
+            self._send(text or summary, parse_mode if text else None)
+        else:
+            lines = [f"• {summary}" for summary, _, _ in events]
+            header = f"📋 Сводка событий: {len(events)}\n\n"
+            chunk = header
+            for line in lines:
+                if len(chunk) + len(line) + 1 > MESSAGE_LIMIT:
+                    self._send(chunk, None)
+                    chunk = ""
+                chunk += line + "\n"
+            self._send(chunk, None)
+        self.sent_digests += 1
+
+    def pending(self):
+        with self._cond:
+            return len(self._events)
+
+    def stats(self):
+        return {
+            'pending': self.pending(),
+            'digests': self.sent_digests,
+            'immediate': self.sent_immediate,
+            'buffered_total': self.buffered_total
+        }
+
+    def _send(self, text, parse_mode):
+        if self.sender is None:
+            logger.warning(f"Уведомление администратору не отправлено (нет отправителя): {text}")
+            return
+        try:
+            self.sender(text, parse_mode)
+        except Exception as e:
+            logger.error(f"Ошибка отправки уведомления администратору: {e}")
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='admin-notifier', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._events:
+                    self._cond.wait()
+                interval, max_events = get_digest_settings()
+                wait = self._first_at + interval - time.monotonic()
+                if len(self._events) < max_events and wait > 0:
+                    # Ждем до срока сводки или нового события
+                    self._cond.wait(timeout=min(wait, 1.0))
+                    continue
+            self.flush()
+
+
+admin_notifier = AdminNotifier()
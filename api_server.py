@@ -1,23 +1,45 @@
+import ipaddress
 import os
+import queue
+import threading
 
-from fastapi import Depends, FastAPI, Header, HTTPException, Query
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request
 from pydantic import BaseModel
+from telebot.types import Update
 import uvicorn
 
-from bot import bot
-from config import ADMIN_ID
+from bot import bot, settle_yookassa_payment
+from config import ADMIN_ID, BOT_MODE, WEBHOOK_PATH, WEBHOOK_SECRET, logger
 from db import (
     get_internal_stars,
     get_internal_stars_pool,
     update_internal_stars,
-    update_internal_stars_pool
+    update_internal_stars_pool,
+    withdraw_internal_stars
 )
 from keyboards import back_to_main_keyboard
+from telegram_sender import admin_lane
 
 
 API_KEY = os.getenv("INTERNAL_STARS_API_KEY")
 API_HOST = os.getenv("INTERNAL_STARS_API_HOST", "0.0.0.0")
 API_PORT = int(os.getenv("INTERNAL_STARS_API_PORT", "9000"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+# Уведомления ЮKassa принимаются только с ее адресов (список из документации ЮKassa).
+# За обратным прокси uvicorn берет адрес клиента из X-Forwarded-For (см. FORWARDED_ALLOW_IPS).
+YOOKASSA_CHECK_IP = os.getenv("YOOKASSA_WEBHOOK_CHECK_IP", "1") != "0"
+YOOKASSA_NETWORKS = [
+    ipaddress.ip_network(network) for network in (
+        "185.71.76.0/27",
+        "185.71.77.0/27",
+        "77.75.153.0/25",
+        "77.75.156.11/32",
+        "77.75.156.35/32",
+        "77.75.154.128/25",
+        "2a02:5180::/32",
+    )
+]
 
 app = FastAPI()
 
@@ -54,8 +76,8 @@ def get_internal_stars_user_balance(user_id: int, _: None = Depends(require_api_
 def credit_internal_stars_user(user_id: int, body: AmountRequest, _: None = Depends(require_api_key)):
     if body.amount <= 0:
         raise HTTPException(status_code=400, detail="amount_must_be_positive")
-    update_internal_stars(user_id, body.amount)
-    return {"user_id": user_id, "balance": get_internal_stars(user_id)}
+    balance = update_internal_stars(user_id, body.amount)
+    return {"user_id": user_id, "balance": balance or 0}
 
 @app.get("/internal-stars/user/{user_id}/credit")
 def credit_internal_stars_user_get(
@@ -63,19 +85,18 @@ def credit_internal_stars_user_get(
     amount: int = Query(..., gt=0),
     _: None = Depends(require_api_key)
 ):
-    update_internal_stars(user_id, amount)
-    return {"user_id": user_id, "balance": get_internal_stars(user_id)}
+    balance = update_internal_stars(user_id, amount)
+    return {"user_id": user_id, "balance": balance or 0}
 
 
 @app.post("/internal-stars/user/{user_id}/debit")
 def debit_internal_stars_user(user_id: int, body: AmountRequest, _: None = Depends(require_api_key)):
     if body.amount <= 0:
         raise HTTPException(status_code=400, detail="amount_must_be_positive")
-    current = get_internal_stars(user_id)
-    if current < body.amount:
+    balance = withdraw_internal_stars(user_id, body.amount)
+    if balance is None:
         raise HTTPException(status_code=400, detail="insufficient_balance")
-    update_internal_stars(user_id, -body.amount)
-    return {"user_id": user_id, "balance": get_internal_stars(user_id)}
+    return {"user_id": user_id, "balance": balance}
 
 
 @app.get("/internal-stars/user/{user_id}/debit")
@@ -84,29 +105,28 @@ def debit_internal_stars_user_get(
     amount: int = Query(..., gt=0),
     _: None = Depends(require_api_key)
 ):
-    current = get_internal_stars(user_id)
-    if current < amount:
+    balance = withdraw_internal_stars(user_id, amount)
+    if balance is None:
         raise HTTPException(status_code=400, detail="insufficient_balance")
-    update_internal_stars(user_id, -amount)
-    return {"user_id": user_id, "balance": get_internal_stars(user_id)}
+    return {"user_id": user_id, "balance": balance}
 
 
 @app.post("/internal-stars/credit")
 def credit_internal_stars(body: AmountRequest, _: None = Depends(require_api_key)):
     if body.amount <= 0:
         raise HTTPException(status_code=400, detail="amount_must_be_positive")
-    update_internal_stars_pool(body.amount)
-    return {"balance": get_internal_stars_pool()}
+    balance = update_internal_stars_pool(body.amount)
+    return {"balance": balance}
 
 
 @app.post("/internal-stars/debit")
 def debit_internal_stars(body: AmountRequest, _: None = Depends(require_api_key)):
     if body.amount <= 0:
         raise HTTPException(status_code=400, detail="amount_must_be_positive")
-    ok = update_internal_stars_pool(-body.amount)
-    if not ok:
+    balance = update_internal_stars_pool(-body.amount)
+    if balance is None:
         raise HTTPException(status_code=400, detail="insufficient_balance")
-    return {"balance": get_internal_stars_pool()}
+    return {"balance": balance}
 
 
 @app.post("/withdrawals/notify")
@@ -123,16 +143,96 @@ def notify_withdrawal(body: WithdrawalRequest, _: None = Depends(require_api_key
         f"Количество: {body.amount}"
     )
     try:
-        bot.send_message(
-            ADMIN_ID,
-            message,
-            parse_mode="Markdown",
-            reply_markup=back_to_main_keyboard()
-        )
+        with admin_lane():
+            bot.send_message(
+                ADMIN_ID,
+                message,
+                parse_mode="Markdown",
+                reply_markup=back_to_main_keyboard()
+            )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"send_failed:{e}")
     return {"status": "ok"}
 
 
+# --- Уведомления ЮKassa ---
+# Телу уведомления не доверяем: статус платежа перепроверяется запросом к API,
+# а закрытие платежа в БД идемпотентно, поэтому повторы безопасны.
+def is_yookassa_address(host):
+    try:
+        address = ipaddress.ip_address(host)
+    except (TypeError, ValueError):
+        return False
+    return any(address in network for network in YOOKASSA_NETWORKS)
+
+
+@app.post("/yookassa/webhook")
+def yookassa_webhook(body: dict, request: Request):
+    client_host = request.client.host if request.client else None
+    if YOOKASSA_CHECK_IP and not is_yookassa_address(client_host):
+        # Иначе любой анонимный POST вызывал бы запрос к API ЮKassa
+        logger.warning(f"Уведомление ЮKassa с недоверенного адреса {client_host} отклонено")
+        raise HTTPException(status_code=403, detail="forbidden")
+
+    payment_object = body.get("object") or {}
+    payment_id = payment_object.get("id")
+    if body.get("type") != "notification" or not payment_id:
+        raise HTTPException(status_code=400, detail="invalid_notification")
+
+    status, _ = settle_yookassa_payment(payment_id)
+    if status is None:
+        # Не удалось проверить платеж в API ЮKassa — ответ 5xx, ЮKassa повторит уведомление
+        raise HTTPException(status_code=500, detail="verification_failed")
+    # 'unknown' — платежа нет в нашей БД (не наш), 'amount_mismatch' — недоплата уже записана
+    # и отправлена администратору: повтор ничего не изменит, отвечаем 200
+    return {"status": status}
+
+
+# --- Webhook Telegram ---
+# Обновления складываются в ограниченную очередь и разбираются пулом потоков,
+# поэтому медленный обработчик не держит HTTP-ответ Telegram.
+_update_queue = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+_webhook_workers = []
+_webhook_workers_lock = threading.Lock()
+
+
+def _process_updates_worker():
+    while True:
+        update = _update_queue.get()
+        try:
+            bot.process_new_updates([update])
+        except Exception as e:
+            logger.error(f"Ошибка обработки обновления {update.update_id}: {e}")
+        finally:
+            _update_queue.task_done()
+
+
+def start_webhook_workers():
+    with _webhook_workers_lock:
+        if _webhook_workers:
+            return
+        for index in range(WEBHOOK_WORKERS):
+            thread = threading.Thread(target=_process_updates_worker, name=f"webhook-worker-{index}", daemon=True)
+            thread.start()
+            _webhook_workers.append(thread)
+
+
+@app.post(WEBHOOK_PATH)
+async def telegram_webhook(request: Request, x_telegram_bot_api_secret_token: str = Header(None)):
+    if BOT_MODE != "webhook":
+        raise HTTPException(status_code=404, detail="webhook_disabled")
+    if WEBHOOK_SECRET and x_telegram_bot_api_secret_token != WEBHOOK_SECRET:
+        raise HTTPException(status_code=401, detail="unauthorized")
+
+    update = Update.de_json(await request.json())
+    start_webhook_workers()
+    try:
+        _update_queue.put_nowait(update)
+    except queue.Full:
+        # Telegram повторит доставку позже
+        raise HTTPException(status_code=503, detail="queue_full")
+    return {"ok": True}
+
+
 def run_api_server():
     uvicorn.run(app, host=API_HOST, port=API_PORT, log_level="info")
@@ -0,0 +1,154 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+from config import logger
+
+
+# --- Общий фоновый runtime ---
+# Один поток с одним event loop обслуживает все периодические задачи
+# (мониторинг TON, курс, сверка платежей). HTTP-запросы идут через общую
+# aiohttp-сессию, а блокирующие вызовы (sqlite, синхронные клиенты, telebot)
+# — через ограниченный пул потоков, чтобы не останавливать loop.
+DB_EXECUTOR_WORKERS = 4
+HTTP_POOL_LIMIT = 20
+
+
+class PeriodicJob:
+    """Периодическая задача и ее метрики."""
+
+    def __init__(self, name, func, interval, initial_delay):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.initial_delay = initial_delay
+        self.runs = 0
+        self.errors = 0
+        self.last_error = None
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.next_run_at = None
+        self.running = False
+
+    def stats(self, now):
+        return {
+            'interval': self.interval,
+            'runs': self.runs,
+            'errors': self.errors,
+            'last_error': self.last_error,
+            'running': self.running,
+            'last_duration': self.last_duration,
+            'avg_duration': self.total_duration / self.runs if self.runs else 0.0,
+            'max_duration': self.max_duration,
+            'last_lag': self.last_lag,
+            'max_lag': self.max_lag,
+            'next_in': max(0.0, self.next_run_at - now) if self.next_run_at is not None else None
+        }
+
+
+class BackgroundRuntime:
+    """Event loop в отдельном потоке с планировщиком периодических задач."""
+
+    def __init__(self, executor_workers=DB_EXECUTOR_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=executor_workers, thread_name_prefix='background-io')
+        self.loop = None
+        self.http = None
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._started = threading.Event()
+        self._thread = None
+
+    def add_periodic(self, name, func, interval, initial_delay=0.0):
+        """Регистрирует задачу: func — async-функция без аргументов.
+
+        Если func возвращает число, оно становится задержкой до следующего
+        запуска (адаптивный интервал), иначе используется interval.
+        Задачи можно добавлять и после start().
+        """
+        job = PeriodicJob(name, func, interval, initial_delay)
+        with self._lock:
+            if name in self._jobs:
+                raise ValueError(f"Задача {name} уже зарегистрирована")
+            self._jobs[name] = job
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._spawn, job)
+        return job
+
+    def start(self):
+        """Запускает поток с event loop и все зарегистрированные задачи."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='background-runtime', daemon=True)
+        self._thread.start()
+        self._started.wait()
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        # asyncio.to_thread внутри задач тоже идет через ограниченный пул
+        self.loop.set_default_executor(self.executor)
+        self.loop.run_until_complete(self._open_http())
+        with self._lock:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            self._spawn(job)
+        logger.info(f"Фоновый runtime запущен: {', '.join(job.name for job in jobs) or 'задач нет'}")
+        self._started.set()
+        self.loop.run_forever()
+
+    async def _open_http(self):
+        self.http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=HTTP_POOL_LIMIT))
+
+    def _spawn(self, job):
+        self.loop.create_task(self._run_job(job), name=f'job-{job.name}')
+
+    async def _run_job(self, job):
+        delay = job.initial_delay
+        while True:
+            job.next_run_at = time.monotonic() + delay
+            await asyncio.sleep(delay)
+
+            started = time.monotonic()
+            job.last_lag = started - job.next_run_at
+            job.max_lag = max(job.max_lag, job.last_lag)
+            job.running = True
+            next_delay = None
+            try:
+                next_delay = await job.func()
+            except Exception as e:
+                job.errors += 1
+                job.last_error = str(e)
+                logger.error(f"Ошибка фоновой задачи {job.name}: {e}")
+            finally:
+                job.running = False
+                duration = time.monotonic() - started
+                job.runs += 1
+                job.last_duration = duration
+                job.total_duration += duration
+                job.max_duration = max(job.max_duration, duration)
+
+            delay = next_delay if isinstance(next_delay, (int, float)) else job.interval
+
+    async def run_blocking(self, func, *args):
+        """Выполняет блокирующую функцию (БД, синхронный клиент) в ограниченном пуле."""
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    def submit(self, coro):
+        """Запускает корутину в loop runtime из другого потока. Возвращает concurrent Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stats(self):
+        """Метрики задач: запуски, ошибки, длительность, отставание от расписания."""
+        now = time.monotonic()
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return {job.name: job.stats(now) for job in jobs}
+
+
+background = BackgroundRuntime()
@@ -8,31 +8,51 @@ import threading
 import time
 import asyncio
 import requests
+import http_client
+import telegram_sender
 from datetime import datetime
 from dotenv import load_dotenv
 import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, Message
 from telebot.types import LabeledPrice
-from excel_export import export_database_to_excel, cleanup_old_exports
+from excel_export import save_export_watermarks, cleanup_old_exports
+from export_jobs import ExportJobs
+from utils import ProgressScheduler
+from telegram_sender import admin_lane
+from admin_notifier import admin_notifier, get_digest_settings, set_digest_settings
+from delivery_queue import DeliveryQueue
+from payment_reconciler import PaymentReconciler, RECONCILE_INTERVAL
+from ton_ingest import TonDepositIngestor, MIN_POLL_INTERVAL as TON_MIN_POLL_INTERVAL
+from background_runtime import background
+from rate_service import TonRateService, RATE_TTL as TON_RATE_TTL
+from pricing import quotes, get_price_tiers, set_price_tiers, parse_tiers, format_tiers
 import os
 
 
 try:
     from config import MAIN_MENU_IMAGE, BUY_STARS_IMAGE, INTERNAL_STARS_IMAGE, PROFILE_IMAGE, \
     DEPOSIT_IMAGE, REFERRALS_IMAGE, CALCULATOR_IMAGE, WELCOME_MES, logger, REFERRAL_REWARD, \
-    ADMIN_ID, DB_NAME
+    ADMIN_ID, DB_NAME, BOT_MODE, WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_PATH
     from db import (
-        init_db, get_user, create_user, update_balance, add_transaction,
-        get_pending_payment, update_payment_status,
+        init_db, transaction, get_user, create_user, update_balance, add_transaction,
+        get_payment, get_latest_payment, settle_payment,
         set_session_data, get_session_data, delete_session_data,
-        get_setting, set_setting, get_referral_count, get_ton_rate_updated_at,
-        set_ton_rate, set_ton_rate_updated_at, get_ton_rate,
+        get_setting, set_setting, get_referral_count,
         update_internal_stars, get_internal_stars_pool, update_internal_stars_pool,
         set_internal_stars_pool, get_star_price, set_star_price,
-        get_usd_rub_rate, set_usd_rub_rate
+        get_usd_rub_rate, set_usd_rub_rate, get_settings_cache_stats,
+        reserve_balance, commit_balance_hold, release_balance_hold, enqueue_delivery_job,
+        get_stats_counters, rebuild_stats_counters, get_open_connections_count,
+        get_open_balance_holds, get_open_balance_hold, close_interrupted_delivery_job
 )
-    from fragment_api import load_fragment_token, authenticate_fragment, send_stars
-    from yookassa import create_yookassa_payment, check_payment_status
+    from fragment_api import (
+        load_fragment_token, authenticate_fragment, send_stars,
+        register_bot, refresh_bot_identity, get_bot_username
+    )
+    from yookassa import (
+        create_yookassa_payment, check_payment_status, get_paid_amount, is_underpaid,
+        AMOUNT_MISMATCH, PAYMENT_NOT_FOUND
+    )
     from keyboards import (
         main_menu_keyboard, buy_stars_options_keyboard, buy_stars_quantity_keyboard,
         back_to_main_keyboard, calculator_menu_keyboard, buy_internal_stars_quantity_keyboard
@@ -56,12 +76,23 @@ TON_DEPOSIT_ADDRESS = os.getenv('TON_DEPOSIT_ADDRESS')  # Адрес кошел
 TON_API_KEY = os.getenv('TON_API_KEY')  # Ключ от toncenter.com
 TON_API_BASE_URL = os.getenv('TON_API_BASE_URL', 'https://toncenter.com')
 
-TON_RATE_API = "https://api.coingecko.com/api/v3/simple/price?ids=the-open-network&vs_currencies=rub"
-
 # Инициализация бота
 bot = telebot.TeleBot(BOT_TOKEN)
+register_bot(bot)
+# Все запросы к Bot API идут через общий ограничитель (лимиты Telegram, 429)
+telegram_sender.install()
+
+
+def send_admin_message(text, parse_mode=None):
+    """Отправляет сообщение администратору в полосе уведомлений."""
+    if not ADMIN_ID:
+        logger.warning("ADMIN_ID не установлен. Уведомления администратора не будут отправляться.")
+        return
+    with admin_lane():
+        bot.send_message(ADMIN_ID, text, parse_mode=parse_mode, reply_markup=back_to_main_keyboard())
+
 
-animation_running = False
+admin_notifier.set_sender(send_admin_message)
 
 # Добавьте эту функцию после импортов и перед обработчиками
 def safe_edit_message_caption(bot, chat_id, message_id, new_caption, new_reply_markup=None, parse_mode=None):
@@ -151,6 +182,58 @@ def edit_message_with_fallback(chat_id, message_id, text, reply_markup=None, par
             logger.error(f"Ошибка редактирования сообщения: {fallback_error}")
 
 
+MEDIA_CACHE_PREFIX = 'media_file_id:'
+
+
+def get_media_cache_key(path):
+    """Ключ кэша file_id — только путь: при замене картинки запись перезаписывается."""
+    return f"{MEDIA_CACHE_PREFIX}{os.path.abspath(path)}"
+
+
+def get_media_fingerprint(path):
+    """mtime и размер файла: меняются при замене картинки."""
+    stat = os.stat(path)
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def send_cached_local_photo(chat_id, path, caption, reply_markup=None, parse_mode=None):
+    """Отправляет локальную картинку, загружая ее в Telegram только один раз.
+
+    После первой загрузки file_id сохраняется в settings (значение
+    '<mtime>:<размер>:<file_id>') и дальше отправляется вместо самого файла,
+    пока файл не изменится.
+    """
+    cache_key = get_media_cache_key(path)
+    fingerprint = get_media_fingerprint(path)
+    cached = (get_setting(cache_key) or '').split(':', 2)
+    file_id = cached[2] if len(cached) == 3 and f"{cached[0]}:{cached[1]}" == fingerprint else None
+    if file_id:
+        try:
+            return bot.send_photo(
+                chat_id=chat_id,
+                photo=file_id,
+                caption=caption,
+                reply_markup=reply_markup,
+                parse_mode=parse_mode
+            )
+        except telebot.apihelper.ApiTelegramException as e:
+            if "file" not in str(e).lower():
+                raise
+            logger.warning(f"Кэшированный file_id для {path} недействителен, загружаем заново: {e}")
+
+    with open(path, 'rb') as photo_file:
+        sent = bot.send_photo(
+            chat_id=chat_id,
+            photo=photo_file,
+            caption=caption,
+            reply_markup=reply_markup,
+            parse_mode=parse_mode
+        )
+    if getattr(sent, 'photo', None):
+        set_setting(cache_key, f"{fingerprint}:{sent.photo[-1].file_id}")
+    return sent
+
+
 def send_photo_with_caption(chat_id, photo, caption, reply_markup=None, parse_mode=None):
     if isinstance(photo, str):
         if photo.startswith('http://') or photo.startswith('https://'):
@@ -162,14 +245,7 @@ def send_photo_with_caption(chat_id, photo, caption, reply_markup=None, parse_mo
                 parse_mode=parse_mode
             )
         if os.path.isfile(photo):
-            with open(photo, 'rb') as photo_file:
-                return bot.send_photo(
-                    chat_id=chat_id,
-                    photo=photo_file,
-                    caption=caption,
-                    reply_markup=reply_markup,
-                    parse_mode=parse_mode
-                )
+            return send_cached_local_photo(chat_id, photo, caption, reply_markup, parse_mode)
         logger.error(f"Не найден файл изображения: {photo}")
         return bot.send_message(
             chat_id=chat_id,
@@ -187,10 +263,9 @@ def send_photo_with_caption(chat_id, photo, caption, reply_markup=None, parse_mo
 
 
 def build_welcome_message():
-    star_price = get_star_price()
-    price_100 = star_price * 100
-    usd_rate = get_usd_rub_rate()
-    usd_price = price_100 / usd_rate if usd_rate and usd_rate > 0 else None
+    quote = quotes.current()
+    price_100 = quote.star_cost(100)
+    usd_price = quote.to_usd(price_100)
     usd_text = f"${usd_price:.2f}" if usd_price is not None else "N/A"
     return (
         "✨ Добро пожаловать!\n\n"
@@ -200,20 +275,14 @@ def build_welcome_message():
         "Выберете действие:"
     )
 # --- Анимация загрузки ---
-def animate_caption(bot, call):
-    global animation_running
-    dots = 1
-    while animation_running:
-        caption = "🔄 Отправляю звезды" + "." * dots
-        edit_message_with_fallback(
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            text=caption,
-            reply_markup=back_to_main_keyboard()
-        )
-
-        dots = (dots % 3) + 1
-        time.sleep(1)
+progress_scheduler = ProgressScheduler(
+    lambda chat_id, message_id, text, reply_markup: edit_message_with_fallback(
+        chat_id=chat_id,
+        message_id=message_id,
+        text=text,
+        reply_markup=reply_markup
+    )
+)
 
 
 # --- Обработчики команд ---
@@ -284,9 +353,86 @@ def start_or_menu(message: Message):
         reply_markup=main_menu_keyboard(user.id)
     )
 
+def parse_export_args(text):
+    """Разбирает аргументы /export: [delta] [xlsx|csv|columnar]. Возвращает (incremental, format)."""
+    args = (text or '').split()[1:]
+    incremental = 'delta' in args
+    export_format = 'xlsx'
+    if 'csv' in args:
+        export_format = 'csv'
+    elif 'columnar' in args:
+        export_format = 'csv.gz'
+    return incremental, export_format
+
+
+def export_cancel_keyboard(job_id):
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(InlineKeyboardButton("⛔ Отменить экспорт", callback_data=f'export_cancel_{job_id}'))
+    return keyboard
+
+
+def show_export_progress(job):
+    """Обновляет сообщение о ходе экспорта."""
+    bot.edit_message_text(
+        chat_id=job['chat_id'],
+        message_id=job['message_id'],
+        text=f"🔄 Экспорт базы данных: {job['progress']}",
+        reply_markup=export_cancel_keyboard(job['id'])
+    )
+
+
+def finish_export(job, status, filename, watermarks, error):
+    """Отправляет готовый файл или сообщает об итоге задачи экспорта."""
+    chat_id = job['chat_id']
+    if status != 'exported':
+        text = "⛔ Экспорт отменен." if status == 'canceled' else f"❌ Не удалось создать файл экспорта. {error or ''}"
+        bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=job['message_id'],
+            text=text,
+            reply_markup=back_to_main_keyboard()
+        )
+        return
+
+    try:
+        # Отправляем файл
+        with open(filename, 'rb') as file:
+            bot.send_document(
+                chat_id=chat_id,
+                document=file,
+                caption=f"📊 {'Инкрементальный экспорт' if watermarks else 'Экспорт'} базы данных завершен\nФайл: {filename}",
+                reply_to_message_id=job['reply_to_message_id'],
+                reply_markup=back_to_main_keyboard()
+            )
+
+        # Отметки сдвигаются только после доставки файла
+        if watermarks:
+            save_export_watermarks(watermarks)
+    finally:
+        # УДАЛЯЕМ файл после отправки (или ошибки отправки)
+        try:
+            os.remove(filename)
+            logger.info(f"✅ Файл экспорта удален: {filename}")
+        except Exception as delete_error:
+            logger.error(f"❌ Ошибка удаления файла {filename}: {delete_error}")
+
+    # Удаляем сообщение о процессе
+    bot.delete_message(chat_id=chat_id, message_id=job['message_id'])
+
+
+export_jobs = ExportJobs(on_progress=show_export_progress, on_finished=finish_export)
+
+
 @bot.message_handler(commands=['export'])
 def handle_export_command(message: Message):
-    """Обработчик команды /export для экспорта БД в Excel."""
+    """Обработчик команды /export для экспорта БД.
+
+    /export — полная выгрузка в Excel, /export delta — только новые
+    пользователи, транзакции и платежи с прошлой инкрементальной выгрузки.
+    Формат: csv (zip с CSV) или columnar (zip с gzip-CSV, по файлу на таблицу).
+    Экспорт выполняется в отдельном процессе; повторная команда, пока такой же
+    экспорт не закончился, новую задачу не создает.
+    """
     user_id = message.from_user.id
 
     # Проверяем, что команду вызвал админ
@@ -294,54 +440,44 @@ def handle_export_command(message: Message):
         bot.reply_to(message, "❌ У вас нет прав для выполнения этой команды.", reply_markup=back_to_main_keyboard())
         return
 
-    try:
+    def send_progress_message(job_id):
         # Отправляем сообщение о начале процесса
-        processing_msg = bot.reply_to(message, "🔄 Начинаю экспорт базы данных в Excel...", reply_markup=back_to_main_keyboard())
-
-        # Выполняем экспорт
-        filename = export_database_to_excel()
-
-        if filename and os.path.exists(filename):
-            # Отправляем файл
-            with open(filename, 'rb') as file:
-                bot.send_document(
-                    chat_id=message.chat.id,
-                    document=file,
-                    caption=f"📊 Экспорт базы данных завершен\nФайл: {filename}",
-                    reply_to_message_id=message.message_id,
-                    reply_markup=back_to_main_keyboard()
-                )
-
-            # УДАЛЯЕМ файл после успешной отправки
-            try:
-                os.remove(filename)
-                logger.info(f"✅ Файл экспорта удален: {filename}")
-            except Exception as delete_error:
-                logger.error(f"❌ Ошибка удаления файла {filename}: {delete_error}")
-
-            # Удаляем сообщение о процессе
-            bot.delete_message(chat_id=message.chat.id, message_id=processing_msg.message_id)
+        processing_msg = bot.reply_to(
+            message, "🔄 Начинаю экспорт базы данных в Excel...", reply_markup=export_cancel_keyboard(job_id)
+        )
+        return processing_msg.message_id
 
-        else:
-            bot.edit_message_text(
-                chat_id=message.chat.id,
-                message_id=processing_msg.message_id,
-                text="❌ Не удалось создать файл экспорта.",
+    try:
+        incremental, export_format = parse_export_args(message.text)
+        job_id, created = export_jobs.submit(
+            message.chat.id, message.message_id, incremental, export_format, send_progress_message
+        )
+        if not created:
+            bot.reply_to(
+                message,
+                f"⏳ Такой экспорт уже выполняется (задача #{job_id}). Файл придет, когда он завершится.",
                 reply_markup=back_to_main_keyboard()
             )
 
     except Exception as e:
         logger.error(f"Ошибка при выполнении команды /export: {e}")
+        bot.reply_to(message, f"❌ Произошла ошибка при экспорте: {e}", reply_markup=back_to_main_keyboard())
 
-        # Пытаемся удалить файл даже в случае ошибки отправки
-        try:
-            if 'filename' in locals() and filename and os.path.exists(filename):
-                os.remove(filename)
-                logger.info(f"✅ Файл экспорта удален после ошибки: {filename}")
-        except Exception as delete_error:
-            logger.error(f"❌ Ошибка удаления файла после ошибки отправки: {delete_error}")
 
-        bot.reply_to(message, f"❌ Произошла ошибка при экспорте: {e}", reply_markup=back_to_main_keyboard())
+@bot.callback_query_handler(func=lambda call: call.data.startswith('export_cancel_'))
+def handle_export_cancel(call: CallbackQuery):
+    if str(call.from_user.id) != ADMIN_ID:
+        bot.answer_callback_query(call.id, "❌ Доступно только администратору.", show_alert=True)
+        return
+
+    job_id = int(call.data.split('_')[-1])
+    status = export_jobs.cancel(job_id)
+    if status == 'canceled':
+        bot.answer_callback_query(call.id, "⛔ Экспорт отменен.")
+    elif status == 'running':
+        bot.answer_callback_query(call.id, "⏳ Останавливаю экспорт...")
+    else:
+        bot.answer_callback_query(call.id, "Экспорт уже завершен.")
 
 
 @bot.message_handler(commands=['stats'])
@@ -355,39 +491,43 @@ def handle_stats_command(message: Message):
         return
 
     try:
-        from db import get_setting
-        import sqlite3
-
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-
-        # Быстрая статистика
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
-
-        cursor.execute("SELECT COUNT(*) FROM users WHERE referrer_id IS NOT NULL")
-        users_with_referrer = cursor.fetchone()[0]
-
-        cursor.execute("SELECT SUM(balance) FROM users")
-        total_balance = cursor.fetchone()[0] or 0
-
-        cursor.execute("SELECT SUM(internal_stars) FROM users")
-        total_internal_stars = cursor.fetchone()[0] or 0
-
-        cursor.execute("SELECT COUNT(*) FROM transactions WHERE type = 'stars_purchase' AND status = 'completed'")
-        stars_transactions = cursor.fetchone()[0]
-
-        cursor.execute("SELECT COUNT(*) FROM payments WHERE status = 'succeeded'")
-        successful_payments = cursor.fetchone()[0]
-
-        cursor.execute("SELECT SUM(amount) FROM payments WHERE status = 'succeeded'")
-        total_payments = cursor.fetchone()[0] or 0
-
-        ton_rate = get_setting('ton_rub_rate', 'N/A')
-        last_rate_update = get_setting('ton_rate_updated_at', 'N/A')
-        internal_pool = get_setting('internal_stars_pool', '0')
-
-        conn.close()
+        # Счетчики поддерживаются триггерами в БД — без сканирования таблиц
+        counters = get_stats_counters()
+        total_users = int(counters.get('total_users', 0))
+        users_with_referrer = int(counters.get('referred_users', 0))
+        total_balance = counters.get('balance_sum', 0)
+        total_internal_stars = int(counters.get('internal_stars_sum', 0))
+        stars_transactions = int(counters.get('completed_purchases', 0))
+        successful_payments = int(counters.get('succeeded_payments', 0))
+        total_payments = counters.get('succeeded_payments_sum', 0)
+
+        rate_stats = ton_rate_service.stats()
+        quote_stats = quotes.stats()
+        rate_sources = ", ".join(
+            f"{name} {provider['last_rate']:.2f}" if provider['last_rate'] else f"{name} —"
+            for name, provider in rate_stats['providers'].items()
+        )
+        internal_pool = get_internal_stars_pool()
+        cache_stats = get_settings_cache_stats()
+        queue_stats = delivery_queue.stats()
+        reconciler_stats = payment_reconciler.stats()
+        ton_stats = ton_ingestor.stats()
+        background_lines = "".join(
+            f"• `{name}`: запусков {job['runs']}, ошибок {job['errors']}, "
+            f"ср. {job['avg_duration']:.2f} с, отставание макс. {job['max_lag']:.2f} с\n"
+            for name, job in background.stats().items()
+        ) or "• Задачи не запущены\n"
+        http_lines = "".join(
+            f"• {host}: {stats['requests']} запр., ср. {stats['avg_ms']:.0f} мс, ошибок {stats['errors']}\n"
+            for host, stats in http_client.get_metrics().items()
+        ) or "• Запросов не было\n"
+        sender_stats = telegram_sender.get_stats()
+        digest_stats = admin_notifier.stats()
+        sender_lines = "".join(
+            f"• {lane}: отправлено {stats['sent']}, ждут {stats['waiting']}, задержано {stats['delayed']}, "
+            f"ожидание ср. {stats['avg_wait']:.2f} с / макс. {stats['max_wait']:.1f} с\n"
+            for lane, stats in sender_stats['lanes'].items()
+        )
 
         stats_message = (
             "📊 *Статистика бота*\n\n"
@@ -401,10 +541,31 @@ def handle_stats_command(message: Message):
             f"• Внутренние звезды у пользователей: {total_internal_stars}\n\n"
             f"💳 *Платежи:*\n"
             f"• Успешных: {successful_payments}\n"
-            f"• Общая сумма: {total_payments:.2f} руб\n\n"
+            f"• Общая сумма: {total_payments:.2f} руб\n"
+            f"• Ожидают сверки: {reconciler_stats.get('backlog', 'N/A')}, "
+            f"сверено всего: {reconciler_stats['total_checked']}\n"
+            f"• TON: курсор lt {ton_stats['last_lt']}, опрос раз в {ton_stats['interval']:.0f} с, "
+            f"зачислено {ton_stats['total_credited']}\n\n"
             f"🪙 *Курс TON:*\n"
-            f"• Текущий: {ton_rate} RUB\n"
-            f"• Обновлен: {last_rate_update[:16] if last_rate_update != 'N/A' else 'N/A'}"
+            f"• Текущий: {rate_stats['rate'] or 'N/A'} RUB\n"
+            f"• Обновлен: {rate_stats['updated_at'].strftime('%Y-%m-%d %H:%M') if rate_stats['updated_at'] else 'N/A'}\n"
+            f"• Источники: {rate_sources}\n"
+            f"• Обновлений: {rate_stats['refreshes']}, неудач: {rate_stats['failures']}\n"
+            f"• Котировки: версия {quote_stats['version']}, пересчетов {quote_stats['rebuilds']}\n\n"
+            f"⚙️ *Кэш настроек:*\n"
+            f"• Попаданий: {cache_stats['hits']}, промахов: {cache_stats['misses']}\n"
+            f"• Открытых соединений с БД: {get_open_connections_count()}\n\n"
+            f"📦 *Очередь отправки:*\n"
+            f"• В очереди: {queue_stats['queued']}, в работе: {queue_stats['running']}, исход неизвестен: {queue_stats['interrupted']}\n"
+            f"• Задержка: ср. {queue_stats['avg_latency']:.1f} с, макс. {queue_stats['max_latency']:.1f} с\n\n"
+            f"⏱ *Фоновые задачи:*\n"
+            f"{background_lines}\n"
+            f"🌐 *Внешние API:*\n"
+            f"{http_lines}\n"
+            f"📨 *Отправка в Telegram:*\n"
+            f"{sender_lines}"
+            f"• Чатов на паузе: {sender_stats['throttled_chats']}, ответов 429: {sender_stats['rate_limited']}\n"
+            f"• Сводки админу: в буфере {digest_stats['pending']}, отправлено сводок {digest_stats['digests']}\n"
         )
 
         bot.reply_to(message, stats_message, parse_mode='Markdown', reply_markup=back_to_main_keyboard())
@@ -413,6 +574,161 @@ def handle_stats_command(message: Message):
         logger.error(f"Ошибка при выполнении команды /stats: {e}")
         bot.reply_to(message, f"❌ Ошибка получения статистики: {e}", reply_markup=back_to_main_keyboard())
 
+@bot.message_handler(commands=['stats_rebuild'])
+def handle_stats_rebuild_command(message: Message):
+    """Пересчитывает счетчики /stats с нуля и показывает расхождения."""
+    user_id = message.from_user.id
+
+    if str(user_id) != ADMIN_ID:
+        bot.reply_to(message, "❌ У вас нет прав для выполнения этой команды.", reply_markup=back_to_main_keyboard())
+        return
+
+    try:
+        before, after = rebuild_stats_counters()
+        lines = []
+        for name, value in after.items():
+            old_value = before.get(name, 0)
+            mark = "✅" if abs((old_value or 0) - (value or 0)) < 0.005 else "⚠️"
+            lines.append(f"{mark} {name}: {old_value} → {value}")
+        bot.reply_to(
+            message,
+            "🔄 Счетчики статистики пересчитаны:\n\n" + "\n".join(lines),
+            reply_markup=back_to_main_keyboard()
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при выполнении команды /stats_rebuild: {e}")
+        bot.reply_to(message, f"❌ Ошибка пересчета статистики: {e}", reply_markup=back_to_main_keyboard())
+
+
+@bot.message_handler(commands=['digest'])
+def handle_digest_command(message: Message):
+    """/digest [секунды] [событий] — настройка сводок уведомлений администратору."""
+    user_id = message.from_user.id
+
+    if str(user_id) != ADMIN_ID:
+        bot.reply_to(message, "❌ У вас нет прав для выполнения этой команды.", reply_markup=back_to_main_keyboard())
+        return
+
+    args = message.text.split()[1:]
+    try:
+        if args:
+            interval = float(args[0])
+            max_events = int(args[1]) if len(args) > 1 else get_digest_settings()[1]
+            if interval < 0 or max_events < 1:
+                raise ValueError
+            set_digest_settings(interval, max_events)
+    except ValueError:
+        bot.reply_to(message, "❌ Формат: /digest <секунды> [событий], 0 секунд — без сводок.",
+                     reply_markup=back_to_main_keyboard())
+        return
+
+    interval, max_events = get_digest_settings()
+    mode = "каждое событие сразу" if not interval else f"раз в {interval:g} с или по {max_events} событий"
+    bot.reply_to(
+        message,
+        f"📋 Сводки уведомлений: {mode}.\nВ буфере: {admin_notifier.pending()}",
+        reply_markup=back_to_main_keyboard()
+    )
+
+
+@bot.message_handler(commands=['tiers'])
+def handle_tiers_command(message: Message):
+    """/tiers [звезд:скидка% ...|off] — скидки за объем при покупке звезд."""
+    user_id = message.from_user.id
+
+    if str(user_id) != ADMIN_ID:
+        bot.reply_to(message, "❌ У вас нет прав для выполнения этой команды.", reply_markup=back_to_main_keyboard())
+        return
+
+    args = message.text.split()[1:]
+    try:
+        if args == ['off']:
+            set_price_tiers(())
+        elif args:
+            set_price_tiers(parse_tiers(','.join(args)))
+    except ValueError:
+        bot.reply_to(message, "❌ Формат: /tiers 500:3 1000:5 (от 500 звезд скидка 3%), /tiers off — без скидок.",
+                     reply_markup=back_to_main_keyboard())
+        return
+
+    tiers = get_price_tiers()
+    packages = "\n".join(f"• {label}" for _, _, label in quotes.current().packages)
+    bot.reply_to(
+        message,
+        f"🏷 Скидки за объем: {format_tiers(tiers) if tiers else 'нет'}\n\nПакеты:\n{packages}",
+        reply_markup=back_to_main_keyboard()
+    )
+
+
+OPEN_HOLD_MIN_AGE = 30  # минут: более свежие резервы еще могут закрыться сами
+
+
+@bot.message_handler(commands=['holds'])
+def handle_holds_command(message: Message):
+    """/holds [минут] — открытые резервы; /holds commit|release <id> — закрыть резерв после проверки."""
+    user_id = message.from_user.id
+
+    if str(user_id) != ADMIN_ID:
+        bot.reply_to(message, "❌ У вас нет прав для выполнения этой команды.", reply_markup=back_to_main_keyboard())
+        return
+
+    args = message.text.split()[1:]
+    try:
+        if args and args[0] in ('commit', 'release'):
+            reply = resolve_balance_hold(args[0], int(args[1]))
+        else:
+            min_age = int(args[0]) if args else OPEN_HOLD_MIN_AGE
+            if min_age < 0:
+                raise ValueError
+            reply = format_open_holds(get_open_balance_holds(min_age), min_age)
+    except (ValueError, IndexError):
+        reply = ("❌ Формат: /holds [минут] — открытые резервы старше N минут, "
+                 "/holds commit <id> — звезды отправлены, /holds release <id> — вернуть средства.")
+    bot.reply_to(message, reply, reply_markup=back_to_main_keyboard())
+
+
+def format_open_holds(holds, min_age):
+    if not holds:
+        return f"✅ Открытых резервов старше {min_age} мин нет."
+    lines = []
+    for hold in holds:
+        job = (f"задача {hold['job_id']} ({hold['job_status']}): {hold['stars']} ⭐ для @{hold['target_username']}"
+               if hold['job_id'] else "без задачи отправки")
+        lines.append(f"• резерв {hold['id']}: {hold['amount']:.2f} руб, user {hold['user_id']}, "
+                     f"с {hold['created_at']}, {job}")
+    return (f"⏳ Открытые резервы старше {min_age} мин:\n" + "\n".join(lines) +
+            "\n\n/holds commit <id> — звезды отправлены, /holds release <id> — вернуть средства.")
+
+
+def resolve_balance_hold(action, hold_id):
+    """Закрывает резерв по решению администратора и сообщает пользователю результат."""
+    hold = get_open_balance_hold(hold_id)
+    if not hold:
+        return f"❌ Резерв {hold_id} не найден или уже закрыт."
+
+    if action == 'commit':
+        if not hold['job_id']:
+            return f"❌ У резерва {hold_id} нет задачи отправки: подтверждать нечего, его можно только вернуть."
+        new_balance = commit_balance_hold(hold_id, hold['stars'], 'stars_purchase', target_user=hold['target_username'])
+        if new_balance is None:
+            return f"❌ Резерв {hold_id} уже закрыт."
+        close_interrupted_delivery_job(hold_id, 'done', 'подтверждено администратором')
+        user_text = f"✅ Отправка {hold['stars']} звезд пользователю @{hold['target_username']} подтверждена."
+        reply = f"✅ Резерв {hold_id} подтвержден: {hold['amount']:.2f} руб списано."
+    else:
+        if not release_balance_hold(hold_id):
+            return f"❌ Резерв {hold_id} уже закрыт."
+        close_interrupted_delivery_job(hold_id, 'failed', 'средства возвращены администратором')
+        user_text = f"↩️ Звезды не были отправлены, {hold['amount']:.2f} руб возвращены на баланс."
+        reply = f"↩️ Резерв {hold_id} возвращен: {hold['amount']:.2f} руб на балансе user {hold['user_id']}."
+
+    try:
+        bot.send_message(hold['chat_id'] or hold['user_id'], user_text, reply_markup=back_to_main_keyboard())
+    except Exception as e:
+        logger.warning(f"Не удалось уведомить пользователя {hold['user_id']} о резерве {hold_id}: {e}")
+    return reply
+
+
 # --- Обработчики колбэков (Меню и Профиль) ---
 @bot.callback_query_handler(func=lambda call: call.data == 'buy_stars')
 def buy_stars_selection_menu(call: CallbackQuery):
@@ -427,7 +743,6 @@ def buy_stars_selection_menu(call: CallbackQuery):
 @bot.callback_query_handler(func=lambda call: call.data == 'buy_internal_stars')
 def buy_internal_stars_menu(call: CallbackQuery):
     user_id = call.from_user.id
-    pool = get_internal_stars_pool()
     send_photo_with_caption(
         chat_id=call.message.chat.id,
         photo=INTERNAL_STARS_IMAGE,
@@ -486,7 +801,7 @@ def show_referrals_menu(call: CallbackQuery):
     user_id = call.from_user.id
 
     # Получаем никнейм бота для генерации ссылки
-    bot_username = bot.get_me().username
+    bot_username = get_bot_username()
     referral_link = f"https://t.me/{bot_username}?start=r{user_id}"
 
     # Получаем количество рефералов
@@ -538,9 +853,10 @@ def grant_internal_50(call: CallbackQuery):
         bot.answer_callback_query(call.id, "❌ Доступно только администратору.", show_alert=True)
         return
 
-    update_internal_stars(user_id, 50)
-    update_internal_stars_pool(50)
-    add_transaction(user_id, 50, 'internal_stars_grant', status='completed', target_user='test_grant')
+    with transaction():
+        update_internal_stars(user_id, 50)
+        update_internal_stars_pool(50)
+        add_transaction(user_id, 50, 'internal_stars_grant', status='completed', target_user='test_grant')
     bot.answer_callback_query(call.id, "✅ Начислено 50 внутренних ⭐", show_alert=True)
 
 
@@ -968,6 +1284,22 @@ def handle_calculator_choice(call: CallbackQuery):
     bot.register_next_step_handler(call.message, process_calculator_amount)
 
 
+# Тип расчета -> (из чего, во что, заголовок, строка результата)
+CALCULATOR_MODES = {
+    'calc_rub_to_stars': ('rub', 'stars', "🧮 Рубли → ⭐", "Получите: ~{:.2f} ⭐"),
+    'calc_stars_to_rub': ('stars', 'rub', "🧮 ⭐ → Рубли", "Нужно заплатить: {:.2f} руб"),
+    'calc_ton_to_rub': ('ton', 'rub', "🧮 TON → Рубли", "Получите: {:.2f} руб"),
+    'calc_rub_to_ton': ('rub', 'ton', "🧮 Рубли → TON", "Нужно отправить: {:.6f} TON"),
+    'calc_ton_to_stars': ('ton', 'stars', "🧮 TON → ⭐", "Получите: ~{:.2f} ⭐"),
+    'calc_stars_to_ton': ('stars', 'ton', "🧮 ⭐ → TON", "Нужно отправить: {:.6f} TON"),
+}
+CALCULATOR_AMOUNT_FORMATS = {
+    'rub': "Сумма: {:.2f} руб",
+    'stars': "Количество звезд: {:.2f} ⭐",
+    'ton': "Сумма: {:.6f} TON",
+}
+
+
 def process_calculator_amount(message: Message):
     user_id = message.from_user.id
     amount_input = message.text.strip().replace(',', '.')
@@ -999,10 +1331,14 @@ def process_calculator_amount(message: Message):
         bot.register_next_step_handler(message, process_calculator_amount)
         return
 
-    ton_rate = None
-    if calc_type in ('calc_ton_to_rub', 'calc_rub_to_ton', 'calc_ton_to_stars', 'calc_stars_to_ton'):
-        ton_rate = get_ton_rub_rate()
-        if not ton_rate:
+    mode = CALCULATOR_MODES.get(calc_type)
+    if mode is None:
+        caption = "❌ Неизвестный тип расчета."
+    else:
+        source, target, title, result_template = mode
+        quote = quotes.current()
+        converted = quote.convert(amount, source, target)
+        if converted is None:
             edit_message_with_fallback(
                 chat_id=message.chat.id,
                 message_id=target_message_id,
@@ -1012,59 +1348,17 @@ def process_calculator_amount(message: Message):
             delete_session_data(user_id)
             return
 
-    star_price = get_star_price()
-    if calc_type == 'calc_rub_to_stars':
-        stars = amount / star_price
-        caption = (
-            "🧮 Рубли → ⭐\n\n"
-            f"Сумма: {amount:.2f} руб\n"
-            f"Цена звезды: {star_price:.2f} руб\n\n"
-            f"Получите: ~{stars:.2f} ⭐"
-        )
-    elif calc_type == 'calc_stars_to_rub':
-        rub = amount * star_price
-        caption = (
-            "🧮 ⭐ → Рубли\n\n"
-            f"Количество звезд: {amount:.2f} ⭐\n"
-            f"Цена звезды: {star_price:.2f} руб\n\n"
-            f"Нужно заплатить: {rub:.2f} руб"
-        )
-    elif calc_type == 'calc_ton_to_rub':
-        rub = amount * ton_rate
-        caption = (
-            "🧮 TON → Рубли\n\n"
-            f"Сумма: {amount:.6f} TON\n"
-            f"Курс: 1 TON ≈ {ton_rate:.2f} руб\n\n"
-            f"Получите: {rub:.2f} руб"
-        )
-    elif calc_type == 'calc_rub_to_ton':
-        ton = amount / ton_rate
+        result, star_price = converted
+        rate_lines = {
+            'stars': f"Цена звезды: {star_price:.2f} руб",
+            'ton': f"Курс: 1 TON ≈ {quote.ton_rate:.2f} руб" if quote.ton_rate else None
+        }
         caption = (
-            "🧮 Рубли → TON\n\n"
-            f"Сумма: {amount:.2f} руб\n"
-            f"Курс: 1 TON ≈ {ton_rate:.2f} руб\n\n"
-            f"Нужно отправить: {ton:.6f} TON"
+            f"{title}\n\n"
+            f"{CALCULATOR_AMOUNT_FORMATS[source].format(amount)}\n"
+            + "".join(f"{rate_lines[unit]}\n" for unit in (source, target) if unit in rate_lines)
+            + f"\n{result_template.format(result)}"
         )
-    elif calc_type == 'calc_ton_to_stars':
-        stars = (amount * ton_rate) / star_price
-        caption = (
-            "🧮 TON → ⭐\n\n"
-            f"Сумма: {amount:.6f} TON\n"
-            f"Курс: 1 TON ≈ {ton_rate:.2f} руб\n"
-            f"Цена звезды: {star_price:.2f} руб\n\n"
-            f"Получите: ~{stars:.2f} ⭐"
-        )
-    elif calc_type == 'calc_stars_to_ton':
-        ton = (amount * star_price) / ton_rate
-        caption = (
-            "🧮 ⭐ → TON\n\n"
-            f"Количество звезд: {amount:.2f} ⭐\n"
-            f"Цена звезды: {star_price:.2f} руб\n"
-            f"Курс: 1 TON ≈ {ton_rate:.2f} руб\n\n"
-            f"Нужно отправить: {ton:.6f} TON"
-        )
-    else:
-        caption = "❌ Неизвестный тип расчета."
 
     edit_message_with_fallback(
         chat_id=message.chat.id,
@@ -1173,9 +1467,7 @@ def process_friend_username(message: Message):
 
 def execute_star_purchase(call, stars):
     user_id = call.from_user.id
-    user_data = get_user(user_id)
-    star_price = get_star_price()
-    cost = stars * star_price
+    cost = quotes.current().star_cost(stars)
 
     # Получаем целевой username из БД
     session_data = get_session_data(user_id)
@@ -1196,69 +1488,114 @@ def execute_star_purchase(call, stars):
         )
         return
 
-    if user_data['balance'] < cost:
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+
+    # Резервируем средства до отправки звезд: параллельные клики не смогут потратить их дважды
+    hold_id = reserve_balance(user_id, cost)
+    if hold_id is None:
         if getattr(call, 'id', None):
             bot.answer_callback_query(call.id, f"❌ Недостаточно средств. Нужно {cost:.2f} руб.", show_alert=True)
         else:
             edit_message_with_fallback(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
+                chat_id=chat_id,
+                message_id=message_id,
                 text=f"❌ Недостаточно средств. Нужно {cost:.2f} руб.",
                 reply_markup=back_to_main_keyboard()
             )
         return
 
-    # Запуск анимации
-    global animation_running
-    animation_running = True
-    animation_thread = threading.Thread(target=animate_caption, args=(bot, call))
-    animation_thread.start()
+    # Анимация запускается до постановки в очередь, чтобы ее кадр не перезаписал результат задачи
+    progress_scheduler.start(chat_id, message_id, "🔄 Отправляю звезды", back_to_main_keyboard())
+    try:
+        enqueue_delivery_job(user_id, chat_id, message_id, target_username, stars, hold_id)
+    except Exception:
+        progress_scheduler.stop(chat_id, message_id)
+        release_balance_hold(hold_id)
+        raise
+
+    # Очищаем состояние: получатель уже сохранен в задаче
+    delete_session_data(user_id)
+    delivery_queue.notify()
+
+
+def deliver_stars_job(job):
+    """Выполняет задачу из очереди отправки: вызывает Fragment и обновляет сообщение пользователя."""
+    chat_id = job['chat_id']
+    message_id = job['message_id']
+    target_username = job['target_username']
+    stars = job['stars']
 
+    settled = False
     try:
         token = load_fragment_token() or authenticate_fragment()
         if not token:
-            animation_running = False
+            progress_scheduler.stop(chat_id, message_id)
             edit_message_with_fallback(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
+                chat_id=chat_id,
+                message_id=message_id,
                 text="❌ Ошибка системы. Не удалось получить токен Fragment API. Попробуйте позже.",
                 reply_markup=back_to_main_keyboard()
             )
-            return
+            return False, 'fragment_token_unavailable'
 
         success, message = send_stars(token, target_username, stars)
 
-        animation_running = False
-        animation_thread.join()
+        progress_scheduler.stop(chat_id, message_id)
+
+        if success is None:
+            # Ответ Fragment потерян после отправки заказа: звезды могли уйти. Как и у
+            # задач, прерванных перезапуском, резерв остается открытым до ручной проверки.
+            settled = True
+            admin_notifier.error(
+                f"❓ Исход отправки {stars} ⭐ для @{target_username} неизвестен "
+                f"(задача {job['id']}, резерв {job['hold_id']}): {message}. "
+                f"Проверьте заказ и закройте резерв командой /holds."
+            )
+            edit_message_with_fallback(
+                chat_id=chat_id,
+                message_id=message_id,
+                text="⏳ Не удалось получить подтверждение отправки звезд. Средства зарезервированы: "
+                     "мы проверим заказ и вернем их, если звезды не были отправлены.",
+                reply_markup=back_to_main_keyboard()
+            )
+            return None, message
 
         if success:
-            update_balance(user_data['user_id'], -cost)
-            add_transaction(user_data['user_id'], stars, 'stars_purchase', target_user=target_username)
-            user_data_new = get_user(user_id)
+            # Звезды уже отправлены: резерв больше нельзя вернуть, даже если подтверждение упадет
+            settled = True
+            new_balance = commit_balance_hold(job['hold_id'], stars, 'stars_purchase', target_user=target_username)
 
             edit_message_with_fallback(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
+                chat_id=chat_id,
+                message_id=message_id,
                 text=f"✅ Успешно отправлено {stars} звезд пользователю **@{target_username}**!\n"
-                     f"💰 Ваш новый баланс: {user_data_new['balance']:.2f} руб",
+                     f"💰 Ваш новый баланс: {new_balance:.2f} руб",
                 reply_markup=back_to_main_keyboard(),
                 parse_mode='Markdown'
             )
+            return True, None
+
+        if "not enough funds" in message.lower() or "баланс" in message.lower():
+            error_message = "❌ У нас закончились звезды. Попробуйте позже."
         else:
-            if "not enough funds" in message.lower() or "баланс" in message.lower():
-                error_message = "❌ У нас закончились звезды. Попробуйте позже."
-            else:
-                error_message = f"❌ Ошибка при отправке: {message}"
+            error_message = f"❌ Ошибка при отправке: {message}"
 
-            edit_message_with_fallback(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                text=error_message,
-                reply_markup=back_to_main_keyboard()
-            )
+        edit_message_with_fallback(
+            chat_id=chat_id,
+            message_id=message_id,
+            text=error_message,
+            reply_markup=back_to_main_keyboard()
+        )
+        return False, message
     finally:
-        # Очищаем состояние после завершения
-        delete_session_data(user_id)
+        progress_scheduler.stop(chat_id, message_id)
+        # Возвращаем зарезервированные средства, если покупка не состоялась
+        if not settled:
+            release_balance_hold(job['hold_id'])
+
+
+delivery_queue = DeliveryQueue(deliver_stars_job)
 
 
 @bot.callback_query_handler(func=lambda call: call.data == 'buy_custom')
@@ -1364,13 +1701,13 @@ def handle_successful_payment(message: Message):
         logger.error("Сумма Stars не совпадает с запрошенным количеством.")
         return
 
-    update_internal_stars_pool(stars)
-    update_internal_stars(user_id, stars)
-    add_transaction(user_id, stars, 'internal_stars_purchase', status='completed',
-                    target_user=f"stars_payment:{payment.telegram_payment_charge_id}")
+    with transaction():
+        update_internal_stars_pool(stars)
+        update_internal_stars(user_id, stars)
+        add_transaction(user_id, stars, 'internal_stars_purchase', status='completed',
+                        target_user=f"stars_payment:{payment.telegram_payment_charge_id}")
 
     user_data_new = get_user(user_id)
-    pool_new = get_internal_stars_pool()
 
     bot.send_message(
         message.chat.id,
@@ -1484,10 +1821,9 @@ def handle_ton_deposit(call: CallbackQuery):
     rate_text = f"~{ton_rub_rate:.2f} руб" if ton_rub_rate else "курс недоступен"
 
     # Добавляем информацию о времени обновления курса
-    last_updated = get_ton_rate_updated_at()
+    last_updated = ton_rate_service.updated_at()
     if last_updated:
-        last_updated_dt = datetime.fromisoformat(last_updated)
-        update_info = f" (обновлен {last_updated_dt.strftime('%H:%M')})"
+        update_info = f" (обновлен {last_updated.strftime('%H:%M')})"
     else:
         update_info = ""
 
@@ -1527,13 +1863,8 @@ def handle_predefined_deposit(call: CallbackQuery):
 
 
 def send_admin_deposit_notification(user, amount_rub, deposit_type, status, ton_amount=None):
-    """Отправляет уведомление администратору о пополнении баланса."""
+    """Добавляет пополнение баланса в сводку уведомлений администратору."""
     try:
-        admin_id = ADMIN_ID
-        if not admin_id:
-            logger.warning("ADMIN_ID не установлен. Уведомления администратора не будут отправляться.")
-            return
-
         # Формируем текст уведомления в зависимости от типа пополнения
         if deposit_type == 'ton':
             type_text = "TON"
@@ -1555,14 +1886,10 @@ def send_admin_deposit_notification(user, amount_rub, deposit_type, status, ton_
             f"   Сумма: {amount_info}\n"
             f"   Статус: {status_text}"
         )
+        summary = f"💰 {type_text}: {amount_info} — @{user.username or user.id} ({status_text})"
 
-        bot.send_message(
-            admin_id,
-            message,
-            parse_mode='Markdown',
-            reply_markup=back_to_main_keyboard()
-        )
-        logger.info(f"Уведомление отправлено администратору {admin_id} о пополнении пользователя {user.id}")
+        admin_notifier.notify(summary, message, parse_mode='Markdown')
+        logger.info(f"Уведомление администратору о пополнении пользователя {user.id} поставлено в сводку")
 
     except Exception as e:
         logger.error(f"Ошибка отправки уведомления администратору: {e}")
@@ -1647,7 +1974,7 @@ def process_custom_deposit_amount(message: Message):
 
 
 def process_deposit(call, amount: float, deposit_type='yookassa'):
-    bot_username = bot.get_me().username
+    bot_username = get_bot_username()
     payment_url = create_yookassa_payment(amount, call.from_user.id, bot_username)
 
     if payment_url:
@@ -1679,36 +2006,133 @@ def process_deposit(call, amount: float, deposit_type='yookassa'):
 
 
 
+# Как часто кнопка "Я оплатил" может обращаться к API ЮKassa по одному платежу
+PAYMENT_RECHECK_INTERVAL = 30
+_payment_checked_at = {}
+_payment_checked_lock = threading.Lock()
+
+
+def build_notification_user(user_id):
+    """Собирает объект пользователя для уведомлений, когда настоящего объекта Telegram нет."""
+    user_data = get_user(user_id) or {}
+    return type('MockUser', (object,), {
+        'id': user_id,
+        'username': user_data.get('username'),
+        'first_name': f"User{user_id}"
+    })()
+
+
+def notify_payment_settled(settled, notify_user=True):
+    """Уведомляет администратора (и пользователя) о зачисленном платеже ЮKassa."""
+    user_id = settled['user_id']
+    send_admin_deposit_notification(build_notification_user(user_id), settled['amount'], 'yookassa', 'completed')
+    if not notify_user:
+        return
+    try:
+        bot.send_message(
+            user_id,
+            f"✅ Платеж успешно завершен!\n"
+            f"💳 Сумма: **{settled['amount']:.2f} руб**\n"
+            f"💰 Новый баланс: **{settled['balance']:.2f} руб**",
+            parse_mode='Markdown',
+            reply_markup=back_to_main_keyboard()
+        )
+    except Exception as e:
+        logger.error(f"Не удалось уведомить пользователя {user_id} о платеже: {e}")
+
+
+def notify_payment_amount_mismatch(payment_id, settled, paid=None):
+    """Сообщает администратору о платеже, оплаченном не на полную сумму (один раз)."""
+    paid_text = f"{paid:.2f} руб" if paid is not None else "меньше ожидаемого"
+    admin_notifier.error(
+        f"⚠️ Платеж ЮKassa {payment_id} пользователя {settled['user_id']} оплачен не полностью: "
+        f"{paid_text} вместо {settled['amount']:.2f} руб. Баланс не пополнен, платеж помечен {AMOUNT_MISMATCH}."
+    )
+
+
+def _on_reconciled_payment(payment):
+    if payment['status'] == 'succeeded':
+        notify_payment_settled(payment)
+    elif payment['status'] == AMOUNT_MISMATCH:
+        notify_payment_amount_mismatch(payment['yookassa_id'], payment)
+
+
+payment_reconciler = PaymentReconciler(on_settled=_on_reconciled_payment)
+
+
+def settle_yookassa_payment(payment_id, notify_user=True):
+    """Проверяет платеж в ЮKassa и идемпотентно закрывает его в БД.
+
+    Возвращает (status, settled), где settled — результат settle_payment
+    (None, если платеж уже был закрыт ранее), ('unknown', None) для платежа,
+    которого нет в БД, или (None, None) при ошибке проверки. Недоплаченный
+    платеж закрывается со статусом AMOUNT_MISMATCH без пополнения баланса.
+    """
+    payment = get_payment(payment_id)
+    if not payment:
+        logger.warning(f"Платеж {payment_id} не найден в БД.")
+        return 'unknown', None
+
+    payment_info = check_payment_status(payment_id)
+    if not payment_info:
+        return None, None
+
+    status = payment_info.get('status')
+    if status == 'pending' or status == 'waiting_for_capture' or status == PAYMENT_NOT_FOUND:
+        # Платеж без ответа ЮKassa (404) не закрываем здесь: его просрочит фоновая сверка
+        return status, None
+
+    if status == 'succeeded' and is_underpaid(payment_info, payment['amount']):
+        # Повторная проверка ничего не изменит: фиксируем расхождение один раз и отвечаем ЮKassa 200
+        logger.error(
+            f"Сумма платежа {payment_id} не совпадает: {get_paid_amount(payment_info)} < {payment['amount']}"
+        )
+        status = AMOUNT_MISMATCH
+
+    settled = settle_payment(payment_id, status)
+    if settled and status == 'succeeded':
+        notify_payment_settled(settled, notify_user)
+    elif settled and status == AMOUNT_MISMATCH:
+        notify_payment_amount_mismatch(payment_id, settled, get_paid_amount(payment_info))
+    return status, settled
+
+
+def _payment_recheck_allowed(payment_id):
+    now = time.monotonic()
+    with _payment_checked_lock:
+        if now - _payment_checked_at.get(payment_id, 0.0) < PAYMENT_RECHECK_INTERVAL:
+            return False
+        for key in [key for key, checked_at in _payment_checked_at.items()
+                    if now - checked_at >= PAYMENT_RECHECK_INTERVAL]:
+            del _payment_checked_at[key]
+        _payment_checked_at[payment_id] = now
+        return True
+
+
 @bot.callback_query_handler(func=lambda call: call.data == 'check_payment')
 def handle_check_payment(call: CallbackQuery):
     user_id = call.from_user.id
 
-    payment = get_pending_payment(user_id)
+    # Статус обычно уже обновлен webhook-уведомлением ЮKassa — смотрим в БД
+    payment = get_latest_payment(user_id)
 
     if not payment:
         bot.answer_callback_query(call.id, "❌ Активный платеж для проверки не найден", show_alert=True)
         return
 
-    payment_id, amount = payment
-    payment_info = check_payment_status(payment_id)
-
-    if not payment_info:
-        bot.answer_callback_query(call.id, "❌ Ошибка проверки платежа", show_alert=True)
-        return
+    payment_id, amount, status = payment
 
-    if payment_info['status'] == 'succeeded':
-        # Обновление статуса платежа
-        update_payment_status(payment_id, 'succeeded')
-
-        # Обновление баланса и добавление транзакции
-        update_balance(user_id, amount)
-        add_transaction(user_id, amount, 'deposit', 'completed')
+    if status == 'pending' and _payment_recheck_allowed(payment_id):
+        # Уведомление могло не дойти — изредка сверяемся с API напрямую
+        remote_status, _ = settle_yookassa_payment(payment_id, notify_user=False)
+        if remote_status is None:
+            bot.answer_callback_query(call.id, "❌ Ошибка проверки платежа", show_alert=True)
+            return
+        if remote_status not in ('pending', 'waiting_for_capture', PAYMENT_NOT_FOUND):
+            status = remote_status
 
+    if status == 'succeeded':
         user_data = get_user(user_id)
-
-        # Отправляем уведомление администратору об успешном пополнении
-        send_admin_deposit_notification(call.from_user, amount, 'yookassa', 'completed')
-
         edit_message_with_fallback(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
@@ -1719,18 +2143,23 @@ def handle_check_payment(call: CallbackQuery):
             parse_mode='Markdown'
         )
 
-    elif payment_info['status'] == 'pending':
+    elif status == 'pending':
         bot.answer_callback_query(
             call.id,
             "⌛ Платеж еще не прошел. Попробуйте проверить позже.",
             show_alert=True
         )
+    elif status == AMOUNT_MISMATCH:
+        bot.answer_callback_query(
+            call.id,
+            "⚠️ Сумма оплаты не совпала с суммой платежа. Баланс не пополнен, администратор уже уведомлен.",
+            show_alert=True
+        )
     else:
         # Платеж не прошел (например, canceled, expired, etc.)
-        update_payment_status(payment_id, payment_info['status'])
         bot.answer_callback_query(
             call.id,
-            f"❌ Платеж не прошел. Статус: {payment_info['status']}",
+            f"❌ Платеж не прошел. Статус: {status}",
             show_alert=True
         )
 
@@ -1738,225 +2167,62 @@ def handle_check_payment(call: CallbackQuery):
 # --- ФУНКЦИИ ФОНОВОГО МОНИТОРИНГА TON (ОБНОВЛЕННЫЕ) ---
 # bot.py - добавить эти функции
 
-def get_ton_rub_rate():
-    """Получает текущий курс TON к рублю с кэшированием в БД."""
-    try:
-        # Пытаемся получить курс из БД
-        cached_rate = get_ton_rate()
-        last_updated = get_ton_rate_updated_at()
-
-        # Если курс в БД есть и он обновлялся менее 10 минут назад - используем его
-        if cached_rate and last_updated:
-            last_updated_dt = datetime.fromisoformat(last_updated)
-            if (datetime.now() - last_updated_dt).total_seconds() < 600:  # 10 минут
-                return float(cached_rate)
-
-        # Иначе получаем свежий курс из API
-        fresh_rate = fetch_fresh_ton_rate()
-        if fresh_rate:
-            # Сохраняем в БД
-            set_ton_rate(fresh_rate)
-            set_ton_rate_updated_at(datetime.now().isoformat())
-            logger.info(f"✅ Курс TON обновлен: {fresh_rate:.2f} RUB")
-            return fresh_rate
-        elif cached_rate:
-            # Если не удалось получить свежий курс, используем кэшированный (даже если старый)
-            logger.warning("⚠️ Используется устаревший курс TON из кэша")
-            return float(cached_rate)
-        else:
-            return None
-
-    except Exception as e:
-        logger.error(f"Ошибка получения курса TON: {e}")
-        # Пытаемся вернуть кэшированное значение в случае ошибки
-        cached_rate = get_ton_rate()
-        return float(cached_rate) if cached_rate else None
+ton_rate_service = TonRateService(background)
 
 
-def fetch_fresh_ton_rate():
-    """Получает свежий курс TON от API."""
-    try:
-        response = requests.get(TON_RATE_API, timeout=5)
-        response.raise_for_status()
-        data = response.json()
-        rate = data.get('the-open-network', {}).get('rub')
-        if rate:
-            return float(rate)
-        return None
-    except Exception as e:
-        logger.error(f"Ошибка получения свежего курса TON/RUB: {e}")
-        return None
+def get_ton_rub_rate():
+    """Текущий курс TON к рублю из памяти (обновляется в фоне, обработчики не ждут API)."""
+    return ton_rate_service.get()
 
 
-async def update_ton_rate_periodically():
-    """Периодическое обновление курса TON каждые 10 минут."""
-    while True:
-        try:
-            fresh_rate = fetch_fresh_ton_rate()
-            if fresh_rate:
-                set_ton_rate(fresh_rate)
-                set_ton_rate_updated_at(datetime.now().isoformat())
-                logger.info(f"🔄 Курс TON обновлен в фоне: {fresh_rate:.2f} RUB")
-            else:
-                logger.warning("❌ Не удалось обновить курс TON в фоновом режиме")
-        except Exception as e:
-            logger.error(f"Ошибка фонового обновления курса TON: {e}")
+quotes.set_ton_rate_func(get_ton_rub_rate)
 
-        await asyncio.sleep(600)  # 10 минут
 
+def notify_ton_deposit(deposit):
+    """Уведомляет администратора и пользователя о зачисленном депозите TON."""
+    uid = deposit['user_id']
 
-async def check_deposits():
-    if not TON_DEPOSIT_ADDRESS or not TON_API_KEY:
-        logger.error("TON_DEPOSIT_ADDRESS или TON_API_KEY не заданы. Мониторинг не запущен.")
-        return
+    # Отправляем уведомление администратору о TON пополнении
+    try:
+        from_user_info = type('MockUser', (object,), {
+            'id': uid,
+            'username': deposit['username'],
+            'first_name': f"User{uid}"  # Заглушка, так как нет реального объекта пользователя
+        })()
+        send_admin_deposit_notification(from_user_info, deposit['rub_amount'], 'ton', 'completed', deposit['ton_amount'])
+    except Exception as e:
+        logger.error(f"Ошибка отправки уведомления администратору: {e}")
 
-    # --- Чтение last_lt из БД вместо файла ---
-    last_lt_str = get_setting('last_lt', '0')
     try:
-        last_lt = int(last_lt_str)
-    except ValueError:
-        logger.error(f"Некорректное значение last_lt в БД: '{last_lt_str}'. Используется 0.")
-        last_lt = 0
+        bot.send_message(
+            uid,
+            '✅ Депозит через TON подтвержден!\n'
+            f"Сумма: *+{deposit['ton_amount']:.4f} TON* ({deposit['rub_amount']:.2f} руб)\n"
+            f"Ваш новый баланс: {deposit['balance']:.2f} руб",
+            parse_mode='Markdown',
+            reply_markup=back_to_main_keyboard()
+        )
+    except Exception as e:
+        logger.error(f"Error sending message to user {uid}: {e}")
 
-    logger.info(f"Запуск мониторинга TON. Последний LT: {last_lt}")
 
-    while True:
-        await asyncio.sleep(10)
-        try:
-            ton_rub_rate = get_ton_rub_rate()
-            if not ton_rub_rate:
-                continue
-
-            def fetch_ton_transactions(archival):
-                """Запрашивает транзакции TON и логирует детали при ошибке."""
-                api_url = (
-                    f'{TON_API_BASE_URL}/api/v2/getTransactions?'
-                    f'address={TON_DEPOSIT_ADDRESS}&limit=100&'
-                    f'archival={str(archival).lower()}&api_key={TON_API_KEY}'
-                )
-                try:
-                    response = requests.get(api_url, timeout=10)
-                    if response.status_code != 200:
-                        logger.error(
-                            "TON API HTTP %s: %s",
-                            response.status_code,
-                            response.text[:500]
-                        )
-                        return None
-                    resp_json = response.json()
-                except Exception as e:
-                    logger.error(f"Ошибка запроса TON API: {e}")
-                    return None
-
-                if not resp_json.get('ok'):
-                    err = resp_json.get('error') or resp_json.get('message') or resp_json
-                    logger.error(f"Ошибка ответа TON API: {err}")
-                    return None
-
-                return resp_json
-
-            # Сначала пробуем archival=true, если не получилось — fallback на archival=false.
-            resp = fetch_ton_transactions(archival=True) or fetch_ton_transactions(archival=False)
-            if not resp:
-                continue
-
-            current_max_lt = last_lt
-
-            # Обрабатываем транзакции в обратном порядке (от новых к старым)
-            for tx in reversed(resp.get('result', [])):
-                lt = int(tx['transaction_id']['lt'])
-
-                if lt > current_max_lt:
-                    current_max_lt = lt
-
-                if lt <= last_lt:
-                    continue
-
-                in_msg = tx.get('in_msg')
-                if not in_msg:
-                    continue
-
-                value_nano = int(in_msg.get('value', 0))
-
-                if value_nano > 0:
-                    uid_str = ''
-                    # Пытаемся получить user_id из поля 'message' (обычно там комментарий)
-                    uid_str = in_msg.get('message', '').strip()
-
-                    if not uid_str.isdigit():
-                        logger.warning(f"Пропущена транзакция: {lt}. Некорректный uid в комментарии: '{uid_str}'")
-                        continue
-
-                    uid = int(uid_str)
-                    ton_amount = value_nano / 1e9
-
-                    # Конвертация TON в RUB
-                    rub_amount = round(ton_amount * ton_rub_rate, 2)
-
-                    if rub_amount < 1.0:  # Игнорируем слишком маленькие суммы
-                        continue
-
-                    user_data = get_user(uid)
-                    if not user_data:
-                        logger.warning(f"Пропущена транзакция: {lt}. Пользователь {uid} не найден.")
-                        continue
-
-                    # Пополнение баланса в РУБЛЯХ
-                    update_balance(uid, rub_amount)
-                    # target_user используем для хранения информации о TON транзакции
-                    add_transaction(uid, rub_amount, 'deposit_ton', 'completed', target_user=f'{ton_amount:.4f} TON')
-
-                    logger.info(f"✅ Депозит TON подтвержден! User: {uid}, TON: {ton_amount}, RUB: {rub_amount}")
-
-                    # Отправляем уведомление администратору о TON пополнении
-                    try:
-                        from_user_info = type('MockUser', (object,), {
-                            'id': uid,
-                            'username': user_data['username'],
-                            'first_name': f"User{uid}"  # Заглушка, так как нет реального объекта пользователя
-                        })()
-                        send_admin_deposit_notification(from_user_info, rub_amount, 'ton', 'completed', ton_amount)
-                    except Exception as e:
-                        logger.error(f"Ошибка отправки уведомления администратору: {e}")
-
-                    try:
-                        bot.send_message(
-                            uid,
-                            '✅ Депозит через TON подтвержден!\n'
-                            f'Сумма: *+{ton_amount:.4f} TON* ({rub_amount:.2f} руб)\n'
-                            f'Ваш новый баланс: {get_user(uid)["balance"]:.2f} руб',
-                            parse_mode='Markdown',
-                            reply_markup=back_to_main_keyboard()
-                        )
-                    except Exception as e:
-                        logger.error(f"Error sending message to user {uid}: {e}")
-
-            # --- Сохранение максимального LT в БД ---
-            if current_max_lt > last_lt:
-                last_lt = current_max_lt
-                set_setting('last_lt', last_lt)  # <--- Запись в БД
-
-        except requests.exceptions.Timeout:
-            logger.error("TON API запрос таймаут.")
-        except Exception as e:
-            logger.error(f"Критическая ошибка в TON мониторинге: {e}")
+ton_ingestor = TonDepositIngestor(get_ton_rub_rate, on_credited=notify_ton_deposit)
 
 
-def run_async_loop():
-    """Запуск asyncio loop в отдельном потоке."""
-    # Небольшая задержка перед запуском
-    time.sleep(1)
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(check_deposits())
+def register_background_jobs():
+    """Регистрирует периодические задачи общего фонового runtime."""
+    background.add_periodic('ton_rate', ton_rate_service.run_job, TON_RATE_TTL)
 
+    if TON_DEPOSIT_ADDRESS and TON_API_KEY:
+        background.add_periodic(
+            'ton_deposits', lambda: ton_ingestor.run_job(background), TON_MIN_POLL_INTERVAL, initial_delay=1
+        )
+    else:
+        logger.error("TON_DEPOSIT_ADDRESS или TON_API_KEY не заданы. Мониторинг не запущен.")
 
-def run_async_rate_updater():
-    """Запуск асинхронного обновления курса в отдельном потоке."""
-    time.sleep(2)  # Небольшая задержка после старта
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(update_ton_rate_periodically())
+    background.add_periodic(
+        'payment_reconciler', payment_reconciler.reconcile_once, RECONCILE_INTERVAL, initial_delay=3
+    )
 
 
 def main():
@@ -1965,25 +2231,47 @@ def main():
     except Exception as e:
         logger.error(f"Ошибка инициализации БД: {e}")
 
+    try:
+        export_jobs.start()
+    except Exception as e:
+        logger.error(f"Ошибка восстановления задач экспорта: {e}")
+
+    try:
+        interrupted_jobs = delivery_queue.start()
+        if interrupted_jobs and ADMIN_ID:
+            with admin_lane():
+                bot.send_message(
+                    ADMIN_ID,
+                    "⚠️ После перезапуска найдены прерванные отправки звезд. "
+                    "Проверьте заказы и закройте резервы командой /holds:\n"
+                    + "\n".join(
+                        f"• задача {job['id']}, резерв {job['hold_id']}: {job['stars']} ⭐ для @{job['target_username']}"
+                        for job in interrupted_jobs
+                    )
+                )
+    except Exception as e:
+        logger.error(f"Ошибка запуска очереди отправки звезд: {e}")
+
+    try:
+        refresh_bot_identity()
+    except Exception as e:
+        logger.error(f"Ошибка получения данных бота (getMe): {e}")
+
     try:
         cleanup_old_exports(max_files=1)
     except Exception as e:
         logger.error(f"Ошибка очистки старых файлов экспорта: {e}")
 
-    logger.info("Получение начального курса TON...")
-    initial_rate = get_ton_rub_rate()
-    if initial_rate:
-        logger.info(f"✅ Начальный курс TON установлен: {initial_rate:.2f} RUB")
-    else:
-        logger.error("❌ Не удалось получить начальный курс TON")
-
-    deposit_thread = threading.Thread(target=run_async_loop, daemon=True)
-    deposit_thread.start()
-    logger.info("Запущен фоновый мониторинг TON депозитов.")
+    try:
+        initial_rate = ton_rate_service.load()
+        if initial_rate:
+            logger.info(f"Курс TON из БД: {initial_rate:.2f} RUB, обновление в фоне")
+    except Exception as e:
+        logger.error(f"Ошибка загрузки курса TON из БД: {e}")
 
-    rate_thread = threading.Thread(target=run_async_rate_updater, daemon=True)
-    rate_thread.start()
-    logger.info("Запущен фоновый мониторинг курса TON.")
+    register_background_jobs()
+    background.start()
+    logger.info("Запущены фоновые задачи: мониторинг TON депозитов, курс TON, сверка платежей ЮKassa.")
 
     # Проверка и обновление токена Fragment API
     logger.info("Проверка и обновление токена Fragment API...")
@@ -2001,6 +2289,24 @@ def main():
     except Exception as e:
         logger.error(f"Ошибка работы с Fragment API: {e}")
 
+    if BOT_MODE == 'webhook':
+        # Обновления принимает FastAPI-приложение из api_server.py (один процесс uvicorn).
+        # api_server импортирует модуль bot: при запуске `python bot.py` это была бы вторая
+        # копия модуля со своим TeleBot, очередями и фоновыми задачами, которые никто не запускал
+        if __name__ != 'bot':
+            logger.error("В режиме webhook запускайте бота через run_all.py")
+            return
+        from api_server import run_api_server
+
+        try:
+            bot.remove_webhook()
+            bot.set_webhook(url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET)
+        except Exception as e:
+            logger.error(f"Ошибка установки webhook: {e}")
+        logger.info("Бот запущен в режиме webhook...")
+        run_api_server()
+        return
+
     logger.info("Бот запущен...")
     try:
         bot.infinity_polling()
@@ -44,11 +44,20 @@ MIN_STARS = 50
 
 REFERRAL_REWARD = 5.0 # Вознаграждение за приглашенного пользователя (в рублях)
 
+# Количество воркеров очереди отправки звезд
+DELIVERY_WORKERS = int(os.getenv('DELIVERY_WORKERS', '2'))
+
 # --- Конфигурация API ---
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_ID = os.getenv('ADMIN_ID')
 DB_NAME = 'bot_database.db'
 
+# Режим получения обновлений: 'polling' (по умолчанию) или 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling').strip().lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Публичный адрес API-сервера, например https://example.com
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_PATH = "/telegram/webhook"
+
 # ЮKassa
 YOOKASSA_SHOP_ID = os.getenv('YOOKASSA_SHOP_ID')
 YOOKASSA_SECRET_KEY = os.getenv('YOOKASSA_SECRET_KEY')
@@ -69,6 +78,9 @@ FRAGMENT_MNEMONICS = os.getenv("FRAGMENT_MNEMONICS")
 if not BOT_TOKEN:
     logger.error("❌ BOT_TOKEN не найден в переменных окружения.")
 
+if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+    logger.error("❌ BOT_MODE=webhook, но WEBHOOK_URL не задан.")
+
 # Проверка наличия учетных данных ЮKassa
 if not YOOKASSA_SHOP_ID or not YOOKASSA_SECRET_KEY:
     logger.warning("⚠️ Учетные данные ЮKassa не найдены.")
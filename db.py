@@ -1,15 +1,140 @@
+import json
 import sqlite3
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
 import config
 from config import DB_NAME, logger
 
 
-# Инициализация базы данных
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+# --- Пул соединений ---
+# Каждый поток (воркеры telebot, мониторинг TON, FastAPI) держит одно
+# постоянное соединение с БД. Соединения открываются в WAL-режиме, поэтому
+# читатели не блокируют писателя, а кэш подготовленных выражений sqlite3
+# переиспользуется между вызовами.
+DB_BUSY_TIMEOUT_MS = 5000
+DB_STATEMENT_CACHE_SIZE = 256
+
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+
+
+def _open_connection():
+    conn = sqlite3.connect(
+        DB_NAME,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,
+        check_same_thread=False,
+        cached_statements=DB_STATEMENT_CACHE_SIZE
+    )
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    with _connections_lock:
+        _connections.append(conn)
+    return conn
+
+
+def _close_connection(conn):
+    with _connections_lock:
+        if conn in _connections:
+            _connections.remove(conn)
+    try:
+        conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"Ошибка закрытия соединения с БД: {e}")
+
+
+class _ThreadConnection:
+    """Соединение потока. Закрывается и убирается из пула, когда поток завершается
+    (Python очищает его threading.local) или вызывает release_connection()."""
+
+    def __init__(self):
+        self.conn = _open_connection()
+        self.release = weakref.finalize(self, _close_connection, self.conn)
+
+
+def get_connection():
+    """Возвращает соединение текущего потока (открывает его при первом вызове)."""
+    holder = getattr(_local, 'holder', None)
+    if holder is None:
+        holder = _ThreadConnection()
+        _local.holder = holder
+        _local.depth = 0
+    return holder.conn
+
+
+def release_connection():
+    """Закрывает соединение текущего потока. Вызывать в finally короткоживущих потоков."""
+    holder = _local.__dict__.pop('holder', None)
+    _local.depth = 0
+    if holder is not None:
+        holder.release()
+
+
+def get_open_connections_count():
+    with _connections_lock:
+        return len(_connections)
+
+
+@contextmanager
+def transaction():
+    """Открывает транзакцию (BEGIN IMMEDIATE) на соединении текущего потока.
+
+    Вложенные вызовы присоединяются к внешней транзакции: фиксация или откат
+    выполняются только на самом внешнем уровне.
+    """
+    conn = get_connection()
+    if _local.depth:
+        _local.depth += 1
+        try:
+            yield conn
+        finally:
+            _local.depth -= 1
+        return
+
+    conn.execute('BEGIN IMMEDIATE')
+    _local.depth = 1
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+    finally:
+        _local.depth = 0
+
+
+def _execute(query, params=()):
+    return get_connection().execute(query, params)
+
+
+def _fetchone(query, params=()):
+    return get_connection().execute(query, params).fetchone()
+
+
+def close_connections():
+    """Закрывает все открытые соединения пула (при остановке процесса)."""
+    with _connections_lock:
+        connections = list(_connections)
+    for conn in connections:
+        _close_connection(conn)
+    _local.__dict__.clear()
+
+
+# --- Миграции схемы ---
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция применяется
+# один раз в собственной транзакции; новые изменения схемы добавляются
+# в конец списка MIGRATIONS.
 
+def _migration_base_tables(conn):
+    """Базовые таблицы бота"""
     # Таблица пользователей
-    cursor.execute('''
+    conn.execute('''
     CREATE TABLE IF NOT EXISTS users (
         user_id INTEGER PRIMARY KEY,
         username TEXT,
@@ -23,7 +148,7 @@ def init_db():
     ''')
 
     # Таблица транзакций
-    cursor.execute('''
+    conn.execute('''
     CREATE TABLE IF NOT EXISTS transactions (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER,
@@ -37,7 +162,7 @@ def init_db():
     ''')
 
     # Таблица платежей
-    cursor.execute('''
+    conn.execute('''
     CREATE TABLE IF NOT EXISTS payments (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER,
@@ -50,7 +175,7 @@ def init_db():
     ''')
 
     # Таблица сессий/состояний
-    cursor.execute('''
+    conn.execute('''
     CREATE TABLE IF NOT EXISTS sessions (
         user_id INTEGER PRIMARY KEY,
         state TEXT,
@@ -62,36 +187,343 @@ def init_db():
     ''')
 
     # --- НОВАЯ ТАБЛИЦА: НАСТРОЙКИ (для last_lt) ---
-    cursor.execute('''
+    conn.execute('''
     CREATE TABLE IF NOT EXISTS settings (
         key TEXT PRIMARY KEY,
         value TEXT
     )
     ''')
 
-    # Миграция: добавляем колонку internal_stars, если таблица уже существовала.
-    cursor.execute("PRAGMA table_info(users)")
-    columns = [row[1] for row in cursor.fetchall()]
+
+def _migration_users_star_columns(conn):
+    """Колонки internal_stars и tg_stars_balance в users"""
+    # Базы, созданные до появления версий схемы, могут уже содержать эти колонки.
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(users)").fetchall()]
     if 'internal_stars' not in columns:
-        cursor.execute('ALTER TABLE users ADD COLUMN internal_stars INTEGER DEFAULT 0')
+        conn.execute('ALTER TABLE users ADD COLUMN internal_stars INTEGER DEFAULT 0')
     if 'tg_stars_balance' not in columns:
-        cursor.execute('ALTER TABLE users ADD COLUMN tg_stars_balance INTEGER DEFAULT 0')
+        conn.execute('ALTER TABLE users ADD COLUMN tg_stars_balance INTEGER DEFAULT 0')
+
+
+def _migration_purchase_tables(conn):
+    """Резервы средств и очередь отправки звезд"""
+    # Резервы средств на время выполнения покупки
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS balance_holds (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        amount REAL,
+        status TEXT DEFAULT 'reserved',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        settled_at TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (user_id)
+    )
+    ''')
+
+    # Очередь отправки звезд через Fragment
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS delivery_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        chat_id INTEGER,
+        message_id INTEGER,
+        target_username TEXT,
+        stars INTEGER,
+        hold_id INTEGER,
+        status TEXT DEFAULT 'queued',
+        error TEXT,
+        created_at TIMESTAMP DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (user_id),
+        FOREIGN KEY (hold_id) REFERENCES balance_holds (id)
+    )
+    ''')
+
+
+def _migration_internal_stars_pool(conn):
+    """Пул внутренних звезд в отдельной строке-счетчике"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS internal_stars_pool (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        balance INTEGER NOT NULL DEFAULT 0 CHECK (balance >= 0),
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    # Переносим значение пула из settings, если оно там было.
+    conn.execute('''
+    INSERT OR IGNORE INTO internal_stars_pool (id, balance)
+    VALUES (1, COALESCE(
+        (SELECT CAST(CAST(value AS REAL) AS INTEGER) FROM settings WHERE key = 'internal_stars_pool'),
+        0
+    ))
+    ''')
+
+
+def _migration_indexes(conn):
+    """Вторичные индексы для частых запросов"""
+    # get_referral_count, /stats (пользователи с реферером)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_referrer ON users (referrer_id)')
+    # get_pending_payment: user_id + status ORDER BY created_at
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_payments_user_status_created ON payments (user_id, status, created_at)')
+    # get_latest_payment: user_id ORDER BY created_at
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_payments_user_created ON payments (user_id, created_at)')
+    # update_payment_status / get_payment / settle_payment
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_payments_yookassa_id ON payments (yookassa_id)')
+    # /stats по статусу и постраничная сверка ожидающих платежей
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_payments_status ON payments (status, id, amount)')
+    # /stats и статистика экспорта по типу и статусу транзакций
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_transactions_type_status ON transactions (type, status, amount)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions (user_id)')
+    # claim_delivery_job / get_delivery_queue_depth
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_delivery_jobs_status ON delivery_jobs (status, id)')
+
+
+# --- Материализованные счетчики для /stats ---
+# Счетчики поддерживаются триггерами, поэтому учитывают любые записи
+# (бот, API-сервер, ручные правки), а /stats читает одну маленькую таблицу.
+# Денежные суммы округляются до копеек на каждом шаге, иначе ошибки REAL
+# накапливаются и balance_sum расходится с SUM(balance).
+STATS_COUNTERS_QUERIES = {
+    'total_users': "SELECT COUNT(*) FROM users",
+    'referred_users': "SELECT COUNT(*) FROM users WHERE referrer_id IS NOT NULL",
+    'balance_sum': "SELECT ROUND(COALESCE(SUM(balance), 0), 2) FROM users",
+    'internal_stars_sum': "SELECT COALESCE(SUM(internal_stars), 0) FROM users",
+    'completed_purchases': (
+        "SELECT COUNT(*) FROM transactions WHERE type = 'stars_purchase' AND status = 'completed'"
+    ),
+    'succeeded_payments': "SELECT COUNT(*) FROM payments WHERE status = 'succeeded'",
+    'succeeded_payments_sum': "SELECT ROUND(COALESCE(SUM(amount), 0), 2) FROM payments WHERE status = 'succeeded'",
+}
+
+_STATS_TRIGGERS = {
+    'trg_stats_users_insert': '''
+        AFTER INSERT ON users BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'total_users';
+            UPDATE stats_counters SET value = value + (NEW.referrer_id IS NOT NULL) WHERE name = 'referred_users';
+            UPDATE stats_counters SET value = ROUND(value + COALESCE(NEW.balance, 0), 2) WHERE name = 'balance_sum';
+            UPDATE stats_counters SET value = value + COALESCE(NEW.internal_stars, 0)
+                WHERE name = 'internal_stars_sum';
+        END
+    ''',
+    'trg_stats_users_update': '''
+        AFTER UPDATE OF balance, internal_stars, referrer_id ON users BEGIN
+            UPDATE stats_counters SET value = value + (NEW.referrer_id IS NOT NULL) - (OLD.referrer_id IS NOT NULL)
+                WHERE name = 'referred_users';
+            UPDATE stats_counters SET value = ROUND(value + COALESCE(NEW.balance, 0) - COALESCE(OLD.balance, 0), 2)
+                WHERE name = 'balance_sum';
+            UPDATE stats_counters SET value = value + COALESCE(NEW.internal_stars, 0) - COALESCE(OLD.internal_stars, 0)
+                WHERE name = 'internal_stars_sum';
+        END
+    ''',
+    'trg_stats_users_delete': '''
+        AFTER DELETE ON users BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'total_users';
+            UPDATE stats_counters SET value = value - (OLD.referrer_id IS NOT NULL) WHERE name = 'referred_users';
+            UPDATE stats_counters SET value = ROUND(value - COALESCE(OLD.balance, 0), 2) WHERE name = 'balance_sum';
+            UPDATE stats_counters SET value = value - COALESCE(OLD.internal_stars, 0)
+                WHERE name = 'internal_stars_sum';
+        END
+    ''',
+    'trg_stats_transactions_insert': '''
+        AFTER INSERT ON transactions WHEN NEW.type = 'stars_purchase' AND NEW.status = 'completed' BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'completed_purchases';
+        END
+    ''',
+    'trg_stats_transactions_update': '''
+        AFTER UPDATE OF type, status ON transactions BEGIN
+            UPDATE stats_counters
+            SET value = value
+                + (NEW.type = 'stars_purchase' AND NEW.status = 'completed')
+                - (OLD.type = 'stars_purchase' AND OLD.status = 'completed')
+            WHERE name = 'completed_purchases';
+        END
+    ''',
+    'trg_stats_transactions_delete': '''
+        AFTER DELETE ON transactions WHEN OLD.type = 'stars_purchase' AND OLD.status = 'completed' BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'completed_purchases';
+        END
+    ''',
+    'trg_stats_payments_insert': '''
+        AFTER INSERT ON payments WHEN NEW.status = 'succeeded' BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'succeeded_payments';
+            UPDATE stats_counters SET value = ROUND(value + COALESCE(NEW.amount, 0), 2)
+                WHERE name = 'succeeded_payments_sum';
+        END
+    ''',
+    'trg_stats_payments_update': '''
+        AFTER UPDATE OF status, amount ON payments BEGIN
+            UPDATE stats_counters
+            SET value = value + (NEW.status = 'succeeded') - (OLD.status = 'succeeded')
+            WHERE name = 'succeeded_payments';
+            UPDATE stats_counters
+            SET value = ROUND(
+                value
+                + CASE WHEN NEW.status = 'succeeded' THEN COALESCE(NEW.amount, 0) ELSE 0 END
+                - CASE WHEN OLD.status = 'succeeded' THEN COALESCE(OLD.amount, 0) ELSE 0 END,
+                2
+            )
+            WHERE name = 'succeeded_payments_sum';
+        END
+    ''',
+    'trg_stats_payments_delete': '''
+        AFTER DELETE ON payments WHEN OLD.status = 'succeeded' BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'succeeded_payments';
+            UPDATE stats_counters SET value = ROUND(value - COALESCE(OLD.amount, 0), 2)
+                WHERE name = 'succeeded_payments_sum';
+        END
+    ''',
+}
+
+
+def _migration_stats_counters(conn):
+    """Материализованные счетчики для /stats"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS stats_counters (
+        name TEXT PRIMARY KEY,
+        value REAL NOT NULL DEFAULT 0
+    )
+    ''')
+    for name, body in _STATS_TRIGGERS.items():
+        conn.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {body}')
+    _recompute_stats_counters(conn)
+
+
+def _migration_export_jobs(conn):
+    """Задачи экспорта БД"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS export_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        chat_id INTEGER,
+        message_id INTEGER,
+        reply_to_message_id INTEGER,
+        status TEXT DEFAULT 'queued',
+        progress TEXT,
+        cancel_requested INTEGER DEFAULT 0,
+        filename TEXT,
+        error TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP
+    )
+    ''')
+    # Не больше одной активной задачи каждого вида: повторный /export присоединяется к ней
+    conn.execute('''
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_export_jobs_active
+    ON export_jobs (kind) WHERE status IN ('queued', 'running')
+    ''')
+
+
+def _migration_transactions_external_id(conn):
+    """Внешний ключ идемпотентности транзакций (lt/hash перевода TON)"""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(transactions)").fetchall()]
+    if 'external_id' not in columns:
+        conn.execute('ALTER TABLE transactions ADD COLUMN external_id TEXT')
+    conn.execute('''
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_external_id
+    ON transactions (external_id) WHERE external_id IS NOT NULL
+    ''')
+
+
+def _migration_rate_history(conn):
+    """История курсов (для аудита зачислений по курсу)"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS rate_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        pair TEXT NOT NULL,
+        rate REAL NOT NULL,
+        sources TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_rate_history_pair_created ON rate_history (pair, created_at)')
+
+
+def _migration_open_holds_indexes(conn):
+    """Индексы для списка открытых резервов (/holds)"""
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_balance_holds_reserved ON balance_holds (created_at) WHERE status = 'reserved'"
+    )
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_delivery_jobs_hold ON delivery_jobs (hold_id)')
+
+
+def _migration_stats_counters_rounding(conn):
+    """Округление денежных счетчиков /stats до копеек"""
+    for name, body in _STATS_TRIGGERS.items():
+        conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+        conn.execute(f'CREATE TRIGGER {name} {body}')
+    _recompute_stats_counters(conn)
+
+
+MIGRATIONS = [
+    _migration_base_tables,
+    _migration_users_star_columns,
+    _migration_purchase_tables,
+    _migration_internal_stars_pool,
+    _migration_indexes,
+    _migration_stats_counters,
+    _migration_export_jobs,
+    _migration_transactions_external_id,
+    _migration_rate_history,
+    _migration_open_holds_indexes,
+    _migration_stats_counters_rounding,
+]
+
+
+def _recompute_stats_counters(conn):
+    values = {}
+    for name, query in STATS_COUNTERS_QUERIES.items():
+        values[name] = conn.execute(query).fetchone()[0]
+        conn.execute(
+            'INSERT OR REPLACE INTO stats_counters (name, value) VALUES (?, ?)',
+            (name, values[name])
+        )
+    return values
+
+
+def get_stats_counters():
+    """Возвращает материализованные счетчики статистики (O(1), без сканирования таблиц)."""
+    rows = get_connection().execute('SELECT name, value FROM stats_counters').fetchall()
+    return dict(rows)
+
+
+def rebuild_stats_counters():
+    """Пересчитывает счетчики с нуля. Возвращает (старые значения, новые значения) для сверки."""
+    with transaction() as conn:
+        before = dict(conn.execute('SELECT name, value FROM stats_counters').fetchall())
+        after = _recompute_stats_counters(conn)
+    return before, after
+
+
+def get_schema_version():
+    return _fetchone('PRAGMA user_version')[0]
+
+
+# Инициализация базы данных
+def init_db():
+    conn = get_connection()
+
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        if get_schema_version() >= version:
+            continue
+        with transaction():
+            # Повторная проверка под блокировкой: миграцию мог применить другой процесс
+            if get_schema_version() >= version:
+                continue
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {version}')
+        logger.info(f"Применена миграция БД #{version}: {migration.__doc__}")
 
-    conn.commit()
-    conn.close()
     logger.info("✅ База данных инициализирована.")
 
 
 def get_user(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
+    user = _fetchone(
         'SELECT user_id, username, balance, internal_stars, tg_stars_balance, referrer_id, created_at '
         'FROM users WHERE user_id = ?',
         (user_id,)
     )
-    user = cursor.fetchone()
-    conn.close()
 
     if user:
         return {
@@ -107,142 +539,538 @@ def get_user(user_id):
 
 
 def create_user(user_id, username, referrer_id=None):  # ДОБАВЛЕН referrer_id
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
     # Обновленный запрос: добавлено поле referrer_id
-    cursor.execute(
+    cursor = _execute(
         'INSERT OR IGNORE INTO users (user_id, username, referrer_id) VALUES (?, ?, ?)',
         (user_id, username, referrer_id)  # ПЕРЕДАЧА referrer_id
     )
-    conn.commit()
-    conn.close()
 
     # Возвращаем True, если пользователь был создан (ROWCOUNT=1)
     return cursor.rowcount == 1
 
 def get_referral_count(user_id):
     """Возвращает количество пользователей, приглашенных данным пользователем."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
+    return _fetchone(
         'SELECT COUNT(*) FROM users WHERE referrer_id = ?',
         (user_id,)
-    )
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
+    )[0]
 
 
 def update_balance(user_id, amount):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
+    _execute(
         'UPDATE users SET balance = ROUND(balance + ?, 2) WHERE user_id = ?',
         (amount, user_id)
     )
-    conn.commit()
-    conn.close()
 
 
 def update_internal_stars(user_id, amount):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        'UPDATE users SET internal_stars = internal_stars + ? WHERE user_id = ?',
+    """Изменяет баланс внутренних звезд пользователя. Возвращает новый баланс или None."""
+    row = _fetchone(
+        'UPDATE users SET internal_stars = internal_stars + ? WHERE user_id = ? RETURNING internal_stars',
         (amount, user_id)
     )
-    conn.commit()
-    conn.close()
+    return int(row[0]) if row else None
+
+
+def withdraw_internal_stars(user_id, amount):
+    """Списывает внутренние звезды одним запросом. Возвращает новый баланс или None, если звезд не хватает."""
+    row = _fetchone(
+        '''
+        UPDATE users SET internal_stars = internal_stars - ?
+        WHERE user_id = ? AND internal_stars >= ?
+        RETURNING internal_stars
+        ''',
+        (amount, user_id, amount)
+    )
+    return int(row[0]) if row else None
 
 
 def get_internal_stars(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT internal_stars FROM users WHERE user_id = ?', (user_id,))
-    row = cursor.fetchone()
-    conn.close()
+    row = _fetchone('SELECT internal_stars FROM users WHERE user_id = ?', (user_id,))
     return int(row[0]) if row and row[0] is not None else 0
 
 
 def update_tg_stars_balance(user_id, amount):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
+    _execute(
         'UPDATE users SET tg_stars_balance = tg_stars_balance + ? WHERE user_id = ?',
         (amount, user_id)
     )
-    conn.commit()
-    conn.close()
 
 
 def get_tg_stars_balance(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT tg_stars_balance FROM users WHERE user_id = ?', (user_id,))
-    row = cursor.fetchone()
-    conn.close()
+    row = _fetchone('SELECT tg_stars_balance FROM users WHERE user_id = ?', (user_id,))
     return int(row[0]) if row and row[0] is not None else 0
 
 
 def add_transaction(user_id, amount, transaction_type, status='completed', target_user=None):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
+    _execute(
         'INSERT INTO transactions (user_id, amount, type, status, target_user) VALUES (?, ?, ?, ?, ?)',
         (user_id, amount, transaction_type, status, target_user)
     )
-    conn.commit()
-    conn.close()
 
 
 def add_payment(user_id, amount, yookassa_id, status='pending'):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
+    _execute(
         'INSERT INTO payments (user_id, amount, yookassa_id, status) VALUES (?, ?, ?, ?)',
         (user_id, amount, yookassa_id, status)
     )
-    conn.commit()
-    conn.close()
 
 
 def get_pending_payment(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
+    return _fetchone(
         'SELECT yookassa_id, amount FROM payments '
-        'WHERE user_id = ? AND status = "pending" '
+        'WHERE user_id = ? AND status = \'pending\' '
         'ORDER BY created_at DESC LIMIT 1',
         (user_id,)
     )
-    payment = cursor.fetchone()
-    conn.close()
-    return payment
 
 
 def update_payment_status(yookassa_id, status):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
+    _execute(
         'UPDATE payments SET status = ? WHERE yookassa_id = ?',
         (status, yookassa_id)
     )
-    conn.commit()
-    conn.close()
+
+
+def get_payment(yookassa_id):
+    row = _fetchone(
+        'SELECT user_id, amount, status, created_at FROM payments WHERE yookassa_id = ?',
+        (yookassa_id,)
+    )
+    if row:
+        return {'user_id': row[0], 'amount': row[1], 'status': row[2], 'created_at': row[3]}
+    return None
+
+
+def get_latest_payment(user_id):
+    """Возвращает последний платеж пользователя (yookassa_id, amount, status) или None."""
+    return _fetchone(
+        'SELECT yookassa_id, amount, status FROM payments '
+        'WHERE user_id = ? ORDER BY created_at DESC, id DESC LIMIT 1',
+        (user_id,)
+    )
+
+
+def get_pending_payments_page(after_id=0, limit=100, min_age_seconds=0):
+    """Возвращает страницу ожидающих платежей с id > after_id (по возрастанию id)."""
+    rows = get_connection().execute(
+        '''
+        SELECT id, yookassa_id, user_id, amount, (julianday('now') - julianday(created_at)) * 86400
+        FROM payments
+        WHERE status = 'pending' AND id > ?
+          AND created_at <= datetime('now', ?)
+        ORDER BY id
+        LIMIT ?
+        ''',
+        (after_id, f'-{int(min_age_seconds)} seconds', limit)
+    ).fetchall()
+    return [
+        {'id': row[0], 'yookassa_id': row[1], 'user_id': row[2], 'amount': row[3], 'age_seconds': row[4]}
+        for row in rows
+    ]
+
+
+def count_pending_payments():
+    return _fetchone("SELECT COUNT(*) FROM payments WHERE status = 'pending'")[0]
+
+
+def settle_payments_batch(updates):
+    """Закрывает пачку платежей [(yookassa_id, status), ...] одной транзакцией.
+
+    Возвращает список закрытых этим вызовом платежей (dict как у settle_payment + status).
+    """
+    settled = []
+    with transaction():
+        for yookassa_id, status in updates:
+            result = settle_payment(yookassa_id, status)
+            if result:
+                result['status'] = status
+                result['yookassa_id'] = yookassa_id
+                settled.append(result)
+    return settled
+
+
+def settle_payment(yookassa_id, status):
+    """Идемпотентно закрывает ожидающий платеж.
+
+    Статус меняется только у платежа в состоянии 'pending'; для 'succeeded'
+    в той же транзакции пополняется баланс и пишется транзакция.
+    Возвращает dict с user_id, amount и balance, если платеж был закрыт
+    этим вызовом, иначе None.
+    """
+    with transaction() as conn:
+        row = conn.execute(
+            '''
+            UPDATE payments SET status = ?
+            WHERE yookassa_id = ? AND status = 'pending'
+            RETURNING user_id, amount
+            ''',
+            (status, yookassa_id)
+        ).fetchone()
+        if not row:
+            return None
+        user_id, amount = row
+        if status == 'succeeded':
+            update_balance(user_id, amount)
+            add_transaction(user_id, amount, 'deposit', 'completed')
+        balance = conn.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        return {'user_id': user_id, 'amount': amount, 'balance': balance[0] if balance else None}
+
+
+def ton_deposit_external_id(lt, tx_hash):
+    return f"ton:{lt}:{tx_hash}"
+
+
+def settle_ton_deposits(deposits, last_lt):
+    """Зачисляет страницу депозитов TON и сдвигает курсор last_lt одной транзакцией.
+
+    Каждый депозит записывается в transactions с external_id из lt и hash
+    перевода; уникальный индекс делает повторную обработку той же страницы
+    пустой операцией. Депозиты несуществующих пользователей пропускаются.
+    Возвращает зачисленные этим вызовом депозиты (с username и новым balance).
+    """
+    credited = []
+    with transaction() as conn:
+        for deposit in deposits:
+            inserted = conn.execute(
+                '''
+                INSERT OR IGNORE INTO transactions (user_id, amount, type, status, target_user, external_id)
+                SELECT user_id, ?, 'deposit_ton', 'completed', ?, ?
+                FROM users WHERE user_id = ?
+                RETURNING id
+                ''',
+                (
+                    deposit['rub_amount'],
+                    f"{deposit['ton_amount']:.4f} TON",  # target_user хранит сумму в TON
+                    ton_deposit_external_id(deposit['lt'], deposit['hash']),
+                    deposit['user_id']
+                )
+            ).fetchone()
+            if not inserted:
+                continue
+
+            row = conn.execute(
+                'UPDATE users SET balance = ROUND(balance + ?, 2) WHERE user_id = ? RETURNING username, balance',
+                (deposit['rub_amount'], deposit['user_id'])
+            ).fetchone()
+            credited.append(dict(deposit, username=row[0], balance=row[1]))
+
+        set_setting('last_lt', last_lt)
+    return credited
+
+
+# --- Резервирование средств (hold) ---
+
+def reserve_balance(user_id, amount):
+    """Атомарно списывает amount с баланса в резерв.
+
+    Возвращает ID резерва или None, если средств недостаточно.
+    """
+    with transaction() as conn:
+        cursor = conn.execute(
+            'UPDATE users SET balance = ROUND(balance - ?, 2) WHERE user_id = ? AND balance >= ?',
+            (amount, user_id, amount)
+        )
+        if cursor.rowcount != 1:
+            return None
+        cursor = conn.execute(
+            'INSERT INTO balance_holds (user_id, amount) VALUES (?, ?)',
+            (user_id, amount)
+        )
+        return cursor.lastrowid
+
+
+def commit_balance_hold(hold_id, transaction_amount, transaction_type, target_user=None):
+    """Подтверждает резерв и записывает транзакцию. Возвращает новый баланс пользователя."""
+    with transaction() as conn:
+        row = conn.execute(
+            '''
+            UPDATE balance_holds SET status = 'committed', settled_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'reserved'
+            RETURNING user_id
+            ''',
+            (hold_id,)
+        ).fetchone()
+        if not row:
+            logger.warning(f"Резерв {hold_id} уже закрыт, подтверждение пропущено.")
+            return None
+        user_id = row[0]
+        conn.execute(
+            'INSERT INTO transactions (user_id, amount, type, status, target_user) VALUES (?, ?, ?, ?, ?)',
+            (user_id, transaction_amount, transaction_type, 'completed', target_user)
+        )
+        return conn.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,)).fetchone()[0]
+
+
+def release_balance_hold(hold_id):
+    """Отменяет резерв и возвращает средства на баланс. Возвращает True, если резерв был открыт."""
+    with transaction() as conn:
+        row = conn.execute(
+            '''
+            UPDATE balance_holds SET status = 'released', settled_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'reserved'
+            RETURNING user_id, amount
+            ''',
+            (hold_id,)
+        ).fetchone()
+        if not row:
+            return False
+        conn.execute(
+            'UPDATE users SET balance = ROUND(balance + ?, 2) WHERE user_id = ?',
+            (row[1], row[0])
+        )
+        return True
+
+
+# --- Очередь отправки звезд ---
+
+def enqueue_delivery_job(user_id, chat_id, message_id, target_username, stars, hold_id):
+    """Ставит отправку звезд в очередь. Возвращает ID задачи."""
+    cursor = _execute(
+        '''
+        INSERT INTO delivery_jobs (user_id, chat_id, message_id, target_username, stars, hold_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''',
+        (user_id, chat_id, message_id, target_username, stars, hold_id)
+    )
+    return cursor.lastrowid
+
+
+def claim_delivery_job():
+    """Атомарно забирает самую старую задачу из очереди. Возвращает dict или None."""
+    row = _fetchone(
+        '''
+        UPDATE delivery_jobs
+        SET status = 'running', started_at = strftime('%Y-%m-%d %H:%M:%f', 'now')
+        WHERE id = (SELECT id FROM delivery_jobs WHERE status = 'queued' ORDER BY id LIMIT 1)
+          AND status = 'queued'
+        RETURNING id, user_id, chat_id, message_id, target_username, stars, hold_id
+        '''
+    )
+    if row:
+        return {
+            'id': row[0],
+            'user_id': row[1],
+            'chat_id': row[2],
+            'message_id': row[3],
+            'target_username': row[4],
+            'stars': row[5],
+            'hold_id': row[6]
+        }
+    return None
+
+
+def finish_delivery_job(job_id, status, error=None):
+    """Закрывает задачу. Возвращает время от постановки в очередь до завершения (в секундах)."""
+    row = _fetchone(
+        '''
+        UPDATE delivery_jobs
+        SET status = ?, error = ?, finished_at = strftime('%Y-%m-%d %H:%M:%f', 'now')
+        WHERE id = ?
+        RETURNING (julianday(finished_at) - julianday(created_at)) * 86400
+        ''',
+        (status, error, job_id)
+    )
+    return row[0] if row else None
+
+
+def recover_delivery_jobs():
+    """Помечает задачи, прерванные перезапуском посреди отправки, как 'interrupted'.
+
+    Такие задачи не повторяются автоматически: звезды могли уже уйти,
+    поэтому их резерв остается открытым до ручной проверки.
+    """
+    rows = get_connection().execute(
+        '''
+        UPDATE delivery_jobs SET status = 'interrupted', finished_at = strftime('%Y-%m-%d %H:%M:%f', 'now')
+        WHERE status = 'running'
+        RETURNING id, user_id, target_username, stars, hold_id
+        '''
+    ).fetchall()
+    return [
+        {'id': row[0], 'user_id': row[1], 'target_username': row[2], 'stars': row[3], 'hold_id': row[4]}
+        for row in rows
+    ]
+
+
+def get_delivery_queue_depth():
+    """Возвращает количество задач в очереди и в работе."""
+    row = _fetchone(
+        '''
+        SELECT
+            SUM(CASE WHEN status = 'queued' THEN 1 ELSE 0 END),
+            SUM(CASE WHEN status = 'running' THEN 1 ELSE 0 END)
+        FROM delivery_jobs WHERE status IN ('queued', 'running')
+        '''
+    )
+    return {'queued': row[0] or 0, 'running': row[1] or 0}
+
+
+# --- Ручная проверка резервов ---
+# Резерв остается открытым, если исход отправки неизвестен (перезапуск посреди
+# отправки или потерянный ответ Fragment). Администратор проверяет заказ и
+# подтверждает или возвращает такой резерв командой /holds.
+
+OPEN_HOLDS_QUERY = '''
+    SELECT h.id, h.user_id, h.amount, h.created_at, j.id, j.status, j.chat_id, j.stars, j.target_username
+    FROM balance_holds h
+    LEFT JOIN delivery_jobs j ON j.hold_id = h.id
+    WHERE h.status = 'reserved'
+'''
+
+
+def _open_hold_from_row(row):
+    return {
+        'id': row[0],
+        'user_id': row[1],
+        'amount': row[2],
+        'created_at': row[3],
+        'job_id': row[4],
+        'job_status': row[5],
+        'chat_id': row[6],
+        'stars': row[7],
+        'target_username': row[8]
+    }
+
+
+def get_open_balance_holds(min_age_minutes=0, limit=50):
+    """Открытые резервы старше min_age_minutes минут (от старых к новым) с их задачами отправки."""
+    rows = get_connection().execute(
+        OPEN_HOLDS_QUERY + " AND h.created_at <= datetime('now', ?) ORDER BY h.created_at LIMIT ?",
+        (f'-{int(min_age_minutes)} minutes', limit)
+    ).fetchall()
+    return [_open_hold_from_row(row) for row in rows]
+
+
+def get_open_balance_hold(hold_id):
+    """Открытый резерв по ID или None, если он уже закрыт."""
+    row = _fetchone(OPEN_HOLDS_QUERY + ' AND h.id = ?', (hold_id,))
+    return _open_hold_from_row(row) if row else None
+
+
+def close_interrupted_delivery_job(hold_id, status, error):
+    """Закрывает задачу с неизвестным исходом после ручной проверки ее резерва."""
+    _execute(
+        "UPDATE delivery_jobs SET status = ?, error = ? WHERE hold_id = ? AND status = 'interrupted'",
+        (status, error, hold_id)
+    )
+
+
+# --- Задачи экспорта ---
+
+EXPORT_JOB_COLUMNS = (
+    'id', 'kind', 'chat_id', 'message_id', 'reply_to_message_id', 'status',
+    'progress', 'cancel_requested', 'filename', 'error'
+)
+
+
+def create_export_job(kind, chat_id, reply_to_message_id):
+    """Создает задачу экспорта. Возвращает (job_id, created).
+
+    Если задача того же вида уже в очереди или выполняется, новая не
+    создается и возвращается ID существующей с created=False.
+    """
+    cursor = _execute(
+        '''
+        INSERT OR IGNORE INTO export_jobs (kind, chat_id, reply_to_message_id)
+        VALUES (?, ?, ?)
+        ''',
+        (kind, chat_id, reply_to_message_id)
+    )
+    if cursor.rowcount:
+        return cursor.lastrowid, True
+    row = _fetchone(
+        "SELECT id FROM export_jobs WHERE kind = ? AND status IN ('queued', 'running')",
+        (kind,)
+    )
+    return (row[0] if row else None), False
+
+
+def set_export_job_message(job_id, message_id):
+    """Запоминает сообщение, в котором показывается прогресс задачи."""
+    _execute('UPDATE export_jobs SET message_id = ? WHERE id = ?', (message_id, job_id))
+
+
+def get_export_job(job_id):
+    """Возвращает задачу экспорта как dict или None."""
+    row = _fetchone(f"SELECT {', '.join(EXPORT_JOB_COLUMNS)} FROM export_jobs WHERE id = ?", (job_id,))
+    return dict(zip(EXPORT_JOB_COLUMNS, row)) if row else None
+
+
+def start_export_job(job_id):
+    """Переводит задачу из очереди в работу. Возвращает False, если ее уже отменили."""
+    cursor = _execute(
+        '''
+        UPDATE export_jobs SET status = 'running', started_at = CURRENT_TIMESTAMP
+        WHERE id = ? AND status = 'queued' AND cancel_requested = 0
+        ''',
+        (job_id,)
+    )
+    return cursor.rowcount == 1
+
+
+def update_export_job_progress(job_id, progress):
+    """Сохраняет прогресс задачи. Возвращает True, если запрошена отмена."""
+    row = _fetchone(
+        'UPDATE export_jobs SET progress = ? WHERE id = ? RETURNING cancel_requested',
+        (progress, job_id)
+    )
+    return bool(row and row[0])
+
+
+def finish_export_job(job_id, status, filename=None, error=None):
+    """Закрывает задачу экспорта с итоговым статусом."""
+    _execute(
+        '''
+        UPDATE export_jobs SET status = ?, filename = COALESCE(?, filename), error = ?,
+            finished_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+        ''',
+        (status, filename, error, job_id)
+    )
+
+
+def cancel_export_job(job_id):
+    """Запрашивает отмену задачи. Возвращает статус задачи после запроса или None.
+
+    Задача из очереди отменяется сразу, выполняющаяся — при следующей
+    записи прогресса.
+    """
+    with transaction():
+        _execute(
+            '''
+            UPDATE export_jobs
+            SET cancel_requested = 1,
+                status = CASE WHEN status = 'queued' THEN 'canceled' ELSE status END,
+                finished_at = CASE WHEN status = 'queued' THEN CURRENT_TIMESTAMP ELSE finished_at END
+            WHERE id = ? AND status IN ('queued', 'running')
+            ''',
+            (job_id,)
+        )
+        row = _fetchone('SELECT status FROM export_jobs WHERE id = ?', (job_id,))
+    return row[0] if row else None
+
+
+def recover_export_jobs():
+    """Закрывает задачи экспорта, прерванные перезапуском. Возвращает их количество."""
+    cursor = _execute(
+        '''
+        UPDATE export_jobs SET status = 'interrupted', finished_at = CURRENT_TIMESTAMP
+        WHERE status IN ('queued', 'running')
+        '''
+    )
+    return cursor.rowcount
 
 
 # --- НОВЫЕ ФУНКЦИИ ДЛЯ РАБОТЫ С СЕССИЯМИ/СОСТОЯНИЯМИ ---
 
 def set_session_data(user_id, data):
     """Сохраняет или обновляет данные сессии пользователя."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
     state = data.get('state')
     target_username = data.get('target_username')
     message_id = data.get('message_id')
 
-    cursor.execute(
+    _execute(
         '''
         INSERT OR REPLACE INTO sessions 
         (user_id, state, target_username, message_id, updated_at) 
@@ -250,20 +1078,14 @@ def set_session_data(user_id, data):
         ''',
         (user_id, state, target_username, message_id)
     )
-    conn.commit()
-    conn.close()
 
 
 def get_session_data(user_id):
     """Получает данные сессии пользователя."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
+    row = _fetchone(
         'SELECT state, target_username, message_id FROM sessions WHERE user_id = ?',
         (user_id,)
     )
-    row = cursor.fetchone()
-    conn.close()
 
     if row:
         return {
@@ -276,43 +1098,138 @@ def get_session_data(user_id):
 
 def delete_session_data(user_id):
     """Удаляет данные сессии пользователя."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    _execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+
+# --- Кэш настроек ---
+# Таблица settings маленькая и читается на каждом рендере меню, поэтому она
+# целиком держится в памяти процесса. Запись идет сквозь кэш, а счетчик
+# версии в самой таблице позволяет другим процессам (API-сервер) заметить
+# изменения и перечитать настройки.
+SETTINGS_VERSION_KEY = 'settings_version'
+SETTINGS_VERSION_CHECK_INTERVAL = 1.0  # секунд между проверками версии
+
+
+class SettingsCache:
+    """Кэш таблицы settings со сквозной записью."""
+
+    def __init__(self, check_interval=SETTINGS_VERSION_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._values = None
+        self._version = None
+        self._checked_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def _reload(self):
+        rows = get_connection().execute('SELECT key, value FROM settings').fetchall()
+        self._values = dict(rows)
+        self._version = self._values.get(SETTINGS_VERSION_KEY)
+        self._checked_at = time.monotonic()
+        self.reloads += 1
+
+    def _is_stale(self):
+        if self._values is None:
+            return True
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return False
+        self._checked_at = now
+        row = _fetchone('SELECT value FROM settings WHERE key = ?', (SETTINGS_VERSION_KEY,))
+        return (row[0] if row else None) != self._version
+
+    def get(self, key, default=None):
+        with self._lock:
+            if self._is_stale():
+                self.misses += 1
+                self._reload()
+            else:
+                self.hits += 1
+            return self._values.get(key, default)
+
+    def get_float(self, key, default):
+        try:
+            return float(self.get(key))
+        except (TypeError, ValueError):
+            return float(default)
+
+    def get_int(self, key, default):
+        try:
+            return int(float(self.get(key)))
+        except (TypeError, ValueError):
+            return int(default)
+
+    def set(self, key, value):
+        value = str(value)
+        # Внутри внешней транзакции запись может еще откатиться: кэш не
+        # обновляем, а сбрасываем, чтобы перечитать его после фиксации.
+        nested = getattr(_local, 'depth', 0) > 0
+        with transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)',
+                (key, value)
+            )
+            version = conn.execute(
+                '''
+                INSERT INTO settings (key, value) VALUES (?, '1')
+                ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+                RETURNING value
+                ''',
+                (SETTINGS_VERSION_KEY,)
+            ).fetchone()[0]
+
+        with self._lock:
+            if self._values is None:
+                return
+            if nested:
+                self._values = None
+                return
+            expected = str(int(self._version or 0) + 1)
+            if str(version) == expected:
+                self._values[key] = value
+                self._values[SETTINGS_VERSION_KEY] = expected
+                self._version = expected
+            else:
+                # Настройки менял другой процесс — перечитаем при следующем чтении.
+                self._values = None
+
+    def invalidate(self):
+        with self._lock:
+            self._values = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'reloads': self.reloads,
+                'version': self._version,
+                'size': len(self._values) if self._values is not None else 0
+            }
+
+
+settings_cache = SettingsCache()
+
 
 def get_setting(key, default=None):
     """Получает значение настройки по ключу."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
-    row = cursor.fetchone()
-    conn.close()
-    return row[0] if row else default
+    return settings_cache.get(key, default)
 
 
 def set_setting(key, value):
     """Сохраняет или обновляет значение настройки."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        '''
-        INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)
-        ''',
-        (key, str(value))
-    )
-    conn.commit()
-    conn.close()
+    settings_cache.set(key, value)
+
+
+def get_settings_cache_stats():
+    """Возвращает счетчики попаданий/промахов кэша настроек."""
+    return settings_cache.stats()
 
 
 def get_star_price():
     """Получает текущую цену Telegram Stars."""
-    value = get_setting('star_price', None)
-    try:
-        return float(value)
-    except (TypeError, ValueError):
-        return float(config.STAR_PRICE)
+    return settings_cache.get_float('star_price', config.STAR_PRICE)
 
 
 def set_star_price(value):
@@ -322,11 +1239,7 @@ def set_star_price(value):
 
 def get_usd_rub_rate():
     """Получает текущий курс USD/RUB."""
-    value = get_setting('usd_rub_rate', None)
-    try:
-        return float(value)
-    except (TypeError, ValueError):
-        return float(config.USD_RUB_RATE)
+    return settings_cache.get_float('usd_rub_rate', config.USD_RUB_RATE)
 
 
 def set_usd_rub_rate(value):
@@ -351,26 +1264,61 @@ def set_ton_rate_updated_at(timestamp):
     set_setting('ton_rate_updated_at', timestamp)
 
 
+def save_ton_rate_sample(rate, sources, timestamp):
+    """Сохраняет курс TON, время обновления и запись в rate_history одной транзакцией.
+
+    sources — {провайдер: курс} ответивших источников.
+    """
+    with transaction() as conn:
+        conn.execute(
+            'INSERT INTO rate_history (pair, rate, sources) VALUES (?, ?, ?)',
+            ('TON/RUB', rate, json.dumps(sources, sort_keys=True))
+        )
+        set_ton_rate(rate)
+        set_ton_rate_updated_at(timestamp)
+
+
+def get_rate_history(pair='TON/RUB', limit=100):
+    """Последние записи истории курса (новые первыми)."""
+    rows = get_connection().execute(
+        'SELECT rate, sources, created_at FROM rate_history WHERE pair = ? ORDER BY id DESC LIMIT ?',
+        (pair, limit)
+    ).fetchall()
+    return [
+        {'rate': rate, 'sources': json.loads(sources) if sources else {}, 'created_at': created_at}
+        for rate, sources, created_at in rows
+    ]
+
+
 def get_internal_stars_pool():
     """Получает баланс внутренних звезд (админский пул)."""
-    value = get_setting('internal_stars_pool', '0')
-    try:
-        return int(float(value))
-    except ValueError:
-        return 0
+    row = _fetchone('SELECT balance FROM internal_stars_pool WHERE id = 1')
+    return int(row[0]) if row else 0
 
 
 def set_internal_stars_pool(value):
     """Устанавливает баланс внутренних звезд (админский пул)."""
-    set_setting('internal_stars_pool', int(value))
+    _execute(
+        '''
+        INSERT INTO internal_stars_pool (id, balance) VALUES (1, ?)
+        ON CONFLICT(id) DO UPDATE SET balance = excluded.balance, updated_at = CURRENT_TIMESTAMP
+        ''',
+        (int(value),)
+    )
 
 
 def update_internal_stars_pool(amount):
-    """Изменяет баланс внутренних звезд (админский пул)."""
-    current = get_internal_stars_pool()
-    new_value = current + int(amount)
-    if new_value < 0:
-        return False
-    set_internal_stars_pool(new_value)
-    return True
+    """Изменяет баланс внутренних звезд (админский пул).
 
+    Возвращает новый баланс или None, если пул ушел бы в минус.
+    """
+    row = _fetchone(
+        '''
+        UPDATE internal_stars_pool
+        SET balance = balance + ?, updated_at = CURRENT_TIMESTAMP
+        WHERE id = 1 AND balance + ? >= 0
+        RETURNING balance
+        ''',
+        (int(amount), int(amount))
+    )
+    return int(row[0]) if row else None
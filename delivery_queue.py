@@ -0,0 +1,104 @@
+import threading
+import time
+
+from config import DELIVERY_WORKERS, logger
+from db import (
+    claim_delivery_job, finish_delivery_job, recover_delivery_jobs,
+    get_delivery_queue_depth
+)
+
+
+# --- Очередь отправки звезд ---
+# Задачи хранятся в таблице delivery_jobs, поэтому переживают перезапуск.
+# Обработчик колбэка только ставит задачу и сразу возвращается, а вызовы
+# Fragment выполняет пул воркеров.
+POLL_INTERVAL = 5.0  # секунд между проверками очереди без уведомлений
+LATENCY_WINDOW = 100  # сколько последних задач учитывать в метриках
+
+
+class DeliveryQueue:
+    """Пул воркеров, исполняющих задачи из таблицы delivery_jobs."""
+
+    def __init__(self, handler, workers=DELIVERY_WORKERS, poll_interval=POLL_INTERVAL):
+        # handler(job) -> (success, error); success=None — исход неизвестен,
+        # задача помечается 'interrupted' и ждет ручной проверки
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._latencies = []
+        self.completed = 0
+        self.failed = 0
+        self.interrupted = 0
+
+    def start(self):
+        """Запускает воркеры. Возвращает задачи, прерванные прошлым перезапуском."""
+        interrupted = recover_delivery_jobs()
+        for job in interrupted:
+            logger.error(
+                f"Задача отправки {job['id']} прервана перезапуском: {job['stars']} ⭐ для "
+                f"@{job['target_username']}, резерв {job['hold_id']} требует ручной проверки."
+            )
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'delivery-worker-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Запущена очередь отправки звезд ({self.workers} воркеров).")
+        return interrupted
+
+    def notify(self):
+        """Будит воркеры после постановки новой задачи (вызывать после фиксации транзакции)."""
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            try:
+                job = claim_delivery_job()
+            except Exception as e:
+                logger.error(f"Ошибка чтения очереди отправки: {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            self._process(job)
+
+    def _process(self, job):
+        started = time.monotonic()
+        try:
+            success, error = self.handler(job)
+        except Exception as e:
+            logger.error(f"Ошибка выполнения задачи отправки {job['id']}: {e}")
+            success, error = False, str(e)
+
+        status = 'done' if success else 'interrupted' if success is None else 'failed'
+        latency = finish_delivery_job(job['id'], status, error)
+        with self._lock:
+            if success:
+                self.completed += 1
+            elif success is None:
+                self.interrupted += 1
+            else:
+                self.failed += 1
+            self._latencies.append(latency if latency is not None else time.monotonic() - started)
+            del self._latencies[:-LATENCY_WINDOW]
+        logger.info(f"Задача отправки {job['id']} завершена ({status}).")
+
+    def stats(self):
+        depth = get_delivery_queue_depth()
+        with self._lock:
+            latencies = list(self._latencies)
+            stats = {
+                'workers': self.workers,
+                'completed': self.completed,
+                'failed': self.failed,
+                'interrupted': self.interrupted
+            }
+        stats.update(depth)
+        stats['avg_latency'] = sum(latencies) / len(latencies) if latencies else 0.0
+        stats['max_latency'] = max(latencies) if latencies else 0.0
+        return stats
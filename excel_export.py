@@ -1,75 +1,372 @@
 # excel_export.py
+import csv
+import gzip
+import io
 import sqlite3
+import zipfile
+import numpy as np
 import pandas as pd
 from datetime import datetime
 import os
 from config import DB_NAME, logger
+from db import get_setting, set_setting
 
 
-def export_database_to_excel():
-    """Экспортирует все данные из БД в Excel файл и возвращает имя файла."""
-    try:
-        # Создаем временную папку для экспорта (если нет)
-        temp_dir = "temp_exports"
-        if not os.path.exists(temp_dir):
-            os.makedirs(temp_dir)
+EXPORT_DIR = "temp_exports"
+EXPORT_CHUNK_SIZE = 5000
 
-        # Создаем имя файла с timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = os.path.join(temp_dir, f"bot_database_export_{timestamp}.xlsx")
+# Таблицы и названия листов в порядке экспорта
+EXPORT_TABLES = [
+    ('users', 'Пользователи'),
+    ('transactions', 'Транзакции'),
+    ('payments', 'Платежи'),
+    ('sessions', 'Сессии'),
+    ('settings', 'Настройки'),
+]
 
-        # Подключаемся к БД
-        conn = sqlite3.connect(DB_NAME)
 
-        # Создаем Excel writer
-        with pd.ExcelWriter(filename, engine='openpyxl') as writer:
+def _open_export_connection():
+    # Отдельное соединение только для чтения: экспорт не мешает записям бота (WAL)
+    return sqlite3.connect(f"file:{DB_NAME}?mode=ro", uri=True)
 
-            # 1. Таблица пользователей
-            users_df = pd.read_sql_query("SELECT * FROM users", conn)
-            if not users_df.empty:
-                users_df.to_excel(writer, sheet_name='Пользователи', index=False)
 
-            # 2. Таблица транзакций
-            transactions_df = pd.read_sql_query("SELECT * FROM transactions", conn)
-            if not transactions_df.empty:
-                transactions_df.to_excel(writer, sheet_name='Транзакции', index=False)
+# Инкрементальный экспорт: для каждой таблицы в settings хранится отметка
+# (high-water mark) последнего выгруженного значения колонки.
+# user_id — это Telegram ID, а не возрастающий счетчик, поэтому пользователи
+# отслеживаются по created_at, а транзакции и платежи — по id.
+INCREMENTAL_TABLES = [
+    ('users', 'Пользователи', 'created_at'),
+    ('transactions', 'Транзакции', 'id'),
+    ('payments', 'Платежи', 'id'),
+]
+WATERMARK_KEY_PREFIX = 'export_watermark_'
 
-            # 3. Таблица платежей
-            payments_df = pd.read_sql_query("SELECT * FROM payments", conn)
-            if not payments_df.empty:
-                payments_df.to_excel(writer, sheet_name='Платежи', index=False)
 
-            # 4. Таблица сессий
-            sessions_df = pd.read_sql_query("SELECT * FROM sessions", conn)
-            if not sessions_df.empty:
-                sessions_df.to_excel(writer, sheet_name='Сессии', index=False)
+class ExportCanceled(Exception):
+    """Бросается из progress_callback, чтобы прервать экспорт."""
 
-            # 5. Таблица настроек
-            settings_df = pd.read_sql_query("SELECT * FROM settings", conn)
-            if not settings_df.empty:
-                settings_df.to_excel(writer, sheet_name='Настройки', index=False)
 
-            # 6. Сводная статистика
-            stats_data = generate_statistics(conn)
-            stats_df = pd.DataFrame([stats_data])
-            stats_df.to_excel(writer, sheet_name='Статистика', index=False)
+def _iter_table_chunks(conn, table, chunk_size=EXPORT_CHUNK_SIZE, where='', params=()):
+    """Читает таблицу курсором порциями по chunk_size строк."""
+    cursor = conn.execute(f"SELECT * FROM {table} {where}", params)
+    columns = [column[0] for column in cursor.description]
+    yield columns
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield rows
+
+
+class _XlsxSink:
+    """Запись в xlsx в режиме write_only (строки сбрасываются на диск, а не копятся в памяти)."""
+
+    extension = 'xlsx'
+
+    def __init__(self, filename):
+        from openpyxl import Workbook
+        self.filename = filename
+        self.workbook = Workbook(write_only=True)
+        self.sheet = None
+
+    def start_table(self, title, columns):
+        self.sheet = self.workbook.create_sheet(title=title)
+        self.sheet.append(columns)
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.sheet.append(row)
+
+    def end_table(self):
+        self.sheet = None
+
+    def close(self):
+        self.workbook.save(self.filename)
+
+
+class _CsvZipSink:
+    """Запись каждой таблицы в отдельный CSV внутри zip-архива (сжатие deflate)."""
+
+    extension = 'zip'
+
+    def __init__(self, filename, compression=zipfile.ZIP_DEFLATED):
+        self.filename = filename
+        self.archive = zipfile.ZipFile(filename, 'w', compression=compression)
+        self.stream = None
+        self.writer = None
+
+    def start_table(self, title, columns):
+        self.stream = io.TextIOWrapper(self.archive.open(f"{title}.csv", 'w'), encoding='utf-8-sig', newline='')
+        self.writer = csv.writer(self.stream)
+        self.writer.writerow(columns)
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+
+    def end_table(self):
+        self.stream.close()
+        self.stream = None
+        self.writer = None
+
+    def close(self):
+        self.archive.close()
+
+
+class _CsvGzipZipSink(_CsvZipSink):
+    """Каждая таблица — отдельный .csv.gz внутри zip-архива (без повторного сжатия)."""
+
+    def __init__(self, filename):
+        super().__init__(filename, compression=zipfile.ZIP_STORED)
+        self._member = None
+
+    def start_table(self, title, columns):
+        member = self.archive.open(f"{title}.csv.gz", 'w', force_zip64=True)
+        self.stream = io.TextIOWrapper(gzip.GzipFile(fileobj=member, mode='wb'), encoding='utf-8', newline='')
+        self._member = member
+        self.writer = csv.writer(self.stream)
+        self.writer.writerow(columns)
+
+    def end_table(self):
+        # Закрытие обертки закрывает GzipFile, но не сам член архива
+        self.stream.close()
+        self._member.close()
+        self._member = None
+        self.stream = None
+        self.writer = None
+
+
+EXPORT_FORMATS = {
+    'xlsx': _XlsxSink,
+    'csv': _CsvZipSink,
+    'csv.gz': _CsvGzipZipSink,
+}
+
+
+def _new_export_filename(extension, suffix=''):
+    # Создаем временную папку для экспорта (если нет)
+    if not os.path.exists(EXPORT_DIR):
+        os.makedirs(EXPORT_DIR)
+
+    # Создаем имя файла с timestamp
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return os.path.join(EXPORT_DIR, f"bot_database_export_{suffix}{timestamp}.{extension}")
+
+
+def _write_table(conn, sink, table, title, progress_callback, chunk_size, where='', params=()):
+    """Переносит строки таблицы в sink порциями. Возвращает количество строк."""
+    total = conn.execute(f"SELECT COUNT(*) FROM {table} {where}", params).fetchone()[0]
+    if not total:
+        return 0
+
+    chunks = _iter_table_chunks(conn, table, chunk_size, where, params)
+    sink.start_table(title, next(chunks))
+    done = 0
+    for rows in chunks:
+        sink.write_rows(rows)
+        done += len(rows)
+        if progress_callback:
+            progress_callback(title, done, total)
+    sink.end_table()
+    return done
 
-        conn.close()
+
+def _remove_failed_export(filename):
+    # Пытаемся удалить файл в случае ошибки
+    try:
+        if filename and os.path.exists(filename):
+            os.remove(filename)
+    except OSError:
+        pass
+
+
+def export_database(export_format='xlsx', progress_callback=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """Потоково экспортирует БД в файл и возвращает имя файла (или None при ошибке).
+
+    Таблицы читаются курсором порциями по chunk_size строк и сразу
+    записываются в файл, поэтому пиковая память не зависит от размера БД.
+    progress_callback(title, rows_done, rows_total) вызывается после каждой порции.
+    Чтобы прервать экспорт, progress_callback бросает ExportCanceled.
+    """
+    filename = None
+    try:
+        sink_class = EXPORT_FORMATS[export_format]
+        filename = _new_export_filename(sink_class.extension)
+
+        conn = _open_export_connection()
+        try:
+            sink = sink_class(filename)
+            for table, title in EXPORT_TABLES:
+                _write_table(conn, sink, table, title, progress_callback, chunk_size)
+
+            # Сводная статистика
+            stats_data = generate_statistics(conn)
+            sink.start_table('Статистика', list(stats_data.keys()))
+            sink.write_rows([list(stats_data.values())])
+            sink.end_table()
+
+            # Дневная динамика
+            daily = generate_daily_series(conn)
+            if not daily.empty:
+                sink.start_table('Динамика', list(daily.columns))
+                sink.write_rows(daily.itertuples(index=False, name=None))
+                sink.end_table()
+            sink.close()
+        finally:
+            conn.close()
 
         logger.info(f"✅ База данных успешно экспортирована в {filename}")
         return filename
 
+    except ExportCanceled:
+        _remove_failed_export(filename)
+        raise
+
     except Exception as e:
         logger.error(f"❌ Ошибка при экспорте базы данных: {e}")
+        _remove_failed_export(filename)
+        return None
+
+
+def get_export_watermarks():
+    """Возвращает отметки последнего инкрементального экспорта по таблицам."""
+    return {
+        table: get_setting(WATERMARK_KEY_PREFIX + table)
+        for table, _, _ in INCREMENTAL_TABLES
+    }
+
+
+def save_export_watermarks(watermarks):
+    """Сохраняет отметки. Вызывать только после того, как файл доставлен."""
+    for table, value in watermarks.items():
+        if value is not None:
+            set_setting(WATERMARK_KEY_PREFIX + table, value)
 
-        # Пытаемся удалить файл в случае ошибки
+
+def export_database_delta(export_format='xlsx', progress_callback=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """Экспортирует только строки, появившиеся после прошлого инкрементального экспорта.
+
+    Возвращает (filename, watermarks) или (None, None) при ошибке. Новые
+    отметки не сохраняются автоматически: вызывающий код передает их в
+    save_export_watermarks после успешной отправки файла, чтобы при сбое
+    отправки строки попали в следующую выгрузку.
+    Экспорт только добавляет строки: изменения уже выгруженных строк
+    (например, смена статуса платежа) в дельту не попадают.
+    """
+    filename = None
+    try:
+        sink_class = EXPORT_FORMATS[export_format]
+        filename = _new_export_filename(sink_class.extension, 'delta_')
+        previous = get_export_watermarks()
+        watermarks = {}
+        summary = []
+
+        conn = _open_export_connection()
         try:
-            if 'filename' in locals() and os.path.exists(filename):
-                os.remove(filename)
-        except:
-            pass
+            sink = sink_class(filename)
+            for table, title, column in INCREMENTAL_TABLES:
+                # Верхняя граница фиксируется заранее, чтобы строки, вставленные
+                # во время выгрузки, не потерялись между отметками. Для created_at
+                # (точность — секунда) текущая секунда оставляется следующему запуску.
+                if column == 'id':
+                    lower = int(previous[table] or 0)
+                    upper = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+                else:
+                    lower = previous[table] or ''
+                    upper = conn.execute("SELECT datetime('now', '-1 second')").fetchone()[0]
+
+                rows = _write_table(
+                    conn, sink, table, title, progress_callback, chunk_size,
+                    f"WHERE {column} > ? AND {column} <= ? ORDER BY {column}", (lower, upper)
+                )
+                watermarks[table] = upper if upper > lower else previous[table]
+                summary.append([title, rows, previous[table] or '', watermarks[table] or ''])
+
+            sink.start_table('Сводка', ['Таблица', 'Новых строк', 'С отметки', 'По отметку'])
+            sink.write_rows(summary)
+            sink.end_table()
+            sink.close()
+        finally:
+            conn.close()
+
+        logger.info(f"✅ Инкрементальный экспорт сохранен в {filename}: {summary}")
+        return filename, watermarks
+
+    except ExportCanceled:
+        _remove_failed_export(filename)
+        raise
 
-        return None
+    except Exception as e:
+        logger.error(f"❌ Ошибка при инкрементальном экспорте базы данных: {e}")
+        _remove_failed_export(filename)
+        return None, None
+
+
+def export_database_to_excel(progress_callback=None):
+    """Экспортирует все данные из БД в Excel файл и возвращает имя файла."""
+    return export_database('xlsx', progress_callback)
+
+
+# Все агрегаты сводки за один запрос: каждая ветка UNION ALL возвращает
+# строки одного вида (раздел, ключ, количество, сумма, доп. значение).
+STATISTICS_QUERY = """
+    SELECT 'users' AS section, NULL AS key, COUNT(*) AS count, SUM(balance) AS total,
+           COUNT(DISTINCT referrer_id) AS extra, AVG(balance) AS average
+    FROM users
+    UNION ALL
+    SELECT 'transactions', type, COUNT(*), SUM(amount), NULL, NULL
+    FROM transactions
+    WHERE status = 'completed'
+    GROUP BY type
+    UNION ALL
+    SELECT 'payments', status, COUNT(*), SUM(amount), NULL, NULL
+    FROM payments
+    GROUP BY status
+    UNION ALL
+    SELECT * FROM (
+        SELECT 'top', username, NULL, balance, NULL, NULL
+        FROM users
+        WHERE balance > 0
+        ORDER BY balance DESC
+        LIMIT 5
+    )
+"""
+
+# Дневные ряды: по одному проходу на таблицу, SQL сворачивает строки до
+# одной на день, дальше pandas объединяет ряды и заполняет пропущенные дни.
+DAILY_TRANSACTIONS_QUERY = """
+    SELECT date(created_at) AS day,
+           SUM(amount) FILTER (WHERE type IN ('deposit', 'deposit_ton')) AS revenue,
+           COUNT(*) FILTER (WHERE type = 'stars_purchase') AS purchases,
+           SUM(amount) FILTER (WHERE type = 'stars_purchase') AS stars_sold
+    FROM transactions
+    WHERE status = 'completed'
+    GROUP BY date(created_at)
+"""
+
+DAILY_USERS_QUERY = """
+    SELECT date(created_at) AS day,
+           COUNT(*) AS new_users,
+           COUNT(referrer_id) AS referrals
+    FROM users
+    GROUP BY date(created_at)
+"""
+
+DAILY_SERIES_COLUMNS = {
+    'revenue': 'Пополнения, ₽',
+    'purchases': 'Покупок звезд',
+    'stars_sold': 'Продано звезд',
+    'new_users': 'Новых пользователей',
+    'referrals': 'По реферальной ссылке',
+}
+
+
+def _paired(frame, count_label, sum_label):
+    # Вектором строит {'<count_label> <ключ>': количество, '<sum_label> <ключ>': сумма}
+    # без обхода строк; пары идут подряд, как на листе до оптимизации
+    keys = frame['key'].astype(str)
+    labels = np.column_stack([count_label + ' ' + keys, sum_label + ' ' + keys]).ravel()
+    values = np.column_stack([frame['count'].astype(int).astype(object), frame['total'].astype(object)]).ravel()
+    return dict(zip(labels, values))
 
 
 def generate_statistics(conn):
@@ -77,62 +374,26 @@ def generate_statistics(conn):
     stats = {}
 
     try:
+        frame = pd.read_sql_query(STATISTICS_QUERY, conn)
+        frame['total'] = frame['total'].fillna(0).astype(float).round(2)
+        sections = dict(tuple(frame.groupby('section', sort=False)))
+
         # Общая статистика пользователей
-        users_stats = pd.read_sql_query("""
-            SELECT 
-                COUNT(*) as total_users,
-                COUNT(DISTINCT referrer_id) as users_with_referrals,
-                SUM(balance) as total_balance,
-                AVG(balance) as avg_balance
-            FROM users
-        """, conn)
-
-        if not users_stats.empty:
-            stats['Всего пользователей'] = users_stats.iloc[0]['total_users']
-            stats['Пользователей с рефералами'] = users_stats.iloc[0]['users_with_referrals']
-            stats['Общий баланс'] = round(users_stats.iloc[0]['total_balance'] or 0, 2)
-            stats['Средний баланс'] = round(users_stats.iloc[0]['avg_balance'] or 0, 2)
-
-        # Статистика транзакций
-        transactions_stats = pd.read_sql_query("""
-            SELECT 
-                type,
-                COUNT(*) as count,
-                SUM(amount) as total_amount
-            FROM transactions 
-            WHERE status = 'completed'
-            GROUP BY type
-        """, conn)
-
-        for _, row in transactions_stats.iterrows():
-            stats[f'Транзакций {row["type"]}'] = row['count']
-            stats[f'Сумма {row["type"]}'] = round(row['total_amount'] or 0, 2)
-
-        # Статистика платежей
-        payments_stats = pd.read_sql_query("""
-            SELECT 
-                status,
-                COUNT(*) as count,
-                SUM(amount) as total_amount
-            FROM payments 
-            GROUP BY status
-        """, conn)
-
-        for _, row in payments_stats.iterrows():
-            stats[f'Платежей {row["status"]}'] = row['count']
-            stats[f'Сумма платежей {row["status"]}'] = round(row['total_amount'] or 0, 2)
+        users = sections['users'].iloc[0]
+        stats['Всего пользователей'] = int(users['count'])
+        stats['Пользователей с рефералами'] = int(users['extra'])
+        stats['Общий баланс'] = users['total']
+        stats['Средний баланс'] = round(users['average'], 2) if pd.notna(users['average']) else 0
 
-        # Топ пользователей по балансу
-        top_users = pd.read_sql_query("""
-            SELECT username, balance 
-            FROM users 
-            WHERE balance > 0 
-            ORDER BY balance DESC 
-            LIMIT 5
-        """, conn)
+        # Статистика транзакций и платежей
+        empty = frame.iloc[0:0]
+        stats.update(_paired(sections.get('transactions', empty), 'Транзакций', 'Сумма'))
+        stats.update(_paired(sections.get('payments', empty), 'Платежей', 'Сумма платежей'))
 
-        for i, (_, row) in enumerate(top_users.iterrows(), 1):
-            stats[f'Топ {i} ({row["username"]})'] = round(row['balance'], 2)
+        # Топ пользователей по балансу
+        top = sections.get('top', empty)
+        labels = 'Топ ' + pd.Series(range(1, len(top) + 1), index=top.index).astype(str) + ' (' + top['key'].astype(str) + ')'
+        stats.update(dict(zip(labels, top['total'])))
 
         # Дата последнего обновления
         stats['Дата экспорта'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -144,16 +405,47 @@ def generate_statistics(conn):
     return stats
 
 
+def generate_daily_series(conn):
+    """Возвращает DataFrame по дням: пополнения, покупки, новые и реферальные пользователи.
+
+    Пропущенные дни заполняются нулями через resample, доля пришедших по
+    реферальной ссылке считается по всему ряду сразу.
+    """
+    frames = [
+        pd.read_sql_query(query, conn, index_col='day', parse_dates=['day'])
+        for query in (DAILY_TRANSACTIONS_QUERY, DAILY_USERS_QUERY)
+    ]
+    series = pd.concat(frames, axis=1)
+    series = series[series.index.notna()]
+    if series.empty:
+        return pd.DataFrame(columns=['Дата', *DAILY_SERIES_COLUMNS.values(), 'Доля рефералов, %'])
+
+    series = series.reindex(columns=list(DAILY_SERIES_COLUMNS)).fillna(0).resample('D').sum()
+    new_users = series['new_users'].to_numpy()
+    share = np.divide(series['referrals'].to_numpy() * 100, new_users,
+                      out=np.zeros(len(series)), where=new_users > 0)
+    series['referral_share'] = np.round(share, 1)
+    series['revenue'] = series['revenue'].round(2)
+    counts = ['purchases', 'new_users', 'referrals']
+    series[counts] = series[counts].astype(int)
+
+    series = series.rename(columns={**DAILY_SERIES_COLUMNS, 'referral_share': 'Доля рефералов, %'})
+    series.index = series.index.strftime('%Y-%m-%d')
+    return series.rename_axis('Дата').reset_index()
+
 
 def cleanup_old_exports(max_files=5):
     """Удаляет старые файлы экспорта из временной папки, оставляя только последние max_files."""
     try:
-        temp_dir = "temp_exports"
+        temp_dir = EXPORT_DIR
         if not os.path.exists(temp_dir):
             return
 
         # Ищем файлы экспорта
-        export_files = [f for f in os.listdir(temp_dir) if f.startswith('bot_database_export_') and f.endswith('.xlsx')]
+        export_files = [
+            f for f in os.listdir(temp_dir)
+            if f.startswith('bot_database_export_') and f.endswith(('.xlsx', '.zip'))
+        ]
 
         if len(export_files) > max_files:
             # Сортируем по времени создания (старые первыми)
@@ -177,7 +469,7 @@ def cleanup_old_exports(max_files=5):
 def cleanup_all_temp_exports():
     """Принудительно удаляет все временные файлы экспорта."""
     try:
-        temp_dir = "temp_exports"
+        temp_dir = EXPORT_DIR
         if os.path.exists(temp_dir):
             for file in os.listdir(temp_dir):
                 file_path = os.path.join(temp_dir, file)
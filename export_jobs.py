@@ -0,0 +1,157 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from config import logger
+from db import (
+    create_export_job, set_export_job_message, get_export_job, start_export_job,
+    update_export_job_progress, finish_export_job, cancel_export_job, recover_export_jobs,
+    release_connection
+)
+from excel_export import ExportCanceled, export_database, export_database_delta
+
+
+# --- Фоновые задачи экспорта ---
+# Задача хранится в таблице export_jobs, сам экспорт (pandas, openpyxl)
+# выполняется в отдельном процессе и не держит GIL процесса бота.
+# Дочерний процесс пишет прогресс в строку задачи и там же видит запрос
+# отмены, а родитель периодически читает строку и обновляет сообщение админу.
+EXPORT_PROCESSES = 1
+PROGRESS_WRITE_INTERVAL = 1.0  # секунд между записями прогресса из дочернего процесса
+PROGRESS_POLL_INTERVAL = 3.0  # секунд между правками сообщения о прогрессе
+
+
+def export_job_kind(incremental, export_format):
+    return f"{'delta' if incremental else 'full'}:{export_format}"
+
+
+def run_export_job(job_id, incremental, export_format):
+    """Выполняется в дочернем процессе. Возвращает (status, filename, watermarks, error)."""
+    if not start_export_job(job_id):
+        return 'canceled', None, None, None
+
+    last_write = [0.0]
+
+    def report_progress(title, done, total):
+        now = time.monotonic()
+        if now - last_write[0] < PROGRESS_WRITE_INTERVAL and done < total:
+            return
+        last_write[0] = now
+        percent = done * 100 // total if total else 100
+        if update_export_job_progress(job_id, f"{title} — {done}/{total} ({percent}%)"):
+            raise ExportCanceled()
+
+    watermarks = None
+    try:
+        if incremental:
+            filename, watermarks = export_database_delta(export_format, progress_callback=report_progress)
+        else:
+            filename = export_database(export_format, progress_callback=report_progress)
+    except ExportCanceled:
+        finish_export_job(job_id, 'canceled')
+        return 'canceled', None, None, None
+
+    if not filename:
+        finish_export_job(job_id, 'failed', error='Не удалось создать файл экспорта')
+        return 'failed', None, None, 'Не удалось создать файл экспорта'
+
+    # Статус 'done' выставляет родитель после отправки файла
+    update_export_job_progress(job_id, 'Файл готов, отправляю...')
+    return 'exported', filename, watermarks, None
+
+
+class ExportJobs:
+    """Очередь задач экспорта поверх пула процессов."""
+
+    def __init__(self, on_progress, on_finished, processes=EXPORT_PROCESSES, poll_interval=PROGRESS_POLL_INTERVAL):
+        # on_progress(job) — периодически, пока задача выполняется;
+        # on_finished(job, status, filename, watermarks, error) — по завершении
+        self.on_progress = on_progress
+        self.on_finished = on_finished
+        self.processes = processes
+        self.poll_interval = poll_interval
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Закрывает задачи, прерванные прошлым перезапуском."""
+        interrupted = recover_export_jobs()
+        if interrupted:
+            logger.warning(f"Прервано перезапуском задач экспорта: {interrupted}")
+        return interrupted
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn: дочерний процесс не наследует соединения с БД и потоки бота
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._executor
+
+    def submit(self, chat_id, reply_to_message_id, incremental, export_format, send_progress_message):
+        """Ставит экспорт в очередь. Возвращает (job_id, created).
+
+        send_progress_message(job_id) отправляет сообщение о прогрессе и
+        возвращает его message_id; вызывается только для новой задачи.
+        """
+        job_id, created = create_export_job(
+            export_job_kind(incremental, export_format), chat_id, reply_to_message_id
+        )
+        if not created:
+            return job_id, False
+
+        try:
+            set_export_job_message(job_id, send_progress_message(job_id))
+            future = self._get_executor().submit(run_export_job, job_id, incremental, export_format)
+        except Exception as e:
+            finish_export_job(job_id, 'failed', error=str(e))
+            raise
+
+        threading.Thread(
+            target=self._watch, args=(job_id, future), name=f'export-job-{job_id}', daemon=True
+        ).start()
+        return job_id, True
+
+    def cancel(self, job_id):
+        """Запрашивает отмену. Возвращает статус задачи после запроса."""
+        return cancel_export_job(job_id)
+
+    def _watch(self, job_id, future):
+        try:
+            self._watch_job(job_id, future)
+        finally:
+            # Поток живет только до конца задачи: закрываем его соединение с БД
+            release_connection()
+
+    def _watch_job(self, job_id, future):
+        last_progress = None
+        while True:
+            try:
+                status, filename, watermarks, error = future.result(timeout=self.poll_interval)
+                break
+            except TimeoutError:
+                job = get_export_job(job_id)
+                if job and job['progress'] and job['progress'] != last_progress:
+                    last_progress = job['progress']
+                    try:
+                        self.on_progress(job)
+                    except Exception as e:
+                        logger.warning(f"Не удалось обновить прогресс экспорта {job_id}: {e}")
+            except Exception as e:
+                logger.error(f"Ошибка процесса экспорта {job_id}: {e}")
+                finish_export_job(job_id, 'failed', error=str(e))
+                status, filename, watermarks, error = 'failed', None, None, str(e)
+                break
+
+        job = get_export_job(job_id)
+        try:
+            self.on_finished(job, status, filename, watermarks, error)
+            if status == 'exported':
+                finish_export_job(job_id, 'done', filename=filename)
+        except Exception as e:
+            logger.error(f"Ошибка завершения задачи экспорта {job_id}: {e}")
+            if status == 'exported':
+                finish_export_job(job_id, 'failed', filename=filename, error=str(e))
@@ -1,14 +1,27 @@
 import json
 import os
+import threading
 import config
-import requests
+import http_client
+from admin_notifier import admin_notifier
 
 from config import (
     FRAGMENT_API_URL, FRAGMENT_API_KEY, FRAGMENT_PHONE,
     FRAGMENT_MNEMONICS, TOKEN_FILE, logger
 )
 
+# Заказ звезд ждет ответа блокчейна, поэтому таймаут чтения больше обычного
+FRAGMENT_ORDER_TIMEOUT = (5, 90)
+
 _bot_instance = None
+_bot_identity = None
+_bot_identity_lock = threading.Lock()
+
+
+def register_bot(bot_instance):
+    """Регистрирует основной экземпляр бота, чтобы модули не создавали свой."""
+    global _bot_instance
+    _bot_instance = bot_instance
 
 
 def get_bot():
@@ -18,6 +31,33 @@ def get_bot():
         _bot_instance = telebot.TeleBot(config.BOT_TOKEN)
     return _bot_instance
 
+
+def refresh_bot_identity():
+    """Запрашивает getMe и обновляет кэш данных бота."""
+    global _bot_identity
+    bot = get_bot()
+    if not bot:
+        return None
+    identity = bot.get_me()
+    with _bot_identity_lock:
+        _bot_identity = identity
+    logger.info(f"✅ Данные бота обновлены: @{identity.username}")
+    return identity
+
+
+def get_bot_identity():
+    """Возвращает закэшированный результат getMe (запрашивает его только при первом вызове)."""
+    with _bot_identity_lock:
+        identity = _bot_identity
+    if identity is None:
+        identity = refresh_bot_identity()
+    return identity
+
+
+def get_bot_username():
+    identity = get_bot_identity()
+    return identity.username if identity else None
+
 
 def load_fragment_token():
     if os.path.exists(TOKEN_FILE):
@@ -51,7 +91,7 @@ def authenticate_fragment():
             "mnemonics": mnemonics_list,
             "version": "V4R2"
         }
-        res = requests.post(f"{FRAGMENT_API_URL}/auth/authenticate/", json=payload)
+        res = http_client.post(f"{FRAGMENT_API_URL}/auth/authenticate/", json=payload)
         if res.status_code == 200:
             token = res.json().get("token")
             save_fragment_token(token)
@@ -65,6 +105,7 @@ def authenticate_fragment():
 
 
 def send_stars(token, username, quantity):
+    """Заказывает звезды. Возвращает (True/False/None, сообщение); None — исход неизвестен."""
     try:
         data = {
             "username": username,
@@ -77,25 +118,32 @@ def send_stars(token, username, quantity):
         }
 
         logger.info(f"🔄 Отправка {quantity} ⭐ пользователю @{username}...")
-        res = requests.post(f"{FRAGMENT_API_URL}/order/stars/", json=data, headers=headers)
+        # Без повторов: повторный заказ может отправить звезды дважды
+        res = http_client.post(
+            f"{FRAGMENT_API_URL}/order/stars/",
+            json=data,
+            headers=headers,
+            retries=0,
+            timeout=FRAGMENT_ORDER_TIMEOUT
+        )
 
-        bot = get_bot()
         if res.status_code == 200:
-            if bot:
-                bot.send_message(config.ADMIN_ID, f"✅ Отправлены {quantity} ⭐ пользователю @{username}...")
+            admin_notifier.notify(f"✅ Отправлены {quantity} ⭐ пользователю @{username}")
             logger.info("✅ Звезды успешно отправлены!")
             return True, "Успешно"
         else:
-            if bot:
-                bot.send_message(
-                    config.ADMIN_ID,
-                    f"❌ Ошибка отправки {quantity} ⭐ пользователю @{username}. \n\nТекст ошибки: {res.text}"
-                )
+            admin_notifier.error(
+                f"❌ Ошибка отправки {quantity} ⭐ пользователю @{username}. \n\nТекст ошибки: {res.text}"
+            )
             error_msg = f"❌ Ошибка отправки: {res.text}"
             logger.error(error_msg)
             return False, res.text
 
     except Exception as e:
+        if http_client.request_may_have_reached_server(e):
+            # Заказ мог быть выполнен: нельзя считать отправку неудачной и возвращать средства
+            logger.error(f"❓ Исход заказа {quantity} ⭐ для @{username} неизвестен: {e!r}")
+            return None, str(e)
         error_msg = f"❌ Исключение при отправке: {e}"
         logger.error(error_msg)
         return False, str(e)
@@ -0,0 +1,187 @@
+import asyncio
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from config import logger
+
+
+# --- Общий HTTP-клиент для внешних API (Fragment, ЮKassa, TON, CoinGecko) ---
+# На каждый хост держится своя requests.Session с пулом keep-alive соединений,
+# поэтому повторные запросы не платят за новый TCP+TLS handshake.
+# Фоновые задачи в event loop используют async_request поверх общей
+# aiohttp-сессии с теми же повторами и метриками.
+DEFAULT_TIMEOUT = (5, 30)  # (connect, read) в секундах
+POOL_MAXSIZE = 10
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8.0
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def _host_of(url):
+    return urlsplit(url).netloc
+
+
+def get_session(host):
+    """Возвращает пулированную сессию для хоста (создает ее при первом обращении)."""
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[host] = session
+        return session
+
+
+def _record(host, elapsed, error=False, retried=False):
+    with _metrics_lock:
+        stats = _metrics.setdefault(host, {
+            'requests': 0,
+            'errors': 0,
+            'retries': 0,
+            'total_ms': 0.0,
+            'max_ms': 0.0,
+            'last_ms': 0.0
+        })
+        elapsed_ms = elapsed * 1000
+        stats['requests'] += 1
+        stats['total_ms'] += elapsed_ms
+        stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+        stats['last_ms'] = elapsed_ms
+        if error:
+            stats['errors'] += 1
+        if retried:
+            stats['retries'] += 1
+
+
+def get_metrics():
+    """Возвращает метрики задержек по хостам (количество, ошибки, средняя/максимальная задержка)."""
+    with _metrics_lock:
+        result = {}
+        for host, stats in _metrics.items():
+            result[host] = dict(stats)
+            result[host]['avg_ms'] = stats['total_ms'] / stats['requests'] if stats['requests'] else 0.0
+        return result
+
+
+def _backoff_delay(attempt, retry_after=None):
+    if retry_after is not None:
+        return min(float(retry_after), BACKOFF_MAX)
+    # "Full jitter": случайная задержка в пределах экспоненциального окна
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+def request(method, url, retries=2, timeout=DEFAULT_TIMEOUT, **kwargs):
+    """Выполняет HTTP-запрос через пулированную сессию хоста.
+
+    Повторяет запрос при сетевых ошибках и статусах из RETRY_STATUSES
+    (с экспоненциальной задержкой и джиттером). Возвращает последний ответ
+    или пробрасывает последнее исключение requests.
+    Для неидемпотентных запросов передавайте retries=0.
+    """
+    host = _host_of(url)
+    session = get_session(host)
+
+    for attempt in range(retries + 1):
+        started = time.monotonic()
+        try:
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            _record(host, time.monotonic() - started, error=True, retried=attempt > 0)
+            if attempt >= retries:
+                raise
+            delay = _backoff_delay(attempt)
+            logger.warning(f"HTTP {method} {host}: {e}. Повтор через {delay:.1f} с")
+            time.sleep(delay)
+            continue
+
+        failed = response.status_code in RETRY_STATUSES
+        _record(host, time.monotonic() - started, error=failed, retried=attempt > 0)
+        if not failed or attempt >= retries:
+            return response
+
+        retry_after = response.headers.get('Retry-After')
+        try:
+            delay = _backoff_delay(attempt, retry_after)
+        except ValueError:
+            delay = _backoff_delay(attempt)
+        logger.warning(f"HTTP {method} {host}: статус {response.status_code}. Повтор через {delay:.1f} с")
+        time.sleep(delay)
+
+
+def request_may_have_reached_server(error):
+    """Мог ли запрос, завершившийся исключением requests, дойти до сервера.
+
+    Ошибка установки соединения (таймаут подключения, отказ, DNS) значит,
+    что запрос не отправлен. Таймаут чтения или разрыв соединения после
+    отправки — исход неизвестен: сервер мог выполнить запрос.
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return False
+    if isinstance(error, requests.exceptions.ConnectionError):
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return not isinstance(reason, NewConnectionError)
+    return isinstance(error, requests.exceptions.Timeout)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+async def async_request(session, method, url, retries=2, timeout=DEFAULT_TIMEOUT, **kwargs):
+    """Асинхронный вариант request() поверх aiohttp.ClientSession.
+
+    Возвращает (status, body): body — разобранный JSON, если ответ в JSON,
+    иначе текст. Сетевые ошибки после всех повторов пробрасываются.
+    """
+    host = _host_of(url)
+    connect_timeout, read_timeout = timeout
+    client_timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+
+    for attempt in range(retries + 1):
+        started = time.monotonic()
+        try:
+            async with session.request(method, url, timeout=client_timeout, **kwargs) as response:
+                status = response.status
+                retry_after = response.headers.get('Retry-After')
+                if response.content_type == 'application/json':
+                    body = await response.json()
+                else:
+                    body = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            _record(host, time.monotonic() - started, error=True, retried=attempt > 0)
+            if attempt >= retries:
+                raise
+            delay = _backoff_delay(attempt)
+            logger.warning(f"HTTP {method} {host}: {e!r}. Повтор через {delay:.1f} с")
+            await asyncio.sleep(delay)
+            continue
+
+        failed = status in RETRY_STATUSES
+        _record(host, time.monotonic() - started, error=failed, retried=attempt > 0)
+        if not failed or attempt >= retries:
+            return status, body
+
+        try:
+            delay = _backoff_delay(attempt, retry_after)
+        except ValueError:
+            delay = _backoff_delay(attempt)
+        logger.warning(f"HTTP {method} {host}: статус {status}. Повтор через {delay:.1f} с")
+        await asyncio.sleep(delay)
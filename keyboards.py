@@ -5,6 +5,7 @@ from telebot.types import *
 import config
 from config import *
 from db import *
+from pricing import quotes
 
 
 def main_menu_keyboard(user_id=None):
@@ -42,17 +43,8 @@ def buy_stars_options_keyboard():
 def buy_stars_quantity_keyboard(user_data):
     keyboard = InlineKeyboardMarkup()
 
-    # Получаем актуальную цену из БД
-    star_price = get_star_price()
-
-    options = [
-        (50, f"50 звезд - {star_price * 50:.2f} руб"),
-        (100, f"100 звезд - {star_price * 100:.2f} руб"),
-        (500, f"500 звезд - {star_price * 500:.2f} руб"),
-        (1000, f"1000 звезд - {star_price * 1000:.2f} руб")
-    ]
-
-    for stars, text in options:
+    # Цены и подписи пакетов берем из текущего снимка котировок
+    for stars, _, text in quotes.current().packages:
         keyboard.row(InlineKeyboardButton(text, callback_data=f'buy_{stars}'))
 
     keyboard.row(InlineKeyboardButton("✍️ Другое количество", callback_data='buy_custom'))
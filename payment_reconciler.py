@@ -0,0 +1,129 @@
+import asyncio
+import time
+
+from config import logger
+from db import get_pending_payments_page, count_pending_payments, settle_payments_batch
+from yookassa import check_payment_status, get_paid_amount, is_underpaid, AMOUNT_MISMATCH, PAYMENT_NOT_FOUND
+
+
+# --- Фоновая сверка ожидающих платежей ЮKassa ---
+# Подбирает платежи, по которым не пришло webhook-уведомление: постранично
+# читает 'pending' строки, параллельно (но с ограничением) запрашивает их
+# статус и закрывает пачку одной транзакцией.
+RECONCILE_INTERVAL = 300  # секунд между проходами
+PAGE_SIZE = 100
+MAX_CONCURRENCY = 5
+MAX_REQUESTS_PER_SECOND = 5.0
+MIN_PAYMENT_AGE = 120  # свежие платежи оставляем webhook-уведомлениям
+STALE_PAYMENT_AGE = 48 * 3600  # после этого неизвестный ЮKassa (404) платеж считается просроченным
+FINAL_STATUSES = ('succeeded', 'canceled')
+
+
+class RateLimiter:
+    """Разносит запросы во времени: не больше rate запросов в секунду."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._lock = asyncio.Lock()
+        self._next_at = 0.0
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_at - now
+            self._next_at = max(now, self._next_at) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class PaymentReconciler:
+    """Периодическая сверка ожидающих платежей с API ЮKassa.
+
+    reconcile_once регистрируется в BackgroundRuntime с интервалом RECONCILE_INTERVAL.
+    """
+
+    def __init__(self, on_settled=None, concurrency=MAX_CONCURRENCY, rate=MAX_REQUESTS_PER_SECOND):
+        # on_settled(payment) вызывается для каждого платежа после фиксации транзакции
+        self.on_settled = on_settled
+        self.concurrency = concurrency
+        self.rate = rate
+        self.last_run = {}
+        self.total_checked = 0
+        self.total_settled = 0
+
+    async def _check(self, payment, semaphore, limiter):
+        async with semaphore:
+            await limiter.wait()
+            info = await asyncio.to_thread(check_payment_status, payment['yookassa_id'])
+
+        if not info:
+            # Ошибка запроса (сеть, 5xx, нет учетных данных) ничего не говорит о платеже — повторим позже
+            return None
+
+        status = info.get('status')
+        if status == PAYMENT_NOT_FOUND:
+            if payment['age_seconds'] >= STALE_PAYMENT_AGE:
+                return payment['yookassa_id'], 'expired'
+            return None
+        if status not in FINAL_STATUSES:
+            return None
+        if status == 'succeeded' and is_underpaid(info, payment['amount']):
+            logger.error(
+                f"Сумма платежа {payment['yookassa_id']} не совпадает: {get_paid_amount(info)} < {payment['amount']}"
+            )
+            return payment['yookassa_id'], AMOUNT_MISMATCH
+        return payment['yookassa_id'], status
+
+    async def reconcile_once(self):
+        """Один проход по всем ожидающим платежам. Возвращает метрики прохода."""
+        started = time.monotonic()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        limiter = RateLimiter(self.rate)
+        checked = 0
+        settled_count = 0
+        after_id = 0
+
+        while True:
+            page = await asyncio.to_thread(get_pending_payments_page, after_id, PAGE_SIZE, MIN_PAYMENT_AGE)
+            if not page:
+                break
+            after_id = page[-1]['id']
+
+            results = await asyncio.gather(*(self._check(payment, semaphore, limiter) for payment in page))
+            checked += len(page)
+            updates = [result for result in results if result]
+            if not updates:
+                continue
+
+            settled = await asyncio.to_thread(settle_payments_batch, updates)
+            settled_count += len(settled)
+            if self.on_settled:
+                for payment in settled:
+                    try:
+                        # Уведомления блокирующие (telebot) — не держим ими event loop
+                        await asyncio.to_thread(self.on_settled, payment)
+                    except Exception as e:
+                        logger.error(f"Ошибка уведомления о платеже {payment['yookassa_id']}: {e}")
+
+        elapsed = time.monotonic() - started
+        self.total_checked += checked
+        self.total_settled += settled_count
+        self.last_run = {
+            'checked': checked,
+            'settled': settled_count,
+            'duration': elapsed,
+            'throughput': checked / elapsed if elapsed > 0 else 0.0,
+            'backlog': await asyncio.to_thread(count_pending_payments)
+        }
+        if checked:
+            logger.info(
+                f"Сверка платежей: проверено {checked}, закрыто {settled_count}, "
+                f"{self.last_run['throughput']:.1f} платежей/с, в ожидании {self.last_run['backlog']}"
+            )
+        return self.last_run
+
+    def stats(self):
+        stats = dict(self.last_run)
+        stats['total_checked'] = self.total_checked
+        stats['total_settled'] = self.total_settled
+        return stats
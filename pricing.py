@@ -0,0 +1,165 @@
+import threading
+
+import config
+from config import logger
+from db import settings_cache
+
+
+# --- Котировки ---
+# Цена звезды, курс USD/RUB, курс TON/RUB и скидки за объем собираются в
+# неизменяемый снимок с номером версии. Снимок пересобирается только когда
+# меняется хотя бы одно из значений: цены пакетов, подписи кнопок и
+# коэффициенты пересчета считаются один раз, а калькулятор, клавиатуры и
+# покупка берут их из одного снимка.
+STAR_PRICE_TIERS_KEY = 'star_price_tiers'
+PACKAGE_SIZES = (50, 100, 500, 1000)
+
+
+def parse_tiers(raw):
+    """'500:3,1000:5' -> ((500, 3.0), (1000, 5.0)): от скольких звезд какая скидка в процентах."""
+    tiers = []
+    for part in (raw or '').replace(' ', '').split(','):
+        if not part:
+            continue
+        min_stars, discount = part.split(':')
+        min_stars, discount = int(min_stars), float(discount)
+        if min_stars < 1 or not 0 < discount < 100:
+            raise ValueError(f"Некорректная ступень скидки: {part}")
+        tiers.append((min_stars, discount))
+    return tuple(sorted(tiers))
+
+
+def format_tiers(tiers):
+    return ','.join(f"{min_stars}:{discount:g}" for min_stars, discount in tiers)
+
+
+def get_price_tiers():
+    return _parse_tiers_setting(settings_cache.get(STAR_PRICE_TIERS_KEY, ''))
+
+
+def _parse_tiers_setting(raw):
+    try:
+        return parse_tiers(raw)
+    except ValueError as e:
+        logger.error(f"Скидки за объем в настройках не применены ('{raw}'): {e}")
+        return ()
+
+
+def set_price_tiers(tiers):
+    settings_cache.set(STAR_PRICE_TIERS_KEY, format_tiers(tiers))
+
+
+class QuoteSnapshot:
+    """Неизменяемый набор цен и коэффициентов одной версии."""
+
+    def __init__(self, version, star_price, usd_rate, ton_rate, tiers):
+        self.version = version
+        self.star_price = star_price
+        self.usd_rate = usd_rate if usd_rate and usd_rate > 0 else None
+        self.ton_rate = ton_rate if ton_rate and ton_rate > 0 else None
+        self.tiers = tiers
+        # Ступени от крупной к мелкой: (от скольких звезд, цена звезды, скидка)
+        self._unit_prices = tuple(
+            (min_stars, star_price * (1 - discount / 100), discount) for min_stars, discount in reversed(tiers)
+        ) + ((0, star_price, 0.0),)
+        self.packages = tuple(self._package(stars) for stars in PACKAGE_SIZES)
+
+    def _package(self, stars):
+        cost = self.star_cost(stars)
+        discount = self._tier(stars)[2]
+        label = f"{stars} звезд - {cost:.2f} руб" + (f" (-{discount:g}%)" if discount else "")
+        return stars, cost, label
+
+    def _tier(self, stars):
+        for tier in self._unit_prices:
+            if stars >= tier[0]:
+                return tier
+
+    def unit_price(self, stars):
+        """Цена одной звезды при покупке stars звезд (с учетом скидки за объем)."""
+        return self._tier(stars)[1]
+
+    def star_cost(self, stars):
+        """Стоимость покупки в рублях (то, что списывается с баланса)."""
+        return round(stars * self.unit_price(stars), 2)
+
+    def stars_for_rub(self, rub):
+        """Сколько звезд можно купить на rub рублей."""
+        # Берем самую выгодную ступень, до которой дотягивает сумма
+        for min_stars, price, _ in self._unit_prices:
+            stars = rub / price
+            if stars >= min_stars:
+                return stars
+
+    def to_usd(self, rub):
+        return rub / self.usd_rate if self.usd_rate else None
+
+    def convert(self, amount, source, target):
+        """Пересчет между rub/stars/ton. Возвращает (результат, цена звезды) или None без курса TON."""
+        if 'ton' in (source, target) and not self.ton_rate:
+            return None
+
+        if source == 'rub':
+            rub = amount
+        elif source == 'stars':
+            rub = amount * self.unit_price(amount)
+        else:
+            rub = amount * self.ton_rate
+
+        if target == 'rub':
+            result = rub
+        elif target == 'stars':
+            result = self.stars_for_rub(rub)
+        else:
+            result = rub / self.ton_rate
+
+        stars = amount if source == 'stars' else result if target == 'stars' else None
+        return result, (self.unit_price(stars) if stars is not None else self.star_price)
+
+
+class QuoteEngine:
+    """Выдает актуальный снимок котировок, пересобирая его при изменении входных данных."""
+
+    def __init__(self, ton_rate_func=None):
+        # ton_rate_func() -> курс TON/RUB или None; должен отвечать без сетевых запросов
+        self.ton_rate_func = ton_rate_func
+        self._state = (None, None)  # (входные данные, снимок) — заменяется целиком
+        self._lock = threading.Lock()
+        self.rebuilds = 0
+
+    def set_ton_rate_func(self, ton_rate_func):
+        self.ton_rate_func = ton_rate_func
+
+    def _read_inputs(self):
+        return (
+            settings_cache.get_float('star_price', config.STAR_PRICE),
+            settings_cache.get_float('usd_rub_rate', config.USD_RUB_RATE),
+            self.ton_rate_func() if self.ton_rate_func else None,
+            settings_cache.get(STAR_PRICE_TIERS_KEY, '')
+        )
+
+    def current(self):
+        """Актуальный снимок. Без изменений на входе — без пересчета."""
+        inputs = self._read_inputs()
+        cached_inputs, snapshot = self._state
+        if snapshot is not None and inputs == cached_inputs:
+            return snapshot
+
+        with self._lock:
+            cached_inputs, snapshot = self._state
+            if snapshot is None or inputs != cached_inputs:
+                star_price, usd_rate, ton_rate, raw_tiers = inputs
+                snapshot = QuoteSnapshot(
+                    snapshot.version + 1 if snapshot else 1,
+                    star_price, usd_rate, ton_rate, _parse_tiers_setting(raw_tiers)
+                )
+                self._state = (inputs, snapshot)
+                self.rebuilds += 1
+            return snapshot
+
+    def stats(self):
+        snapshot = self._state[1]
+        return {'version': snapshot.version if snapshot else None, 'rebuilds': self.rebuilds}
+
+
+quotes = QuoteEngine()
@@ -0,0 +1,168 @@
+import asyncio
+import statistics
+import threading
+import time
+from datetime import datetime
+
+import http_client
+from config import logger
+from db import get_ton_rate, get_ton_rate_updated_at, save_ton_rate_sample
+
+
+# --- Курс TON/RUB ---
+# Обработчики читают курс из памяти и никогда не ждут внешние API. Курс
+# обновляется периодической задачей фонового runtime; если он старше
+# RATE_TTL (например, задача несколько раз не смогла обновить его), чтение
+# возвращает имеющееся значение и ставит обновление в фон
+# (stale-while-revalidate). Источники опрашиваются параллельно, итоговый
+# курс — медиана ответивших; каждое обновление пишется в rate_history.
+RATE_TTL = 600  # секунд
+REVALIDATE_MIN_GAP = 30  # не чаще одного внепланового обновления за столько секунд
+PROVIDER_TIMEOUT = (5, 5)
+MAX_SPREAD = 0.05  # расхождение источников, о котором стоит предупредить
+
+
+class RateProvider:
+    """Источник курса: url и разбор ответа в курс TON/RUB (или None)."""
+
+    def __init__(self, name, url, parse):
+        self.name = name
+        self.url = url
+        self.parse = parse
+        self.errors = 0
+        self.last_rate = None
+
+    async def fetch(self, session):
+        try:
+            status, data = await http_client.async_request(session, 'GET', self.url, timeout=PROVIDER_TIMEOUT)
+            rate = self.parse(data) if status == 200 and isinstance(data, dict) else None
+        except Exception as e:
+            logger.error(f"Ошибка получения курса TON от {self.name}: {e!r}")
+            rate = None
+        if rate is None or rate <= 0:
+            self.errors += 1
+            return None
+        self.last_rate = rate
+        return rate
+
+
+def _positive_float(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value > 0 else None
+
+
+def parse_coingecko(data):
+    return _positive_float(data.get('the-open-network', {}).get('rub'))
+
+
+def parse_cryptocompare(data):
+    return _positive_float(data.get('RUB'))
+
+
+DEFAULT_PROVIDERS = (
+    ('coingecko', 'https://api.coingecko.com/api/v3/simple/price?ids=the-open-network&vs_currencies=rub',
+     parse_coingecko),
+    ('cryptocompare', 'https://min-api.cryptocompare.com/data/price?fsym=TON&tsyms=RUB', parse_cryptocompare),
+)
+
+
+class TonRateService:
+    """Курс TON/RUB в памяти с фоновым обновлением из нескольких источников."""
+
+    def __init__(self, runtime, providers=None, ttl=RATE_TTL, save=save_ton_rate_sample):
+        self.runtime = runtime
+        self.providers = providers or [RateProvider(*spec) for spec in DEFAULT_PROVIDERS]
+        self.ttl = ttl
+        self.save = save
+        # (курс, время обновления datetime) — заменяется целиком, читается без блокировок
+        self._snapshot = (None, None)
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._last_attempt = 0.0
+        self.refreshes = 0
+        self.failures = 0
+        self.stale_reads = 0
+
+    def load(self):
+        """Поднимает последний сохраненный курс из БД (при старте, до первого обновления)."""
+        rate, updated_at = get_ton_rate(), get_ton_rate_updated_at()
+        try:
+            self._snapshot = (
+                float(rate) if rate else None,
+                datetime.fromisoformat(updated_at) if updated_at else None
+            )
+        except ValueError:
+            logger.error(f"Некорректный курс TON в БД: {rate} ({updated_at})")
+            self._snapshot = (None, None)
+        return self._snapshot[0]
+
+    def get(self):
+        """Текущий курс TON/RUB или None. Не блокируется: устаревший курс обновляется в фоне."""
+        rate, updated_at = self._snapshot
+        if updated_at is None or (datetime.now() - updated_at).total_seconds() >= self.ttl:
+            self.stale_reads += 1
+            self._revalidate()
+        return rate
+
+    def updated_at(self):
+        return self._snapshot[1]
+
+    def _revalidate(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._refreshing or now - self._last_attempt < REVALIDATE_MIN_GAP or self.runtime.loop is None:
+                return
+            self._last_attempt = now
+        self.runtime.submit(self.refresh())
+
+    async def refresh(self):
+        """Опрашивает источники и сохраняет медиану. Возвращает новый курс или None."""
+        with self._lock:
+            if self._refreshing:
+                return None
+            self._refreshing = True
+            self._last_attempt = time.monotonic()
+        try:
+            results = await asyncio.gather(*(provider.fetch(self.runtime.http) for provider in self.providers))
+            sources = {provider.name: rate for provider, rate in zip(self.providers, results) if rate is not None}
+            if not sources:
+                self.failures += 1
+                logger.warning("❌ Не удалось обновить курс TON: ни один источник не ответил")
+                return None
+
+            rate = round(statistics.median(sources.values()), 4)
+            spread = (max(sources.values()) - min(sources.values())) / rate
+            if spread > MAX_SPREAD:
+                logger.warning(f"Источники курса TON расходятся на {spread:.1%}: {sources}")
+
+            updated_at = datetime.now()
+            await self.runtime.run_blocking(self.save, rate, sources, updated_at.isoformat())
+            self._snapshot = (rate, updated_at)
+            self.refreshes += 1
+            logger.info(f"🔄 Курс TON обновлен: {rate:.2f} RUB (источники: {', '.join(sources)})")
+            return rate
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    async def run_job(self):
+        """Периодическая задача runtime."""
+        await self.refresh()
+
+    def stats(self):
+        rate, updated_at = self._snapshot
+        return {
+            'rate': rate,
+            'updated_at': updated_at,
+            'age': (datetime.now() - updated_at).total_seconds() if updated_at else None,
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+            'stale_reads': self.stale_reads,
+            'providers': {
+                provider.name: {'last_rate': provider.last_rate, 'errors': provider.errors}
+                for provider in self.providers
+            }
+        }
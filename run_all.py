@@ -2,6 +2,7 @@ import threading
 
 from api_server import run_api_server
 from bot import main
+from config import BOT_MODE
 
 
 def start_api_thread():
@@ -11,5 +12,7 @@ def start_api_thread():
 
 
 if __name__ == "__main__":
-    start_api_thread()
+    # В режиме webhook main() сам запускает API-сервер в основном потоке
+    if BOT_MODE != "webhook":
+        start_api_thread()
     main()
@@ -0,0 +1,241 @@
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from telebot import apihelper
+
+import http_client
+from config import logger
+
+
+# --- Ограничитель исходящих запросов к Telegram ---
+# Все вызовы Bot API проходят через apihelper.CUSTOM_REQUEST_SENDER, поэтому
+# лимиты соблюдаются и для обработчиков, и для фоновых потоков, и для
+# fragment_api/api_server, без правок в местах вызова.
+# Отправка и правка сообщений берут токен из общего ведра (~30/с) и из ведра
+# своего чата. Ожидающие запросы обслуживаются по полосам: пользовательские
+# раньше уведомлений админу. Ответ 429 приостанавливает чат на retry_after.
+GLOBAL_RATE = 30.0  # сообщений в секунду на бота
+GLOBAL_BURST = 30
+CHAT_RATE = 1.0  # сообщений в секунду в один чат
+CHAT_BURST = 3
+MAX_RETRIES_ON_429 = 3
+MAX_RETRY_AFTER = 60
+CHAT_BUCKETS_LIMIT = 10000  # простаивающие ведра чатов удаляются сверх этого количества
+
+LANE_USER = 0
+LANE_ADMIN = 1
+LANE_NAMES = {LANE_USER: 'user', LANE_ADMIN: 'admin'}
+
+# Методы, на которые действуют лимиты сообщений Telegram
+RATE_LIMITED_METHODS = {
+    'sendMessage', 'sendPhoto', 'sendDocument', 'sendMediaGroup', 'sendInvoice',
+    'copyMessage', 'forwardMessage',
+    'editMessageText', 'editMessageCaption', 'editMessageMedia', 'editMessageReplyMarkup'
+}
+
+_context = threading.local()
+
+
+@contextmanager
+def admin_lane():
+    """Запросы внутри блока идут в полосу уведомлений админу (с низким приоритетом)."""
+    previous = getattr(_context, 'lane', LANE_USER)
+    _context.lane = LANE_ADMIN
+    try:
+        yield
+    finally:
+        _context.lane = previous
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self, now):
+        """Через сколько секунд появится токен (0 — уже есть)."""
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, now, seconds):
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = 0.0
+
+
+class OutboundLimiter:
+    """Выдает разрешения на отправку с учетом общего лимита, лимита чата и полос."""
+
+    def __init__(self, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST,
+                 chat_rate=CHAT_RATE, chat_burst=CHAT_BURST):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats = {}
+        self._cond = threading.Condition()
+        self._waiting = []  # куча (lane, seq, chat_id)
+        self._seq = itertools.count()
+        self.sent = {lane: 0 for lane in LANE_NAMES}
+        self.delayed = {lane: 0 for lane in LANE_NAMES}
+        self.wait_total = {lane: 0.0 for lane in LANE_NAMES}
+        self.wait_max = {lane: 0.0 for lane in LANE_NAMES}
+        self.rate_limited = 0
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= CHAT_BUCKETS_LIMIT:
+                now = time.monotonic()
+                for key in [key for key, value in self._chats.items()
+                            if value.delay(now) == 0 and value.tokens >= value.capacity]:
+                    del self._chats[key]
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _outranked(self, ticket, now):
+        """Есть ли ожидающий запрос выше по очереди, который может уйти прямо сейчас."""
+        for other in self._waiting:
+            if other < ticket and (other[2] is None or self._chat_bucket(other[2]).delay(now) == 0):
+                return True
+        return False
+
+    def acquire(self, chat_id, lane=LANE_USER):
+        """Блокирует поток до получения разрешения на отправку."""
+        started = time.monotonic()
+        ticket = (lane, next(self._seq), chat_id)
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+                    wait = self._global.delay(now)
+                    if chat_bucket is not None:
+                        wait = max(wait, chat_bucket.delay(now))
+                    if wait == 0 and not self._outranked(ticket, now):
+                        self._global.take()
+                        if chat_bucket is not None:
+                            chat_bucket.take()
+                        break
+                    self._cond.wait(timeout=wait or 0.05)
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+            waited = time.monotonic() - started
+            self.sent[lane] += 1
+            if waited > 0.001:
+                self.delayed[lane] += 1
+            self.wait_total[lane] += waited
+            self.wait_max[lane] = max(self.wait_max[lane], waited)
+
+    def penalize(self, chat_id, seconds):
+        """Приостанавливает чат (или всю отправку, если чат неизвестен) после ответа 429."""
+        with self._cond:
+            now = time.monotonic()
+            self.rate_limited += 1
+            bucket = self._chat_bucket(chat_id) if chat_id is not None else self._global
+            bucket.block(now, seconds)
+            self._cond.notify_all()
+
+    def stats(self):
+        """Метрики насыщения: ожидающие по полосам, доля задержанных, среднее/максимальное ожидание."""
+        with self._cond:
+            now = time.monotonic()
+            waiting = {name: 0 for name in LANE_NAMES.values()}
+            for lane, _, _ in self._waiting:
+                waiting[LANE_NAMES[lane]] += 1
+            lanes = {}
+            for lane, name in LANE_NAMES.items():
+                sent = self.sent[lane]
+                lanes[name] = {
+                    'sent': sent,
+                    'waiting': waiting[name],
+                    'delayed': self.delayed[lane],
+                    'avg_wait': self.wait_total[lane] / sent if sent else 0.0,
+                    'max_wait': self.wait_max[lane]
+                }
+            self._global._refill(now)
+            return {
+                'lanes': lanes,
+                'global_tokens': self._global.tokens,
+                'throttled_chats': sum(1 for bucket in self._chats.values() if bucket.delay(now) > 0),
+                'rate_limited': self.rate_limited
+            }
+
+
+limiter = OutboundLimiter()
+
+
+def _chat_id_of(params):
+    if not params:
+        return None
+    chat_id = params.get('chat_id')
+    return str(chat_id) if chat_id is not None else None
+
+
+def _rewind_files(files):
+    # Повтор после 429 отправляет файлы заново — возвращаемся к началу
+    for value in (files or {}).values():
+        file = value[1] if isinstance(value, tuple) else value
+        if hasattr(file, 'seek'):
+            file.seek(0)
+
+
+def _retry_after(response):
+    try:
+        return int(response.json().get('parameters', {}).get('retry_after', 1))
+    except (ValueError, AttributeError):
+        return 1
+
+
+def send_request(method, url, params=None, files=None, timeout=None, proxies=None):
+    """Замена отправителя запросов telebot: лимиты + повтор после 429 по retry_after."""
+    method_name = url.rsplit('/', 1)[-1]
+    chat_id = _chat_id_of(params)
+    lane = getattr(_context, 'lane', LANE_USER)
+
+    for attempt in range(MAX_RETRIES_ON_429 + 1):
+        if method_name in RATE_LIMITED_METHODS:
+            limiter.acquire(chat_id, lane)
+        response = http_client.request(
+            method, url, retries=0, timeout=timeout, params=params, files=files, proxies=proxies
+        )
+        if response.status_code != 429 or attempt >= MAX_RETRIES_ON_429:
+            return response
+
+        retry_after = min(_retry_after(response), MAX_RETRY_AFTER)
+        logger.warning(f"Telegram 429 на {method_name} (чат {chat_id}): повтор через {retry_after} с")
+        limiter.penalize(chat_id, retry_after)
+        if method_name not in RATE_LIMITED_METHODS:
+            time.sleep(retry_after)
+        _rewind_files(files)
+
+
+def install():
+    """Направляет все запросы telebot через ограничитель."""
+    apihelper.CUSTOM_REQUEST_SENDER = send_request
+
+
+def get_stats():
+    return limiter.stats()
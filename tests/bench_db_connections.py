@@ -0,0 +1,92 @@
+"""Микробенчмарк пула соединений: соединение на каждый вызов против соединения потока.
+
+Запуск: python tests/bench_db_connections.py [число операций]
+Работает на временной БД и не трогает bot_database.db.
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+THREADS = 8
+THREAD_CYCLES = 500
+
+
+def get_user_per_call(user_id):
+    # Так работали функции db.py до пула: новое соединение на каждый вызов
+    conn = sqlite3.connect(db.DB_NAME)
+    cursor = conn.cursor()
+    cursor.execute(
+        'SELECT user_id, username, balance, internal_stars, tg_stars_balance, referrer_id, created_at '
+        'FROM users WHERE user_id = ?',
+        (user_id,)
+    )
+    user = cursor.fetchone()
+    conn.close()
+    return user
+
+
+def update_balance_per_call(user_id, amount):
+    conn = sqlite3.connect(db.DB_NAME)
+    cursor = conn.cursor()
+    cursor.execute('UPDATE users SET balance = ROUND(balance + ?, 2) WHERE user_id = ?', (amount, user_id))
+    conn.commit()
+    conn.close()
+
+
+def measure(func, operations):
+    started = time.perf_counter()
+    for index in range(operations):
+        func(index % 100 + 1)
+    return operations / (time.perf_counter() - started)
+
+
+def check_concurrent_updates():
+    """THREADS потоков одновременно пополняют баланс одного пользователя."""
+    before = db.get_user(1)['balance']
+
+    def worker():
+        try:
+            for _ in range(THREAD_CYCLES):
+                db.update_balance(1, 1)
+                db.get_user(1)
+        finally:
+            db.release_connection()
+
+    threads = [threading.Thread(target=worker) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return db.get_user(1)['balance'] - before, THREADS * THREAD_CYCLES
+
+
+def main(operations=5000):
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_NAME = os.path.join(tmp, 'bench.db')
+        db.init_db()
+        for user_id in range(1, 101):
+            db.create_user(user_id, f'user{user_id}')
+
+        rows = (
+            ('get_user', get_user_per_call, db.get_user),
+            ('update_balance', lambda user_id: update_balance_per_call(user_id, 1),
+             lambda user_id: db.update_balance(user_id, 1)),
+        )
+        for name, before, after in rows:
+            print(f"{name:<16}{measure(before, operations):>10.0f} -> {measure(after, operations):.0f} ops/s")
+
+        added, expected = check_concurrent_updates()
+        print(f"{THREADS} потоков x {THREAD_CYCLES}: пополнено {added:.0f} из {expected}, "
+              f"открытых соединений {db.get_open_connections_count()}")
+        db.close_connections()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,46 @@
+"""Бенчмарк листов 'Статистика' и 'Динамика' на синтетической БД.
+
+Запуск: python tests/bench_export_statistics.py [пользователей] [транзакций на пользователя]
+По умолчанию 300k пользователей и 3M транзакций. БД создается во временной папке.
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+from excel_export import generate_daily_series, generate_statistics  # noqa: E402
+from test_export_statistics import fill_database, legacy_generate_statistics  # noqa: E402
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+def main(users=300_000, transactions_per_user=10):
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_NAME = os.path.join(tmp, 'bench.db')
+        db.init_db()
+        conn = db.get_connection()
+        _, fill_time = timed(fill_database, conn, users, transactions_per_user, 2, 1)
+        print(f"БД: {users} пользователей, {users * transactions_per_user} транзакций, "
+              f"{users * 2} платежей ({fill_time:.1f} с)")
+
+        legacy, legacy_time = timed(legacy_generate_statistics, conn)
+        stats, stats_time = timed(generate_statistics, conn)
+        stats.pop('Дата экспорта', None)
+        same = list(stats) == list(legacy) and all(abs(float(stats[k]) - float(v)) < 0.005 for k, v in legacy.items())
+        print(f"generate_statistics: {legacy_time:.2f} с -> {stats_time:.2f} с, совпадает: {same}")
+
+        series, series_time = timed(generate_daily_series, conn)
+        print(f"generate_daily_series: {series_time:.2f} с, дней: {len(series)}")
+        db.close_connections()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,84 @@
+"""Скорость зачисления депозитов TON на синтетической ленте переводов.
+
+Запуск: python tests/bench_ton_ingest.py [депозитов] [пользователей]
+Сравнивает прежнее зачисление по одному депозиту (get_user, update_balance,
+add_transaction) с db.settle_ton_deposits и повторной обработкой той же ленты.
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+from ton_ingest import PAGE_SIZE  # noqa: E402
+
+
+def settle_per_deposit(deposits, last_lt):
+    # Зачисление до перехода на external_id: несколько запросов на каждый депозит
+    credited = []
+    with db.transaction():
+        for deposit in deposits:
+            user_data = db.get_user(deposit['user_id'])
+            if not user_data:
+                continue
+            db.update_balance(deposit['user_id'], deposit['rub_amount'])
+            db.add_transaction(
+                deposit['user_id'], deposit['rub_amount'], 'deposit_ton', 'completed',
+                target_user=f"{deposit['ton_amount']:.4f} TON"
+            )
+            credited.append(dict(deposit, balance=db.get_user(deposit['user_id'])['balance']))
+        db.set_setting('last_lt', last_lt)
+    return credited
+
+
+def synthetic_feed(count, users):
+    return [
+        {'lt': 1000 + index, 'hash': f'h{index}', 'user_id': index % users + 1,
+         'ton_amount': 1.5, 'rub_amount': 150.0}
+        for index in range(count)
+    ]
+
+
+def run(settle, feed):
+    started = time.perf_counter()
+    credited = 0
+    for start in range(0, len(feed), PAGE_SIZE):
+        page = feed[start:start + PAGE_SIZE]
+        credited += len(settle(page, page[-1]['lt']))
+    return credited, len(feed) / (time.perf_counter() - started)
+
+
+def fresh_db(tmp, name, users):
+    db.close_connections()
+    db.DB_NAME = os.path.join(tmp, name)
+    db.settings_cache.invalidate()
+    db.init_db()
+    with db.transaction() as conn:
+        conn.executemany(
+            'INSERT INTO users (user_id, username) VALUES (?, ?)',
+            ((user_id, f'user{user_id}') for user_id in range(1, users + 1))
+        )
+
+
+def main(count=20000, users=10000):
+    feed = synthetic_feed(count, users)
+    with tempfile.TemporaryDirectory() as tmp:
+        fresh_db(tmp, 'per_deposit.db', users)
+        credited, rate = run(settle_per_deposit, feed)
+        print(f"по одному депозиту: {rate:,.0f} депозитов/с (зачислено {credited})")
+
+        fresh_db(tmp, 'pages.db', users)
+        credited, rate = run(db.settle_ton_deposits, feed)
+        balance = db.get_connection().execute('SELECT SUM(balance) FROM users').fetchone()[0]
+        print(f"settle_ton_deposits: {rate:,.0f} депозитов/с (зачислено {credited})")
+
+        credited, rate = run(db.settle_ton_deposits, feed)
+        unchanged = db.get_connection().execute('SELECT SUM(balance) FROM users').fetchone()[0] == balance
+        print(f"повтор ленты: {rate:,.0f} депозитов/с (зачислено {credited}, балансы не изменились: {unchanged})")
+        db.close_connections()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
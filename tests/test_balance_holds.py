@@ -0,0 +1,81 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+
+class OpenBalanceHoldsTest(unittest.TestCase):
+    """Резервы с неизвестным исходом отправки видны в /holds и закрываются вручную."""
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self._db_name = db.DB_NAME
+        db.DB_NAME = os.path.join(self._tmp.name, 'test.db')
+        db.settings_cache.invalidate()
+        db.init_db()
+        db.create_user(1, 'user1')
+        db.update_balance(1, 1000)
+
+    def tearDown(self):
+        db.close_connections()
+        db.DB_NAME = self._db_name
+        db.settings_cache.invalidate()
+        self._tmp.cleanup()
+
+    def interrupted_hold(self, amount, age_minutes):
+        hold_id = db.reserve_balance(1, amount)
+        db.enqueue_delivery_job(1, 100, 200, 'target', 50, hold_id)
+        with db.transaction() as conn:
+            conn.execute(
+                "UPDATE balance_holds SET created_at = datetime('now', ?) WHERE id = ?",
+                (f'-{age_minutes} minutes', hold_id)
+            )
+            conn.execute("UPDATE delivery_jobs SET status = 'interrupted' WHERE hold_id = ?", (hold_id,))
+        return hold_id
+
+    def test_lists_only_old_open_holds(self):
+        old = self.interrupted_hold(100, 120)
+        fresh = self.interrupted_hold(50, 5)
+        released = self.interrupted_hold(30, 90)
+        db.release_balance_hold(released)
+
+        holds = db.get_open_balance_holds(30)
+        self.assertEqual([hold['id'] for hold in holds], [old])
+        self.assertEqual(holds[0]['job_status'], 'interrupted')
+        self.assertEqual(holds[0]['chat_id'], 100)
+        self.assertEqual(holds[0]['stars'], 50)
+        self.assertEqual({hold['id'] for hold in db.get_open_balance_holds(0)}, {old, fresh})
+        self.assertIsNone(db.get_open_balance_hold(released))
+
+    def test_commit_and_release_close_hold_and_job(self):
+        committed = self.interrupted_hold(100, 60)
+        released = self.interrupted_hold(200, 60)
+
+        db.commit_balance_hold(committed, 50, 'stars_purchase', target_user='target')
+        db.close_interrupted_delivery_job(committed, 'done', 'подтверждено администратором')
+        db.release_balance_hold(released)
+        db.close_interrupted_delivery_job(released, 'failed', 'средства возвращены администратором')
+
+        self.assertEqual(db.get_open_balance_holds(0), [])
+        self.assertEqual(db.get_user(1)['balance'], 900)
+        statuses = dict(db.get_connection().execute('SELECT hold_id, status FROM delivery_jobs').fetchall())
+        self.assertEqual(statuses, {committed: 'done', released: 'failed'})
+
+    def test_open_holds_query_uses_partial_index(self):
+        plan = ' '.join(
+            row[-1] for row in db.get_connection().execute(
+                'EXPLAIN QUERY PLAN ' + db.OPEN_HOLDS_QUERY
+                + " AND h.created_at <= datetime('now', ?) ORDER BY h.created_at LIMIT ?",
+                ('-30 minutes', 50)
+            )
+        )
+        self.assertIn('idx_balance_holds_reserved', plan)
+        self.assertIn('idx_delivery_jobs_hold', plan)
+
+
+if __name__ == '__main__':
+    unittest.main()
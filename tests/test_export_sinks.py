@@ -0,0 +1,67 @@
+import csv
+import gzip
+import io
+import os
+import sys
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import parse_export_args  # noqa: E402
+from excel_export import EXPORT_FORMATS  # noqa: E402
+
+TABLES = {
+    'Пользователи': (['user_id', 'username', 'balance'], [[1, 'user1', 10.5], [2, None, 0]]),
+    'Платежи': (['id', 'amount'], [[7, 149.99]]),
+}
+
+
+class ExportSinksTest(unittest.TestCase):
+    """Форматы /export пишут каждую таблицу отдельным файлом внутри zip."""
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+
+    def write(self, export_format):
+        filename = os.path.join(self._tmp.name, f'export.{EXPORT_FORMATS[export_format].extension}')
+        sink = EXPORT_FORMATS[export_format](filename)
+        for title, (columns, rows) in TABLES.items():
+            sink.start_table(title, columns)
+            sink.write_rows(rows)
+            sink.end_table()
+        sink.close()
+        return filename
+
+    def assertTablesEqual(self, read_member, archive, suffix):
+        for title, (columns, rows) in TABLES.items():
+            with self.subTest(table=title):
+                read = list(csv.reader(io.StringIO(read_member(archive, f'{title}.{suffix}'))))
+                expected = [columns] + [['' if value is None else str(value) for value in row] for row in rows]
+                self.assertEqual(read, expected)
+
+    def test_csv_gzip_members(self):
+        with zipfile.ZipFile(self.write('csv.gz')) as archive:
+            self.assertEqual(
+                {info.filename: info.compress_type for info in archive.infolist()},
+                {f'{title}.csv.gz': zipfile.ZIP_STORED for title in TABLES}
+            )
+            self.assertTablesEqual(
+                lambda zf, name: gzip.decompress(zf.read(name)).decode('utf-8'), archive, 'csv.gz'
+            )
+
+    def test_csv_members(self):
+        with zipfile.ZipFile(self.write('csv')) as archive:
+            self.assertTrue(all(info.compress_type == zipfile.ZIP_DEFLATED for info in archive.infolist()))
+            self.assertTablesEqual(lambda zf, name: zf.read(name).decode('utf-8-sig'), archive, 'csv')
+
+    def test_columnar_argument(self):
+        self.assertEqual(parse_export_args('/export delta columnar'), (True, 'csv.gz'))
+        self.assertEqual(parse_export_args('/export csv'), (False, 'csv'))
+        self.assertEqual(parse_export_args('/export'), (False, 'xlsx'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import random
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+from excel_export import generate_statistics  # noqa: E402
+
+TRANSACTION_TYPES = ('deposit', 'deposit_ton', 'stars_purchase', 'referral_reward')
+PAYMENT_STATUSES = ('succeeded', 'pending', 'canceled')
+
+
+def fill_database(conn, users, transactions_per_user=3, payments_per_user=1, seed=1, days=400):
+    """Синтетические пользователи, транзакции и платежи с повторяемыми значениями за days дней."""
+    rng = random.Random(seed)
+    start = datetime(2025, 1, 1)
+
+    def created_at():
+        moment = start + timedelta(days=rng.randrange(days), seconds=rng.randrange(86400))
+        return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+    with db.transaction():
+        conn.executemany(
+            'INSERT INTO users (user_id, username, balance, referrer_id, created_at) VALUES (?, ?, ?, ?, ?)',
+            (
+                (user_id, f'user{user_id}', round(rng.uniform(0, 5000), 2) if user_id % 7 else 0,
+                 rng.randint(1, user_id - 1) if user_id > 1 and user_id % 3 == 0 else None, created_at())
+                for user_id in range(1, users + 1)
+            )
+        )
+        conn.executemany(
+            'INSERT INTO transactions (user_id, amount, type, status, created_at) VALUES (?, ?, ?, ?, ?)',
+            (
+                (rng.randint(1, users), round(rng.uniform(1, 1000), 2), rng.choice(TRANSACTION_TYPES),
+                 'completed' if rng.random() < 0.9 else 'pending', created_at())
+                for _ in range(users * transactions_per_user)
+            )
+        )
+        conn.executemany(
+            'INSERT INTO payments (user_id, amount, yookassa_id, status) VALUES (?, ?, ?, ?)',
+            (
+                (rng.randint(1, users), round(rng.uniform(100, 5000), 2), f'yk-{index}',
+                 rng.choice(PAYMENT_STATUSES))
+                for index in range(users * payments_per_user)
+            )
+        )
+
+
+def legacy_generate_statistics(conn):
+    """generate_statistics до перехода на один запрос: эталон порядка строк и значений листа."""
+    stats = {}
+    users_stats = pd.read_sql_query("""
+        SELECT COUNT(*) as total_users, COUNT(DISTINCT referrer_id) as users_with_referrals,
+               SUM(balance) as total_balance, AVG(balance) as avg_balance
+        FROM users
+    """, conn)
+    stats['Всего пользователей'] = users_stats.iloc[0]['total_users']
+    stats['Пользователей с рефералами'] = users_stats.iloc[0]['users_with_referrals']
+    stats['Общий баланс'] = round(users_stats.iloc[0]['total_balance'] or 0, 2)
+    stats['Средний баланс'] = round(users_stats.iloc[0]['avg_balance'] or 0, 2)
+
+    transactions_stats = pd.read_sql_query("""
+        SELECT type, COUNT(*) as count, SUM(amount) as total_amount
+        FROM transactions WHERE status = 'completed' GROUP BY type
+    """, conn)
+    for _, row in transactions_stats.iterrows():
+        stats[f'Транзакций {row["type"]}'] = row['count']
+        stats[f'Сумма {row["type"]}'] = round(row['total_amount'] or 0, 2)
+
+    payments_stats = pd.read_sql_query("""
+        SELECT status, COUNT(*) as count, SUM(amount) as total_amount FROM payments GROUP BY status
+    """, conn)
+    for _, row in payments_stats.iterrows():
+        stats[f'Платежей {row["status"]}'] = row['count']
+        stats[f'Сумма платежей {row["status"]}'] = round(row['total_amount'] or 0, 2)
+
+    top_users = pd.read_sql_query("""
+        SELECT username, balance FROM users WHERE balance > 0 ORDER BY balance DESC LIMIT 5
+    """, conn)
+    for i, (_, row) in enumerate(top_users.iterrows(), 1):
+        stats[f'Топ {i} ({row["username"]})'] = round(row['balance'], 2)
+    return stats
+
+
+class GenerateStatisticsTest(unittest.TestCase):
+    """Лист 'Статистика' совпадает с прежней реализацией: те же строки, порядок и значения."""
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self._db_name = db.DB_NAME
+        db.DB_NAME = os.path.join(self._tmp.name, 'test.db')
+        db.settings_cache.invalidate()
+        db.init_db()
+        self.conn = db.get_connection()
+
+    def tearDown(self):
+        db.close_connections()
+        db.DB_NAME = self._db_name
+        db.settings_cache.invalidate()
+        self._tmp.cleanup()
+
+    def assertMatchesLegacy(self):
+        stats = generate_statistics(self.conn)
+        self.assertNotIn('Ошибка статистики', stats)
+        self.assertTrue(stats.pop('Дата экспорта')[:4].isdigit())
+        expected = legacy_generate_statistics(self.conn)
+        self.assertEqual(list(stats), list(expected))
+        for key, value in expected.items():
+            self.assertAlmostEqual(float(stats[key]), float(value), places=2, msg=key)
+        return stats
+
+    def test_matches_legacy_sheet(self):
+        fill_database(self.conn, 500)
+        stats = self.assertMatchesLegacy()
+        self.assertEqual(len(stats) + 1, 4 + 2 * len(TRANSACTION_TYPES) + 2 * len(PAYMENT_STATUSES) + 5 + 1)
+
+    def test_empty_database(self):
+        self.assertMatchesLegacy()
+
+
+if __name__ == '__main__':
+    unittest.main()
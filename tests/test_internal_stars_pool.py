@@ -0,0 +1,97 @@
+import os
+import random
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+THREADS = 16
+OPERATIONS = 300
+INITIAL_POOL = 200
+INITIAL_USER_STARS = 300
+
+
+class InternalStarsPoolStressTest(unittest.TestCase):
+    """Параллельные списания и пополнения пула и звезд пользователя не теряются и не уводят баланс в минус."""
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self._db_name = db.DB_NAME
+        db.DB_NAME = os.path.join(self._tmp.name, 'test.db')
+        db.settings_cache.invalidate()
+        db.init_db()
+        db.set_internal_stars_pool(INITIAL_POOL)
+        db.create_user(1, 'user1')
+        db.update_internal_stars(1, INITIAL_USER_STARS)
+
+    def tearDown(self):
+        db.close_connections()
+        db.DB_NAME = self._db_name
+        db.settings_cache.invalidate()
+        self._tmp.cleanup()
+
+    def run_threads(self, target):
+        errors = []
+
+        def run(seed):
+            try:
+                target(random.Random(seed))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                db.release_connection()
+
+        threads = [threading.Thread(target=run, args=(seed,)) for seed in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_pool_never_drifts_or_goes_negative(self):
+        applied = []
+        observed = []
+
+        def worker(rng):
+            for _ in range(OPERATIONS):
+                # Списаний больше, чем пополнений: пул регулярно упирается в ноль
+                amount = rng.randint(1, 40) * (-1 if rng.random() < 0.6 else 1)
+                balance = db.update_internal_stars_pool(amount)
+                if balance is None:
+                    self.assertLess(amount, 0)
+                    continue
+                applied.append(amount)
+                observed.append(balance)
+
+        self.run_threads(worker)
+        self.assertLess(len(applied), THREADS * OPERATIONS)
+        self.assertGreaterEqual(min(observed), 0)
+        self.assertEqual(db.get_internal_stars_pool(), INITIAL_POOL + sum(applied))
+
+    def test_user_withdrawals_never_overdraw(self):
+        withdrawn = []
+        credited = []
+
+        def worker(rng):
+            for _ in range(OPERATIONS):
+                amount = rng.randint(1, 20)
+                if rng.random() < 0.3:
+                    self.assertIsNotNone(db.update_internal_stars(1, amount))
+                    credited.append(amount)
+                    continue
+                balance = db.withdraw_internal_stars(1, amount)
+                if balance is not None:
+                    self.assertGreaterEqual(balance, 0)
+                    withdrawn.append(amount)
+
+        self.run_threads(worker)
+        self.assertEqual(db.get_internal_stars(1), INITIAL_USER_STARS + sum(credited) - sum(withdrawn))
+        self.assertGreaterEqual(db.get_internal_stars(1), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+
+# Статистика sqlite_stat1 рабочей БД на вырост: 1M пользователей, 2M платежей, 5M транзакций.
+# Во втором столбце индекса — среднее число строк на значение: статусов и типов мало,
+# поэтому по ним индекс выглядит для планировщика неселективным.
+LARGE_TABLE_STATS = [
+    ('users', None, '1000000'),
+    ('users', 'idx_users_referrer', '1000000 100'),
+    ('payments', None, '2000000'),
+    ('payments', 'idx_payments_user_status_created', '2000000 2 2 1'),
+    ('payments', 'idx_payments_user_created', '2000000 2 1'),
+    ('payments', 'idx_payments_yookassa_id', '2000000 1'),
+    ('payments', 'idx_payments_status', '2000000 500000 1 1'),
+    ('transactions', None, '5000000'),
+    ('transactions', 'idx_transactions_type_status', '5000000 1000000 500000 1'),
+    ('transactions', 'idx_transactions_user', '5000000 5'),
+    ('transactions', 'idx_transactions_external_id', '200000 1'),
+    ('delivery_jobs', None, '500000'),
+    ('delivery_jobs', 'idx_delivery_jobs_status', '500000 125000 1'),
+    ('delivery_jobs', 'idx_delivery_jobs_hold', '500000 1'),
+    ('balance_holds', None, '500000'),
+    ('balance_holds', 'idx_balance_holds_reserved', '100 1'),
+]
+
+
+class QueryPlanTest(unittest.TestCase):
+    """Частые запросы db.py должны идти по индексам из _migration_indexes, а не сканировать таблицы."""
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self._db_name = db.DB_NAME
+        db.DB_NAME = os.path.join(self._tmp.name, 'test.db')
+        db.settings_cache.invalidate()
+        db.init_db()
+
+        # Без ANALYZE, как в рабочей БД: планировщик опирается только на схему
+        with db.transaction():
+            for user_id in range(1, 51):
+                db.create_user(user_id, f'user{user_id}', referrer_id=1 if user_id % 2 else None)
+                db.add_payment(user_id, 100.0, f'yk-{user_id}', 'pending' if user_id % 10 == 0 else 'succeeded')
+                db.add_transaction(user_id, 10.0, 'stars_purchase', 'completed')
+
+    def tearDown(self):
+        db.close_connections()
+        db.DB_NAME = self._db_name
+        db.settings_cache.invalidate()
+        self._tmp.cleanup()
+
+    def plan_of(self, func, *args):
+        """Выполняет func и возвращает планы всех выполненных ею запросов."""
+        conn = db.get_connection()
+        statements = []
+        conn.set_trace_callback(statements.append)
+        try:
+            func(*args)
+        finally:
+            conn.set_trace_callback(None)
+
+        plans = []
+        for sql in statements:
+            if sql.split(None, 1)[0].upper() not in ('SELECT', 'UPDATE', 'DELETE', 'WITH'):
+                continue
+            rows = conn.execute(f'EXPLAIN QUERY PLAN {sql}').fetchall()
+            plans.append((sql, '\n'.join(row[3] for row in rows)))
+        self.assertTrue(plans, f'{func.__name__} не выполнил ни одного запроса')
+        return plans
+
+    def assertUsesIndex(self, func, index, *args):
+        plans = self.plan_of(func, *args)
+        self.assertTrue(
+            any(index in plan for _, plan in plans),
+            f'{func.__name__} не использует {index}:\n' + '\n\n'.join(f'{sql}\n{plan}' for sql, plan in plans)
+        )
+
+    def test_referral_count(self):
+        self.assertUsesIndex(db.get_referral_count, 'idx_users_referrer', 1)
+
+    def test_pending_payment(self):
+        self.assertUsesIndex(db.get_pending_payment, 'idx_payments_user_status_created', 7)
+
+    def test_latest_payment(self):
+        self.assertUsesIndex(db.get_latest_payment, 'idx_payments_user_created', 7)
+
+    def test_payment_by_yookassa_id(self):
+        self.assertUsesIndex(db.get_payment, 'idx_payments_yookassa_id', 'yk-7')
+        self.assertUsesIndex(db.update_payment_status, 'idx_payments_yookassa_id', 'yk-7', 'canceled')
+
+    def test_pending_payments_page(self):
+        self.assertUsesIndex(db.get_pending_payments_page, 'idx_payments_status', 0, 100, 0)
+
+    def test_claim_delivery_job(self):
+        self.assertUsesIndex(db.claim_delivery_job, 'idx_delivery_jobs_status')
+        self.assertUsesIndex(db.get_delivery_queue_depth, 'idx_delivery_jobs_status')
+
+    def test_open_balance_holds(self):
+        self.assertUsesIndex(db.get_open_balance_holds, 'idx_balance_holds_reserved', 30)
+        self.assertUsesIndex(db.get_open_balance_holds, 'idx_delivery_jobs_hold', 30)
+
+    def test_stats_counter_queries(self):
+        conn = db.get_connection()
+        expected = {
+            'referred_users': 'idx_users_referrer',
+            'completed_purchases': 'idx_transactions_type_status',
+            'succeeded_payments': 'idx_payments_status',
+            'succeeded_payments_sum': 'idx_payments_status',
+        }
+        for name, index in expected.items():
+            with self.subTest(counter=name):
+                query = db.STATS_COUNTERS_QUERIES[name]
+                plan = '\n'.join(row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {query}').fetchall())
+                self.assertIn(index, plan)
+
+
+class LargeTableQueryPlanTest(QueryPlanTest):
+    """Те же запросы, когда ANALYZE видит таблицы на миллионы строк (статистика подменена в sqlite_stat1)."""
+
+    def setUp(self):
+        super().setUp()
+        with db.transaction() as conn:
+            conn.execute('ANALYZE')
+            conn.execute('DELETE FROM sqlite_stat1')
+            conn.executemany('INSERT INTO sqlite_stat1 (tbl, idx, stat) VALUES (?, ?, ?)', LARGE_TABLE_STATS)
+        # Перечитать статистику в схему соединения
+        db.get_connection().execute('ANALYZE sqlite_schema')
+
+    def test_planner_reads_fake_stats(self):
+        # Контроль подмены: объявленный бесполезным индекс планировщик перестает выбирать
+        conn = db.get_connection()
+        query = "EXPLAIN QUERY PLAN SELECT user_id FROM users WHERE referrer_id = 1 AND username = 'user1'"
+        self.assertIn('idx_users_referrer', conn.execute(query).fetchone()[3])
+        with db.transaction():
+            conn.execute("UPDATE sqlite_stat1 SET stat = '1000000 1000000' WHERE idx = 'idx_users_referrer'")
+        conn.execute('ANALYZE sqlite_schema')
+        self.assertNotIn('idx_users_referrer', conn.execute(query).fetchone()[3])
+
+
+if __name__ == '__main__':
+    unittest.main()
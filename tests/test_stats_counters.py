@@ -0,0 +1,60 @@
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+
+class StatsCountersTest(unittest.TestCase):
+    """Денежные счетчики /stats совпадают с пересчетом до копейки после тысяч изменений."""
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self._db_name = db.DB_NAME
+        db.DB_NAME = os.path.join(self._tmp.name, 'test.db')
+        db.settings_cache.invalidate()
+        db.init_db()
+
+    def tearDown(self):
+        db.close_connections()
+        db.DB_NAME = self._db_name
+        db.settings_cache.invalidate()
+        self._tmp.cleanup()
+
+    def test_money_counters_do_not_drift(self):
+        rng = random.Random(7)
+        with db.transaction():
+            for user_id in range(1, 101):
+                db.create_user(user_id, f'user{user_id}')
+            for index in range(5000):
+                user_id = rng.randint(1, 100)
+                db.update_balance(user_id, rng.choice((0.1, 0.2, 0.3, 1.15, 99.99, -0.07, -0.33)))
+                if index % 5 == 0:
+                    amount = rng.choice((0.1, 0.7, 149.99, 1000.01))
+                    db.add_payment(user_id, amount, f'yk-{index}', 'succeeded' if index % 3 else 'pending')
+            for index in range(0, 5000, 15):
+                db.update_payment_status(f'yk-{index}', 'succeeded')
+            db.get_connection().execute('DELETE FROM users WHERE user_id % 10 = 0')
+
+        counters = db.get_stats_counters()
+        before, after = db.rebuild_stats_counters()
+        self.assertEqual(before, after)
+        for name in ('balance_sum', 'succeeded_payments_sum'):
+            with self.subTest(counter=name):
+                self.assertEqual(counters[name], round(counters[name], 2))
+        conn = db.get_connection()
+        self.assertEqual(counters['balance_sum'], round(conn.execute('SELECT SUM(balance) FROM users').fetchone()[0], 2))
+
+    def test_migration_recreates_triggers(self):
+        conn = db.get_connection()
+        sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'trg_stats_users_update'").fetchone()[0]
+        self.assertIn('ROUND(', sql)
+        self.assertEqual(db.get_schema_version(), len(db.MIGRATIONS))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+import requests
+import uvicorn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import api_server  # noqa: E402
+from config import WEBHOOK_PATH  # noqa: E402
+
+SECRET = 'test-secret'
+
+# Обновления в том виде, в каком их присылает Telegram
+RECORDED_UPDATES = [
+    {
+        'update_id': 900000001,
+        'message': {
+            'message_id': 11,
+            'from': {'id': 1001, 'is_bot': False, 'first_name': 'Ivan', 'username': 'ivan', 'language_code': 'ru'},
+            'chat': {'id': 1001, 'first_name': 'Ivan', 'username': 'ivan', 'type': 'private'},
+            'date': 1760000000,
+            'text': '/start',
+            'entities': [{'offset': 0, 'length': 6, 'type': 'bot_command'}],
+        },
+    },
+    {
+        'update_id': 900000002,
+        'callback_query': {
+            'id': '4382bfdwdsb323b2d9',
+            'from': {'id': 1001, 'is_bot': False, 'first_name': 'Ivan', 'username': 'ivan'},
+            'message': {
+                'message_id': 12,
+                'from': {'id': 555, 'is_bot': True, 'first_name': 'Stars Bot', 'username': 'stars_bot'},
+                'chat': {'id': 1001, 'first_name': 'Ivan', 'username': 'ivan', 'type': 'private'},
+                'date': 1760000001,
+                'text': 'Главное меню',
+            },
+            'chat_instance': '-8147356205034012410',
+            'data': 'buy_stars',
+        },
+    },
+]
+
+
+class TelegramWebhookTest(unittest.TestCase):
+    """Записанные обновления Telegram проходят через /telegram/webhook до обработчиков бота."""
+
+    @classmethod
+    def setUpClass(cls):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        cls.url = f'http://127.0.0.1:{sock.getsockname()[1]}{WEBHOOK_PATH}'
+        cls.server = uvicorn.Server(uvicorn.Config(api_server.app, log_level='warning'))
+        cls.thread = threading.Thread(target=cls.server.run, kwargs={'sockets': [sock]}, daemon=True)
+        cls.thread.start()
+        deadline = time.monotonic() + 10
+        while not cls.server.started:
+            if time.monotonic() > deadline:
+                raise RuntimeError('uvicorn не запустился')
+            time.sleep(0.01)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.should_exit = True
+        cls.thread.join(timeout=10)
+
+    def setUp(self):
+        self.processed = []
+        self.done = threading.Semaphore(0)
+
+        def process_new_updates(updates):
+            self.processed.extend(updates)
+            self.done.release()
+
+        for patcher in (
+            mock.patch.object(api_server, 'BOT_MODE', 'webhook'),
+            mock.patch.object(api_server, 'WEBHOOK_SECRET', SECRET),
+            mock.patch.object(api_server.bot, 'process_new_updates', process_new_updates),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post(self, payload, secret=SECRET):
+        headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+        return requests.post(self.url, json=payload, headers=headers, timeout=5)
+
+    def test_recorded_updates_reach_bot(self):
+        for payload in RECORDED_UPDATES:
+            response = self.post(payload)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json(), {'ok': True})
+        for _ in RECORDED_UPDATES:
+            self.assertTrue(self.done.acquire(timeout=5))
+
+        updates = sorted(self.processed, key=lambda update: update.update_id)
+        self.assertEqual([update.update_id for update in updates], [900000001, 900000002])
+        self.assertEqual(updates[0].message.text, '/start')
+        self.assertEqual(updates[0].message.from_user.id, 1001)
+        self.assertEqual(updates[1].callback_query.data, 'buy_stars')
+        self.assertEqual(updates[1].callback_query.message.chat.id, 1001)
+
+    def test_wrong_or_missing_secret_rejected(self):
+        for secret in ('wrong-secret', None):
+            response = self.post(RECORDED_UPDATES[0], secret=secret)
+            self.assertEqual(response.status_code, 401)
+        self.assertFalse(self.done.acquire(timeout=0.3))
+        self.assertEqual(self.processed, [])
+
+    def test_full_queue_asks_telegram_to_retry(self):
+        with mock.patch.object(api_server._update_queue, 'put_nowait', side_effect=api_server.queue.Full):
+            response = self.post(RECORDED_UPDATES[0])
+        self.assertEqual(response.status_code, 503)
+
+
+if __name__ == '__main__':
+    unittest.main()
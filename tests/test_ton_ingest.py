@@ -0,0 +1,157 @@
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import ton_ingest  # noqa: E402
+
+TON_RUB_RATE = 100.0
+NANO = 10 ** 9
+
+
+class InlineRuntime:
+    """Замена BackgroundRuntime: блокирующие вызовы выполняются сразу в потоке теста."""
+
+    http = None
+
+    async def run_blocking(self, func, *args):
+        return func(*args)
+
+
+class FakeChain:
+    """История адреса от новых транзакций к старым, как отдает getTransactions."""
+
+    def __init__(self):
+        self.transactions = []
+        self.next_lt = 1000
+        self.calls = 0
+        self.fail_on_call = None
+
+    def add(self, user_id, ton, comment=None):
+        self.next_lt += 3
+        self.transactions.insert(0, {
+            'transaction_id': {'lt': str(self.next_lt), 'hash': f'h{self.next_lt}'},
+            'in_msg': {'value': str(int(ton * NANO)), 'message': comment if comment is not None else str(user_id)}
+        })
+
+    async def fetch_page(self, lt, tx_hash_value, to_lt, limit):
+        self.calls += 1
+        if self.calls == self.fail_on_call:
+            return None
+        start = 0
+        if lt is not None:
+            start = next(
+                index for index, tx in enumerate(self.transactions)
+                if ton_ingest.tx_lt(tx) == lt and ton_ingest.tx_hash(tx) == tx_hash_value
+            )
+        page = [tx for tx in self.transactions[start:] if ton_ingest.tx_lt(tx) > to_lt]
+        return page[:limit]
+
+
+class TonIngestReplayTest(unittest.TestCase):
+    """Прием депозитов TON: всплески больше страницы, сбои страниц и повторная обработка."""
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self._db_name = db.DB_NAME
+        db.DB_NAME = os.path.join(self._tmp.name, 'test.db')
+        db.settings_cache.invalidate()
+        db.init_db()
+        for user_id in range(1, 11):
+            db.create_user(user_id, f'user{user_id}')
+        self.chain = FakeChain()
+        self.credited = []
+
+    def tearDown(self):
+        db.close_connections()
+        db.DB_NAME = self._db_name
+        db.settings_cache.invalidate()
+        self._tmp.cleanup()
+
+    def ingestor(self):
+        return ton_ingest.TonDepositIngestor(
+            lambda: TON_RUB_RATE, on_credited=self.credited.append, fetch_page=self.chain.fetch_page
+        )
+
+    def poll(self, ingestor):
+        return asyncio.run(ingestor.poll_once(InlineRuntime()))
+
+    def total_balance(self):
+        return db.get_connection().execute('SELECT SUM(balance) FROM users').fetchone()[0]
+
+    def test_first_poll_credits_deposits_without_cursor(self):
+        ingestor = self.ingestor()
+        self.assertEqual(self.poll(ingestor), 0)
+
+        self.chain.add(5, 5)
+        self.assertEqual(self.poll(ingestor), 1)
+        self.assertEqual(db.get_user(5)['balance'], 500.0)
+        self.assertEqual(int(db.get_setting('last_lt')), ingestor.last_lt)
+
+    def test_burst_larger_than_page_is_credited_once(self):
+        self.chain.add(1, 1)
+        ingestor = self.ingestor()
+        self.poll(ingestor)
+
+        for burst in (ton_ingest.PAGE_SIZE - 1, ton_ingest.PAGE_SIZE, ton_ingest.PAGE_SIZE + 1, 350):
+            with self.subTest(burst=burst):
+                before = len(self.credited)
+                for index in range(burst):
+                    self.chain.add(index % 10 + 1, 1)
+                self.chain.add(1, 1, comment='not a user id')
+                self.poll(ingestor)
+                self.assertEqual(len(self.credited) - before, burst)
+
+        self.assertEqual(self.total_balance(), len(self.credited) * TON_RUB_RATE)
+
+    def test_failed_page_keeps_cursor(self):
+        self.chain.add(1, 1)
+        ingestor = self.ingestor()
+        self.poll(ingestor)
+        cursor = ingestor.last_lt
+
+        for index in range(250):
+            self.chain.add(index % 10 + 1, 1)
+        self.chain.fail_on_call = self.chain.calls + 2
+        self.assertEqual(self.poll(ingestor), 0)
+        self.assertEqual(ingestor.last_lt, cursor)
+        self.assertEqual(int(db.get_setting('last_lt')), cursor)
+
+        self.poll(ingestor)
+        self.assertEqual(len(self.credited), 251)
+
+    def test_replay_from_old_cursor_credits_nothing(self):
+        self.chain.add(1, 1)
+        ingestor = self.ingestor()
+        self.poll(ingestor)
+        for index in range(150):
+            self.chain.add(index % 10 + 1, 1)
+        self.poll(ingestor)
+        balance = self.total_balance()
+
+        db.set_setting('last_lt', 0)
+        self.poll(self.ingestor())
+        self.assertEqual(self.total_balance(), balance)
+        self.assertEqual(len(self.credited), 151)
+
+    def test_replaying_a_page_credits_nothing(self):
+        for index in range(ton_ingest.PAGE_SIZE):
+            self.chain.add(index % 10 + 1, 1)
+        deposits = [ton_ingest.parse_deposit(tx, TON_RUB_RATE) for tx in reversed(self.chain.transactions)]
+        last_lt = deposits[-1]['lt']
+
+        self.assertEqual(len(db.settle_ton_deposits(deposits, last_lt)), ton_ingest.PAGE_SIZE)
+        balance = self.total_balance()
+        self.assertEqual(db.settle_ton_deposits(deposits, last_lt), [])
+        self.assertEqual(self.total_balance(), balance)
+        deposit_rows = db.get_connection().execute(
+            "SELECT COUNT(*) FROM transactions WHERE type = 'deposit_ton'"
+        ).fetchone()[0]
+        self.assertEqual(deposit_rows, ton_ingest.PAGE_SIZE)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+import db  # noqa: E402
+import payment_reconciler  # noqa: E402
+import yookassa  # noqa: E402
+from yookassa import AMOUNT_MISMATCH, PAYMENT_NOT_FOUND  # noqa: E402
+
+
+def payment_info(status, value=None):
+    info = {'id': 'yk-1', 'status': status}
+    if value is not None:
+        info['amount'] = {'value': f'{value:.2f}', 'currency': 'RUB'}
+    return info
+
+
+class YookassaPaymentsTest(unittest.TestCase):
+    """Закрытие платежей ЮKassa из webhook-уведомления и фоновой сверки."""
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self._db_name = db.DB_NAME
+        db.DB_NAME = os.path.join(self._tmp.name, 'test.db')
+        db.settings_cache.invalidate()
+        db.init_db()
+        db.create_user(1, 'user1')
+        self.alerts = []
+        for patcher in (
+            mock.patch.object(bot.admin_notifier, 'error', side_effect=lambda text, *_: self.alerts.append(text)),
+            mock.patch.object(bot, 'notify_payment_settled'),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        db.close_connections()
+        db.DB_NAME = self._db_name
+        db.settings_cache.invalidate()
+        self._tmp.cleanup()
+
+    def add_payment(self, yookassa_id, amount, age_hours=0):
+        db.add_payment(1, amount, yookassa_id)
+        with db.transaction() as conn:
+            conn.execute(
+                "UPDATE payments SET created_at = datetime('now', ?) WHERE yookassa_id = ?",
+                (f'-{age_hours * 60 + 5} minutes', yookassa_id)
+            )
+
+    def reconcile(self, check):
+        reconciler = payment_reconciler.PaymentReconciler(on_settled=bot._on_reconciled_payment, rate=1000)
+        with mock.patch.object(payment_reconciler, 'check_payment_status', side_effect=check):
+            return asyncio.run(reconciler.reconcile_once())
+
+    def test_underpaid_payment_closed_once_without_credit(self):
+        self.add_payment('yk-1', 500)
+        with mock.patch.object(bot, 'check_payment_status', return_value=payment_info('succeeded', 300)):
+            first = bot.settle_yookassa_payment('yk-1')
+            second = bot.settle_yookassa_payment('yk-1')
+
+        self.assertEqual(first[0], AMOUNT_MISMATCH)
+        self.assertIsNotNone(first[1])
+        self.assertEqual(second, (AMOUNT_MISMATCH, None))
+        self.assertEqual(len(self.alerts), 1)
+        self.assertIn('300.00', self.alerts[0])
+        self.assertEqual(db.get_payment('yk-1')['status'], AMOUNT_MISMATCH)
+        self.assertEqual(db.get_user(1)['balance'], 0)
+        self.assertEqual(db.count_pending_payments(), 0)
+
+    def test_full_payment_credited(self):
+        self.add_payment('yk-1', 500)
+        with mock.patch.object(bot, 'check_payment_status', return_value=payment_info('succeeded', 500)):
+            status, settled = bot.settle_yookassa_payment('yk-1')
+        self.assertEqual(status, 'succeeded')
+        self.assertEqual(settled['balance'], 500)
+        self.assertEqual(self.alerts, [])
+
+    def test_reconciler_marks_underpaid_payment_and_alerts_once(self):
+        self.add_payment('yk-1', 500, age_hours=1)
+        check = lambda payment_id: payment_info('succeeded', 100)  # noqa: E731
+        self.assertEqual(self.reconcile(check)['settled'], 1)
+        self.assertEqual(self.reconcile(check)['checked'], 0)
+        self.assertEqual(db.get_payment('yk-1')['status'], AMOUNT_MISMATCH)
+        self.assertEqual(db.get_user(1)['balance'], 0)
+        self.assertEqual(len(self.alerts), 1)
+
+    def test_reconciler_expires_only_on_definite_answer(self):
+        for yookassa_id in ('yk-failed', 'yk-missing', 'yk-canceled'):
+            self.add_payment(yookassa_id, 100, age_hours=72)
+        self.add_payment('yk-missing-fresh', 100, age_hours=1)
+        answers = {
+            'yk-failed': None,
+            'yk-missing': payment_info(PAYMENT_NOT_FOUND),
+            'yk-missing-fresh': payment_info(PAYMENT_NOT_FOUND),
+            'yk-canceled': payment_info('canceled'),
+        }
+        self.reconcile(answers.get)
+
+        statuses = {yookassa_id: db.get_payment(yookassa_id)['status'] for yookassa_id in answers}
+        self.assertEqual(statuses, {
+            'yk-failed': 'pending',
+            'yk-missing': 'expired',
+            'yk-missing-fresh': 'pending',
+            'yk-canceled': 'canceled',
+        })
+
+    def test_webhook_path_leaves_unknown_payment_to_reconciler(self):
+        self.add_payment('yk-1', 100, age_hours=72)
+        with mock.patch.object(bot, 'check_payment_status', return_value=payment_info(PAYMENT_NOT_FOUND)):
+            self.assertEqual(bot.settle_yookassa_payment('yk-1'), (PAYMENT_NOT_FOUND, None))
+        self.assertEqual(db.get_payment('yk-1')['status'], 'pending')
+
+
+class CheckPaymentStatusTest(unittest.TestCase):
+    """check_payment_status отличает отсутствующий платеж от ошибки запроса."""
+
+    def setUp(self):
+        for patcher in (
+            mock.patch.object(yookassa, 'YOOKASSA_SHOP_ID', 'shop'),
+            mock.patch.object(yookassa, 'YOOKASSA_SECRET_KEY', 'secret'),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def check(self, status_code=None, error=None):
+        response = mock.Mock(status_code=status_code)
+        response.json.return_value = payment_info('succeeded', 100)
+        if status_code and status_code >= 400:
+            response.raise_for_status.side_effect = requests.HTTPError(f'{status_code} Error')
+        with mock.patch.object(yookassa.http_client, 'get', return_value=response, side_effect=error):
+            return yookassa.check_payment_status('yk-1')
+
+    def test_found(self):
+        self.assertEqual(self.check(200)['status'], 'succeeded')
+
+    def test_not_found(self):
+        self.assertEqual(self.check(404), {'id': 'yk-1', 'status': PAYMENT_NOT_FOUND})
+
+    def test_request_failed(self):
+        self.assertIsNone(self.check(500))
+        self.assertIsNone(self.check(error=requests.ConnectionError('connection reset')))
+        with mock.patch.object(yookassa, 'YOOKASSA_SECRET_KEY', None):
+            self.assertIsNone(self.check(200))
+
+
+if __name__ == '__main__':
+    unittest.main()
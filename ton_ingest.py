@@ -0,0 +1,231 @@
+import functools
+
+import http_client
+from config import TON_API_BASE_URL, TON_API_KEY, TON_DEPOSIT_ADDRESS, logger
+from db import get_setting, settle_ton_deposits
+
+
+# --- Прием депозитов TON ---
+# Курсор (lt последней обработанной транзакции) хранится в settings.last_lt.
+# Каждый проход листает историю адреса от новых транзакций к старым
+# (lt/hash — начало страницы, to_lt — курсор), пока не дойдет до курсора,
+# поэтому всплеск больше одной страницы не теряется. Зачисления и новый
+# курсор фиксируются одной транзакцией БД (db.settle_ton_deposits), а
+# повторная обработка тех же переводов ничего не меняет.
+PAGE_SIZE = 100
+MAX_PAGES = 100  # предохранитель: не больше PAGE_SIZE * MAX_PAGES транзакций за проход
+MIN_POLL_INTERVAL = 3.0
+MAX_POLL_INTERVAL = 30.0
+POLL_BACKOFF = 1.5  # во сколько раз растет интервал, если новых транзакций нет
+MIN_DEPOSIT_RUB = 1.0
+LAST_LT_KEY = 'last_lt'
+
+
+def tx_lt(tx):
+    return int(tx['transaction_id']['lt'])
+
+
+def tx_hash(tx):
+    return tx['transaction_id']['hash']
+
+
+async def fetch_transactions_page(session, lt=None, tx_hash_value=None, to_lt=0, limit=PAGE_SIZE):
+    """Запрашивает страницу транзакций адреса (от новых к старым). None при ошибке."""
+    params = {
+        'address': TON_DEPOSIT_ADDRESS,
+        'limit': limit,
+        'to_lt': to_lt,
+        'api_key': TON_API_KEY
+    }
+    if lt is not None:
+        params['lt'] = lt
+        params['hash'] = tx_hash_value
+
+    # Сначала пробуем archival=true, если не получилось — fallback на archival=false.
+    for archival in ('true', 'false'):
+        try:
+            status, resp_json = await http_client.async_request(
+                session, 'GET', f'{TON_API_BASE_URL}/api/v2/getTransactions',
+                params={**params, 'archival': archival},
+                timeout=(5, 10)
+            )
+        except Exception as e:
+            logger.error(f"Ошибка запроса TON API: {e!r}")
+            continue
+
+        if status != 200 or not isinstance(resp_json, dict):
+            logger.error("TON API HTTP %s: %s", status, str(resp_json)[:500])
+            continue
+        if not resp_json.get('ok'):
+            err = resp_json.get('error') or resp_json.get('message') or resp_json
+            logger.error(f"Ошибка ответа TON API: {err}")
+            continue
+        return resp_json.get('result', [])
+    return None
+
+
+async def collect_new_transactions(last_lt, fetch_page, page_size=PAGE_SIZE):
+    """Собирает все транзакции новее last_lt, листая историю назад.
+
+    fetch_page(lt, hash, to_lt, limit) — корутина, возвращающая страницу.
+    Возвращает (транзакции по возрастанию lt, complete). complete=False, если
+    страницу получить не удалось или сработал MAX_PAGES: тогда курсор двигать
+    нельзя, иначе более старые транзакции будут пропущены.
+    """
+    collected = {}
+    lt = tx_hash_value = None
+    for _ in range(MAX_PAGES):
+        page = await fetch_page(lt, tx_hash_value, last_lt, page_size)
+        if page is None:
+            return [], False
+
+        fresh = 0
+        for tx in page:
+            current_lt = tx_lt(tx)
+            # Страница, начатая с (lt, hash), включает и саму эту транзакцию
+            if current_lt <= last_lt or (current_lt, tx_hash(tx)) in collected:
+                continue
+            collected[(current_lt, tx_hash(tx))] = tx
+            fresh += 1
+
+        if len(page) < page_size or not fresh or tx_lt(page[-1]) <= last_lt:
+            return sorted(collected.values(), key=tx_lt), True
+        lt, tx_hash_value = tx_lt(page[-1]), tx_hash(page[-1])
+
+    logger.error(
+        f"TON: за проход собрано больше {MAX_PAGES} страниц, курсор {last_lt} не сдвинут"
+    )
+    return sorted(collected.values(), key=tx_lt), False
+
+
+def parse_deposit(tx, ton_rub_rate):
+    """Разбирает входящий перевод. Возвращает dict депозита или None, если это не депозит."""
+    lt = tx_lt(tx)
+    in_msg = tx.get('in_msg')
+    if not in_msg:
+        return None
+
+    value_nano = int(in_msg.get('value', 0))
+    if value_nano <= 0:
+        return None
+
+    # user_id передается в комментарии к переводу
+    uid_str = (in_msg.get('message') or '').strip()
+    if not uid_str.isdigit():
+        logger.warning(f"Пропущена транзакция: {lt}. Некорректный uid в комментарии: '{uid_str}'")
+        return None
+
+    ton_amount = value_nano / 1e9
+    # Конвертация TON в RUB
+    rub_amount = round(ton_amount * ton_rub_rate, 2)
+    if rub_amount < MIN_DEPOSIT_RUB:  # Игнорируем слишком маленькие суммы
+        return None
+
+    return {
+        'lt': lt,
+        'hash': tx_hash(tx),
+        'user_id': int(uid_str),
+        'ton_amount': ton_amount,
+        'rub_amount': rub_amount
+    }
+
+
+class TonDepositIngestor:
+    """Прием депозитов TON с курсором и адаптивным интервалом опроса.
+
+    Выполняется как периодическая задача BackgroundRuntime: HTTP-запросы
+    асинхронные, работа с БД и уведомления — через пул runtime.
+    """
+
+    def __init__(self, rate_func, on_credited=None, fetch_page=None, settle=settle_ton_deposits):
+        # rate_func() -> курс TON/RUB или None; on_credited(deposit) — после фиксации.
+        # fetch_page — корутина как у collect_new_transactions (по умолчанию toncenter).
+        self.rate_func = rate_func
+        self.on_credited = on_credited
+        self.fetch_page = fetch_page
+        self.settle = settle
+        self.interval = MIN_POLL_INTERVAL
+        self.last_lt = None
+        self.total_credited = 0
+
+    def load_cursor(self):
+        try:
+            self.last_lt = int(get_setting(LAST_LT_KEY, '0'))
+        except (TypeError, ValueError):
+            logger.error(f"Некорректное значение last_lt в БД: '{get_setting(LAST_LT_KEY)}'. Используется 0.")
+            self.last_lt = 0
+        logger.info(f"Мониторинг TON: последний LT {self.last_lt}")
+        return self.last_lt
+
+    async def poll_once(self, runtime):
+        """Один проход: сбор новых транзакций, зачисление, сдвиг курсора. Возвращает число новых транзакций."""
+        fetch_page = self.fetch_page or functools.partial(fetch_transactions_page, runtime.http)
+        if self.last_lt is None:
+            await runtime.run_blocking(self.load_cursor)
+
+        ton_rub_rate = await runtime.run_blocking(self.rate_func)
+        if not ton_rub_rate:
+            return 0
+
+        if self.last_lt:
+            transactions, complete = await collect_new_transactions(self.last_lt, fetch_page)
+            if not complete:
+                return 0
+        else:
+            # Курсора еще нет (новая БД или новый кошелек): зачисляем последнюю
+            # страницу истории, как раньше. Чтобы пропустить историю, оператор
+            # задает начальный last_lt в settings вручную.
+            page = await fetch_page(None, None, 0, PAGE_SIZE)
+            if page is None:
+                return 0
+            transactions = sorted(page, key=tx_lt)
+        if not transactions:
+            return 0
+
+        # Страницы фиксируются по очереди, от старых к новым: курсор сдвигается
+        # вместе с зачислениями каждой страницы
+        for start in range(0, len(transactions), PAGE_SIZE):
+            page = transactions[start:start + PAGE_SIZE]
+            deposits = [deposit for deposit in (parse_deposit(tx, ton_rub_rate) for tx in page) if deposit]
+            new_last_lt = tx_lt(page[-1])
+            credited = await runtime.run_blocking(self.settle, deposits, new_last_lt)
+            self.last_lt = new_last_lt
+            self.total_credited += len(credited)
+
+            skipped = len(deposits) - len(credited)
+            if skipped:
+                logger.warning(f"TON: {skipped} депозитов не зачислено (повтор или пользователь не найден)")
+
+            # Уведомления — только после фиксации транзакции
+            for deposit in credited:
+                logger.info(
+                    f"✅ Депозит TON подтвержден! User: {deposit['user_id']}, "
+                    f"TON: {deposit['ton_amount']}, RUB: {deposit['rub_amount']}"
+                )
+                if self.on_credited:
+                    try:
+                        await runtime.run_blocking(self.on_credited, deposit)
+                    except Exception as e:
+                        logger.error(f"Ошибка уведомления о депозите TON {deposit['lt']}: {e}")
+        return len(transactions)
+
+    def _next_interval(self, new_count):
+        if new_count:
+            return MIN_POLL_INTERVAL
+        return min(MAX_POLL_INTERVAL, self.interval * POLL_BACKOFF)
+
+    async def run_job(self, runtime):
+        """Периодическая задача runtime. Возвращает задержку до следующего опроса."""
+        new_count = 0
+        try:
+            new_count = await self.poll_once(runtime)
+        finally:
+            self.interval = self._next_interval(new_count)
+        return self.interval
+
+    def stats(self):
+        return {
+            'last_lt': self.last_lt,
+            'interval': self.interval,
+            'total_credited': self.total_credited
+        }
@@ -1,29 +1,104 @@
 import time
 import threading
-from bot import logger
-
-# Глобальная переменная для управления анимацией.
-# Ее определение остается в bot.py, но лучше, если она будет передаваться или управляться классом.
-# Для простоты, оставим ее глобальной, но будем импортировать.
-# from bot import animation_running # <- Должен быть в bot.py
-
-def animate_caption(bot, call):
-    """Показывает анимацию 'Отправляю звезды...'."""
-    from bot import animation_running # Локальный импорт, чтобы избежать циклической зависимости
-    dots = 1
-    while animation_running:
-        caption = "🔄 Отправляю звезды" + "." * dots
-        try:
-            bot.edit_message_caption(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                caption=caption,
-                reply_markup=None
-            )
-        except Exception as e:
-            if "message is not modified" not in str(e):
-                logger.warning(f"Ошибка при обновлении сообщения анимации: {e}")
-            break
-
-        dots = (dots % 3) + 1
-        time.sleep(1)
\ No newline at end of file
+from config import logger
+
+
+# --- Планировщик анимаций прогресса ---
+# Один поток обслуживает все анимации "Отправляю звезды..." сразу.
+# Анимации хранятся по ключу (chat_id, message_id), поэтому параллельные
+# покупки не мешают друг другу, а правки в один чат не чаще CHAT_EDIT_INTERVAL.
+TICK_INTERVAL = 0.25
+FRAME_INTERVAL = 1.0
+CHAT_EDIT_INTERVAL = 1.5
+
+
+class ProgressScheduler:
+    """Общий планировщик анимированных подписей для долгих операций."""
+
+    def __init__(self, edit_func, frame_interval=FRAME_INTERVAL, chat_edit_interval=CHAT_EDIT_INTERVAL):
+        self.edit_func = edit_func
+        self.frame_interval = frame_interval
+        self.chat_edit_interval = chat_edit_interval
+        self._cond = threading.Condition()
+        self._tickers = {}
+        self._chat_last_edit = {}
+        self._in_flight = set()
+        self._thread = None
+        self.edits = 0
+
+    def start(self, chat_id, message_id, text, reply_markup=None):
+        """Запускает анимацию для сообщения (chat_id, message_id)."""
+        key = (chat_id, message_id)
+        with self._cond:
+            self._tickers[key] = {
+                'text': text,
+                'reply_markup': reply_markup,
+                'frame': 0,
+                'next_at': time.monotonic()
+            }
+            self._ensure_thread()
+            self._cond.notify_all()
+        return key
+
+    def stop(self, chat_id, message_id):
+        """Останавливает анимацию и дожидается окончания уже начатой правки."""
+        key = (chat_id, message_id)
+        with self._cond:
+            self._tickers.pop(key, None)
+            while key in self._in_flight:
+                self._cond.wait()
+
+    def active_count(self):
+        with self._cond:
+            return len(self._tickers)
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='progress-scheduler', daemon=True)
+            self._thread.start()
+
+    def _next_due(self, now):
+        """Выбирает по одной анимации на чат, у которой подошло время кадра."""
+        due = {}
+        for key, ticker in self._tickers.items():
+            chat_id = key[0]
+            if ticker['next_at'] > now:
+                continue
+            if now - self._chat_last_edit.get(chat_id, 0.0) < self.chat_edit_interval:
+                continue
+            current = due.get(chat_id)
+            if current is None or ticker['next_at'] < self._tickers[current]['next_at']:
+                due[chat_id] = key
+        return list(due.values())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._tickers:
+                    self._cond.wait()
+                now = time.monotonic()
+                self._chat_last_edit = {
+                    chat_id: edited_at for chat_id, edited_at in self._chat_last_edit.items()
+                    if now - edited_at < self.chat_edit_interval
+                }
+                batch = []
+                for key in self._next_due(now):
+                    ticker = self._tickers[key]
+                    ticker['frame'] = ticker['frame'] % 3 + 1
+                    ticker['next_at'] = now + self.frame_interval
+                    self._chat_last_edit[key[0]] = now
+                    self._in_flight.add(key)
+                    batch.append((key, ticker['text'] + '.' * ticker['frame'], ticker['reply_markup']))
+
+            for key, text, reply_markup in batch:
+                try:
+                    self.edit_func(key[0], key[1], text, reply_markup)
+                    self.edits += 1
+                except Exception as e:
+                    logger.warning(f"Ошибка при обновлении сообщения анимации: {e}")
+                finally:
+                    with self._cond:
+                        self._in_flight.discard(key)
+                        self._cond.notify_all()
+
+            time.sleep(TICK_INTERVAL)
@@ -1,9 +1,24 @@
 import base64
 import uuid
 import requests
+import http_client
 from config import YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY, YOOKASSA_API_URL, logger
 from db import add_payment
 
+# Платеж прошел, но оплачено меньше суммы в БД: баланс не пополняется, разбирает администратор
+AMOUNT_MISMATCH = 'amount_mismatch'
+# ЮKassa ответила 404: платежа с таким ID у нее нет (в отличие от ошибки запроса)
+PAYMENT_NOT_FOUND = 'not_found'
+
+
+def get_paid_amount(payment_info):
+    return float(payment_info.get('amount', {}).get('value', 0))
+
+
+def is_underpaid(payment_info, amount):
+    return get_paid_amount(payment_info) + 0.009 < float(amount)
+
+
 
 def create_yookassa_payment(amount, user_id, bot_username):
     if not YOOKASSA_SHOP_ID or not YOOKASSA_SECRET_KEY:
@@ -61,7 +76,7 @@ def create_yookassa_payment(amount, user_id, bot_username):
 
     try:
         logger.info(f"🔄 Создание платежа ЮKassa: {amount} руб для пользователя {user_id}")
-        response = requests.post(YOOKASSA_API_URL, json=payload, headers=headers, timeout=30)
+        response = http_client.post(YOOKASSA_API_URL, json=payload, headers=headers, timeout=30)
 
         if response.status_code != 200:
             logger.error(f"❌ Ошибка ЮKassa API: {response.status_code} - {response.text}")
@@ -87,6 +102,11 @@ def create_yookassa_payment(amount, user_id, bot_username):
 
 
 def check_payment_status(payment_id):
+    """Данные платежа из API ЮKassa.
+
+    Для неизвестного ЮKassa платежа (404) возвращает {'id': ..., 'status': PAYMENT_NOT_FOUND},
+    при ошибке запроса (сеть, 5xx, нет учетных данных) — None.
+    """
     if not YOOKASSA_SHOP_ID or not YOOKASSA_SECRET_KEY:
         logger.error("❌ Учетные данные ЮKassa отсутствуют.")
         return None
@@ -102,7 +122,10 @@ def check_payment_status(payment_id):
     }
 
     try:
-        response = requests.get(url, headers=headers, timeout=30)
+        response = http_client.get(url, headers=headers, timeout=30)
+        if response.status_code == 404:
+            logger.warning(f"Платеж {payment_id} не найден в ЮKassa")
+            return {'id': payment_id, 'status': PAYMENT_NOT_FOUND}
         response.raise_for_status()
         return response.json()
     except Exception as e: